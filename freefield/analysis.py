@@ -16,13 +16,80 @@ def get_loctest_data(sequence):
     """
     if not isinstance(sequence, Trialsequence):
         raise ValueError("Input must be slab trialsequence!")
-    data = pd.DataFrame(columns=["azi_target", "ele_target", "azi_response", "ele_response"])
+    rows = []
     for trial, response in zip(sequence.trials, sequence.data):
         target = sequence.conditions[trial-1]
-        row = {"azi_target": target.azi, "ele_target": target.ele,
-               "azi_response": response[0], "ele_response": response[1]}
-        data = data.append(row, ignore_index=True)
-    return data
+        rows.append([target.index_number, target.azi, target.ele, response[0], response[1]])
+    data = pd.DataFrame(rows, columns=["index_number", "azi_target", "ele_target", "azi_response", "ele_response"])
+    return data.astype({"azi_response": float, "ele_response": float})
+
+
+def localization_metrics(data):
+    """
+    Compute localization metrics for every speaker, subject and session at once. Instead of
+    grouping the data, the trials are sorted by subject, session and target speaker and all sums
+    are computed with numpy.add.reduceat over the contiguous groups. Trials without a response
+    (NaN) are ignored.
+    Args:
+        data (pandas DataFrame | dict): one trial per row with the columns "index_number" (of the
+            target speaker), "azi_target", "ele_target", "azi_response", "ele_response" and optionally
+            "subject" and "session" (e.g. several concatenated outputs of get_loctest_data)
+    Returns:
+        pandas DataFrame: metrics per subject, session and speaker - number of trials (n), mean response
+            direction (azi_mean, ele_mean), difference between mean response and target (azi_bias,
+            ele_bias) as well as mad and rmse of the responses around their mean (as in mad() and rmse())
+        pandas DataFrame: metrics per subject and session - number of trials (n), root mean square
+            error between responses and targets in azimuth and elevation (azi_rmse, ele_rmse) and
+            the elevation and azimuth gain (eg, ag), i.e. the slope of the regression of
+            response on target position
+    """
+    data = pd.DataFrame(data)
+    data = data[np.isfinite(data[["azi_response", "ele_response"]].values.astype(float)).all(axis=1)]
+    n_trials = len(data)
+    if n_trials == 0:
+        return pd.DataFrame(), pd.DataFrame()
+    subject = data["subject"].values if "subject" in data else np.zeros(n_trials, dtype=int)
+    session = data["session"].values if "session" in data else np.zeros(n_trials, dtype=int)
+    subject_codes, subjects = pd.factorize(subject, sort=True)
+    session_codes, sessions = pd.factorize(session, sort=True)
+    speaker = data["index_number"].values.astype(int)
+    order = np.lexsort((speaker, session_codes, subject_codes))
+    subject_codes, session_codes, speaker = subject_codes[order], session_codes[order], speaker[order]
+    target = data[["azi_target", "ele_target"]].values.astype(float)[order]
+    response = data[["azi_response", "ele_response"]].values.astype(float)[order]
+
+    # groups of speakers within a session and sessions within a subject
+    new_session = np.ones(n_trials, dtype=bool)
+    new_session[1:] = (np.diff(subject_codes) != 0) | (np.diff(session_codes) != 0)
+    new_speaker = new_session.copy()
+    new_speaker[1:] |= np.diff(speaker) != 0
+    speaker_starts, session_starts = np.flatnonzero(new_speaker), np.flatnonzero(new_session)
+
+    # per speaker metrics
+    n = np.diff(np.append(speaker_starts, n_trials))
+    mean = np.add.reduceat(response, speaker_starts, axis=0) / n[:, np.newaxis]
+    dist = np.sqrt(((response - np.repeat(mean, n, axis=0))**2).sum(axis=1))
+    speakers = pd.DataFrame({
+        "subject": subjects[subject_codes[speaker_starts]], "session": sessions[session_codes[speaker_starts]],
+        "index_number": speaker[speaker_starts], "azi_target": target[speaker_starts, 0],
+        "ele_target": target[speaker_starts, 1], "n": n, "azi_mean": mean[:, 0], "ele_mean": mean[:, 1],
+        "azi_bias": mean[:, 0] - target[speaker_starts, 0], "ele_bias": mean[:, 1] - target[speaker_starts, 1],
+        "mad": np.add.reduceat(dist, speaker_starts) / n,
+        "rmse": np.sqrt(np.add.reduceat(dist**2, speaker_starts) / n)})
+
+    # per session metrics, the gain is computed from the sums of the least squares regression
+    n = np.diff(np.append(session_starts, n_trials))
+    sq_error = np.add.reduceat((response - target)**2, session_starts, axis=0)
+    sum_x, sum_y = np.add.reduceat(target, session_starts, axis=0), np.add.reduceat(response, session_starts, axis=0)
+    sum_xx = np.add.reduceat(target**2, session_starts, axis=0)
+    sum_xy = np.add.reduceat(target*response, session_starts, axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        gain = (n[:, np.newaxis]*sum_xy - sum_x*sum_y) / (n[:, np.newaxis]*sum_xx - sum_x**2)
+    sessions = pd.DataFrame({
+        "subject": subjects[subject_codes[session_starts]], "session": sessions[session_codes[session_starts]],
+        "n": n, "azi_rmse": np.sqrt(sq_error[:, 0] / n), "ele_rmse": np.sqrt(sq_error[:, 1] / n),
+        "eg": gain[:, 1], "ag": gain[:, 0]})
+    return speakers, sessions
 
 def mean_dir(data, speaker):
     # use vector addition with uncorrected angles:
@@ -0,0 +1,106 @@
+"""
+Render binaural stimuli for localization tests with headphones by filtering a source signal
+with head related impulse responses (HRIRs). The impulse responses for all positions are
+applied at once by multiplying their spectra with the spectrum of the source.
+"""
+import hashlib
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scipy.fft import next_fast_len
+import slab
+from freefield import spherical
+
+
+def render_binaural(source, hrtf, speakers, n_jobs=1, cache_dir=None):
+    """
+    Filter the source with the HRIRs that are closest to the positions of the given speakers.
+    The result can be passed as signals to main.localization_test_headphones.
+
+    Args:
+        source (slab.Sound): single channel sound, must have the same samplerate as the HRTF
+        hrtf (slab.HRTF | str | pathlib.Path): HRTF with finite impulse responses or path of a .sofa file
+        speakers (pandas DataFrame): rows from the speaker table, the sources of the HRTF that are
+            closest to the speakers' azimuth and elevation are used
+        n_jobs (int): number of processes that compute the convolution, if 1 don't use a process pool
+        cache_dir (None | str | pathlib.Path): if given, rendered stimuli are stored in this folder and
+            loaded from there when the same source is rendered with the same HRTF and HRIR again
+    Returns:
+        dict: binaural sounds (slab.Binaural) with the speakers' index numbers as keys
+    """
+    if isinstance(hrtf, (str, Path)):
+        hrtf = slab.HRTF(hrtf)
+    source = slab.Sound(source)
+    if source.data.shape[1] != 1:
+        raise ValueError("The source must have a single channel!")
+    if source.samplerate != hrtf.samplerate:
+        raise ValueError("Source and HRTF must have the same samplerate!")
+    hrirs, idx = _closest_hrirs(hrtf, speakers)
+    signal = source.data[:, 0].astype(float)
+    rendered = np.zeros((len(speakers), len(signal) + hrirs.shape[1] - 1, 2))
+    missing = np.arange(len(speakers))
+    if cache_dir is not None:
+        cache_dir = Path(cache_dir)
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        hrtf_key = _hrtf_key(hrtf)  # identify the whole HRTF by its data, independent of the rendered speakers
+        source_key = hashlib.sha1(signal.tobytes() + str(source.samplerate).encode()).hexdigest()
+        files = [cache_dir / f"{hashlib.sha1(f'{hrtf_key}_{source_key}_{i}'.encode()).hexdigest()}.npy" for i in idx]
+        cached = np.array([file.exists() for file in files], dtype=bool)
+        for i in np.flatnonzero(cached):
+            rendered[i] = np.load(files[i])
+        missing = np.flatnonzero(~cached)
+    if len(missing):
+        if n_jobs == 1:
+            rendered[missing] = convolve(hrirs[missing], signal)
+        else:
+            chunks = np.array_split(missing, n_jobs)
+            with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+                results = pool.map(convolve, [hrirs[chunk] for chunk in chunks], [signal] * len(chunks))
+                for chunk, result in zip(chunks, results):
+                    rendered[chunk] = result
+        if cache_dir is not None:
+            for i in missing:
+                np.save(files[i], rendered[i])
+    return {index_number: slab.Binaural(rendered[i], samplerate=source.samplerate)
+            for i, index_number in enumerate(speakers.index_number)}
+
+
+def convolve(hrirs, signal):
+    """
+    Convolve a single channel signal with several binaural impulse responses using the FFT.
+
+    Args:
+        hrirs (numpy.ndarray): impulse responses with shape (positions, taps, 2)
+        signal (numpy.ndarray): one dimensional signal
+    Returns:
+        numpy.ndarray: filtered signals with shape (positions, len(signal) + taps - 1, 2)
+    """
+    n = len(signal) + hrirs.shape[1] - 1
+    n_fft = next_fast_len(n)
+    spectrum = np.fft.rfft(signal, n_fft)
+    transfer_functions = np.fft.rfft(hrirs, n_fft, axis=1)
+    return np.fft.irfft(transfer_functions * spectrum[np.newaxis, :, np.newaxis], n_fft, axis=1)[:, :n, :]
+
+
+def _hrtf_key(hrtf):
+    """hash of the impulse responses, source positions and samplerate of the whole HRTF"""
+    sources = np.asarray(getattr(hrtf.sources, "vertical_polar", hrtf.sources), dtype=float)
+    key = hashlib.sha1(sources.tobytes() + str(hrtf.samplerate).encode())
+    for hrir in hrtf.data:
+        key.update(np.ascontiguousarray(hrir.data, dtype=float).tobytes())
+    return key.hexdigest()
+
+
+def _closest_hrirs(hrtf, speakers):
+    """return the HRIRs for the sources closest to the speakers as array and the indices of the sources"""
+    if getattr(hrtf, "datatype", "FIR") != "FIR":
+        raise ValueError("The HRTF must contain finite impulse responses!")
+    sources = np.asarray(getattr(hrtf.sources, "vertical_polar", hrtf.sources), dtype=float)
+    # in the HRTF, azimuth runs counterclockwise from 0 to 360 degree, in the speaker table it is positive to the right
+    source_azi = -((sources[:, 0] + 180) % 360 - 180)
+    error = spherical.great_circle_error(speakers.azi.values.astype(float)[:, np.newaxis],
+                                         speakers.ele.values.astype(float)[:, np.newaxis],
+                                         source_azi[np.newaxis, :], sources[np.newaxis, :, 1])
+    idx = error.argmin(axis=1)
+    hrirs = np.stack([np.asarray(hrtf.data[i].data, dtype=float) for i in idx])
+    return hrirs, idx
@@ -5,7 +5,6 @@ except ModuleNotFoundError:
     print("PySpin module required for working with FLIR cams not found! \n"
           "You can download the .whl here: \n"
           "https://www.flir.com/products/spinnaker-sdk/")
-import PIL
 from freefield import PoseEstimator
 import time
 import cv2
@@ -13,15 +12,67 @@ from scipy import stats
 from matplotlib import pyplot as plt
 import pandas as pd
 import logging
+import threading
+from pathlib import Path
 import numpy as np
 from abc import abstractmethod
 
 
-def initialize_cameras(kind="flir", face_detection_tresh=.9):
+def initialize_cameras(kind="flir", face_detection_tresh=.9, **kwargs):
+    """Initialize cameras of the given kind, additional keyword arguments are passed to the camera class."""
     if kind.lower() == "flir":
         return FlirCams(face_detection_tresh=face_detection_tresh)
     elif kind.lower() == "webcam":
-        return WebCams(face_detection_tresh=face_detection_tresh)
+        return WebCams(face_detection_tresh=face_detection_tresh, **kwargs)
+    elif kind.lower() == "replay":
+        return ReplayCams(face_detection_tresh=face_detection_tresh, **kwargs)
+
+
+def fuse_poses(pose, mad_thresh=3.0, min_error=0.5):
+    """
+    Fuse several head pose estimates (e.g. from multiple cameras and images) into
+    a single estimate. Each estimate is weighted by the confidence of the face
+    detection divided by the squared reprojection error of the pose. Before averaging,
+    estimates that deviate from the median by more than mad_thresh times the (normal
+    scaled) median absolute deviation in azimuth or elevation are rejected as outliers.
+
+    Args:
+        pose (pandas DataFrame): estimates as returned by Cameras.get_headpose(average=False)
+        mad_thresh (float): outlier threshold in multiples of the scaled median absolute deviation
+        min_error (float): lower bound for the reprojection error in pixels, avoids infinite weights
+    Returns:
+        pandas Series: weighted mean of azimuth and elevation, their standard errors and the
+            number of estimates that were used ("n") and rejected ("n_rejected")
+    """
+    pose = pose.dropna(subset=["azi", "ele"])
+    angles = pose[["azi", "ele"]].values.astype(float)
+    if "confidence" in pose and "error" in pose:
+        confidence = pose["confidence"].fillna(1.0).values.astype(float)
+        error = pose["error"].fillna(min_error).values.astype(float)
+        weights = confidence / np.maximum(error, min_error)**2
+    else:
+        weights = np.ones(len(angles))
+    if len(angles) == 0:
+        return pd.Series({"azi": None, "ele": None, "azi_sem": None, "ele_sem": None,
+                          "n": 0, "n_rejected": 0})
+    # median / MAD outlier rejection, separately for azimuth and elevation
+    median = np.median(angles, axis=0)
+    mad = 1.4826 * np.median(np.abs(angles - median), axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        deviation = np.abs(angles - median) / mad
+    deviation[:, mad == 0] = 0  # all estimates (nearly) identical -> keep them
+    keep = (deviation <= mad_thresh).all(axis=1)
+    angles, weights = angles[keep], weights[keep]
+    weights = weights / weights.sum()
+    mean = (weights[:, np.newaxis] * angles).sum(axis=0)
+    if len(angles) > 1:  # standard error based on the effective number of estimates
+        n_eff = 1 / (weights**2).sum()
+        var = (weights[:, np.newaxis] * (angles - mean)**2).sum(axis=0) * n_eff / (n_eff - 1)
+        sem = np.sqrt(var / n_eff)
+    else:
+        sem = np.array([np.nan, np.nan])
+    return pd.Series({"azi": mean[0], "ele": mean[1], "azi_sem": sem[0], "ele_sem": sem[1],
+                      "n": int(keep.sum()), "n_rejected": int((~keep).sum())})
 
 
 class Cameras():
@@ -37,24 +88,27 @@ class Cameras():
     def halt(self) -> None:
         pass
 
-    def get_headpose(self, convert=True, average=True, n=1, resolution=1.0):
+    def get_headpose(self, convert=True, average=True, n=1, resolution=1.0, uncertainty=False,
+                     tolerance=None, timeout=None):
         """Acquire n images and compute headpose (elevation and azimuth). If
         convert is True use the regression coefficients to convert
-        the camera into world coordinates
+        the camera into world coordinates. If average is True, the estimates
+        from all cameras and images are fused (see fuse_poses) and azimuth and
+        elevation are returned. If uncertainty is True as well, the whole fusion
+        result including the standard errors and the number of acquired images
+        ("n_frames") is returned as a pandas Series. A resolution below 1 downsamples
+        the images for face detection while the landmarks are still detected at
+        full resolution (see PoseEstimator.estimate_pose).
+        If a tolerance (in degree) is given, images are acquired one at a time until
+        the standard error of the fused azimuth and elevation is below tolerance. In
+        this case, n is the maximum number of images and timeout (in seconds) an
+        optional deadline after which the acquisition is stopped.
         """
-        pose = pd.DataFrame(columns=["ele", "azi", "cam"])
-        images = self.acquire_images(n)  # take images
-        for i_cam in range(images.shape[3]):
-            for i_image in range(images.shape[2]):
-                image = images[:, :, i_image, i_cam]  # get image from array
-                if resolution < 1.0:
-                    image = self.change_image_res(image, resolution)
-                # get the headpose,
-                azi, ele = self.model.pose_from_image(image)
-                pose = pose.append(
-                        pd.DataFrame(
-                            [[ele, azi, i_cam, "camera"]],
-                            columns=["ele", "azi", "cam", "frame"]))
+        if tolerance is None:
+            pose = self._pose_from_images(self.acquire_images(n), resolution)
+        else:
+            pose = self._acquire_adaptive(convert, n, resolution, tolerance, timeout)
+        n_frames = int(pose["image"].max()) + 1 if len(pose) else 0
         if len(pose.dropna()) == 0:
             if average:
                 return (None, None)
@@ -66,17 +120,85 @@ class Cameras():
                 return None
             else:
                 pose = self.convert_coordinates(pose)
-        if average:  # only return the mean
-            return pose.azi.mean(), pose.ele.mean()
+        if average:  # only return the fused estimate
+            fused = fuse_poses(pose)
+            fused["n_frames"] = n_frames
+            if uncertainty:
+                return fused
+            return fused.azi, fused.ele
         else:  # return the whole data frame
             return pose
 
-    def change_image_res(self, image, resolution):
-        image = PIL.Image.fromarray(image)
-        width = int(self.imsize[1]*resolution)
-        height = int(self.imsize[0]*resolution)
-        image = image.resize((width, height), PIL.Image.ANTIALIAS)
-        return numpy.asarray(image)
+    def _pose_from_images(self, images, resolution=1.0, first_image=0):
+        """Estimate the pose in every image of every camera and return the results in a data frame."""
+        rows = []
+        for i_cam in range(images.shape[3]):
+            for i_image in range(images.shape[2]):
+                image = images[:, :, i_image, i_cam]  # get image from array
+                # get the headpose, detection confidence and reprojection error. Faces
+                # are detected at the given resolution, landmarks in the full image
+                azi, ele, confidence, error = self.model.estimate_pose(image, detection_scale=resolution)
+                rows.append([ele, azi, i_cam, "camera", confidence, error, first_image + i_image])
+        pose = pd.DataFrame(rows, columns=["ele", "azi", "cam", "frame", "confidence", "error", "image"])
+        return pose.astype({"ele": float, "azi": float, "confidence": float, "error": float})
+
+    def _acquire_adaptive(self, convert, max_n, resolution, tolerance, timeout):
+        """Acquire and evaluate one image per camera at a time until the standard
+        error of the fused pose is below tolerance, max_n images were taken or
+        the timeout is exceeded."""
+        deadline = None if timeout is None else time.time() + timeout
+        poses = []
+        for i_image in range(max_n):
+            poses.append(self._pose_from_images(self.acquire_images(1), resolution, first_image=i_image))
+            pose = pd.concat(poses, ignore_index=True)
+            if deadline is not None and time.time() > deadline:
+                logging.warning(f"Pose estimation timed out after {i_image + 1} images")
+                break
+            valid = pose.dropna()
+            if len(valid) < 2:
+                continue
+            if convert and self.calibration is not None:
+                valid = self.convert_coordinates(valid.copy())
+            fused = fuse_poses(valid)
+            if fused.n > 1 and fused.azi_sem < tolerance and fused.ele_sem < tolerance:
+                break
+        logging.info(f"Acquired {i_image + 1} images for pose estimation")
+        return pose
+
+    def record(self, path, n, interval=0.0):
+        """
+        Acquire n images from every camera and write them to a .npy file that can
+        be replayed with ReplayCams. The images are stored in the same layout that
+        is returned by acquire_images, i.e. (height, width, n, ncams). The time
+        each image was acquired is stored in a second file with the suffix
+        "_timestamps".
+
+        Args:
+            path (str | pathlib.Path): file the images are written to
+            n (int): number of images to record from each camera
+            interval (float): pause between two images in seconds
+        """
+        path = Path(path).with_suffix(".npy")
+        frames = np.lib.format.open_memmap(path, mode="w+", dtype="uint8", shape=tuple(self.imsize)+(n, self.ncams))
+        timestamps = np.zeros((n, self.ncams))
+        for i_image in range(n):
+            frames[:, :, i_image, :] = self.acquire_images(1)[:, :, 0, :]
+            camera_timestamps = getattr(self, "timestamps", None)
+            if camera_timestamps is not None:  # use the camera's timestamps if available
+                timestamps[i_image] = camera_timestamps[0]
+            else:
+                timestamps[i_image] = time.monotonic()
+            time.sleep(interval)
+        frames.flush()
+        np.save(path.with_name(path.stem + "_timestamps.npy"), timestamps)
+        logging.info(f"recorded {n} images from {self.ncams} camera(s) to {path}")
+        del frames
+
+    @staticmethod
+    def change_image_res(image, resolution):
+        width = int(image.shape[1]*resolution)
+        height = int(image.shape[0]*resolution)
+        return cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
 
     def convert_coordinates(self, coords):
         for cam in np.unique(coords["cam"]):  # convert for each cam ...
@@ -186,47 +308,200 @@ class FlirCams(Cameras):
 
 
 class WebCams(Cameras):
-    def __init__(self):
+    def __init__(self, face_detection_tresh=.9, devices=None, resolution=None, fps=None):
+        """
+        Initialize webcams. Each camera is read continuously on a background thread
+        which keeps the newest frame, so acquiring images does not require flushing
+        the camera's buffer.
+
+        Args:
+            face_detection_tresh (float): threshold for the face detection, see PoseEstimator
+            devices (None | list of int): indices of the cameras to use, if None use all available
+            resolution (None | tuple of int): width and height of the images, if None use the default
+            fps (None | float): frame rate of the cameras, if None use the default
+        """
         super().__init__(face_detection_tresh=face_detection_tresh)
-        self.cams = []
-        stop = False
-        while stop is False:
-            cap = cv2.VideoCapture(0)
-            if cap.isOpened():
-                self.cams.append(cap)
-            else:
-                stop = True
+        if devices is None:
+            devices = find_webcams()
+        self.cams = [_WebCamReader(index, resolution, fps) for index in devices]
+        for cam in self.cams:
+            cam.start()
         logging.info("initialized %s webcams(s)" % (len(self.cams)))
         self.ncams = len(self.cams)
-        self.imsize = self.acquire_images(n=1).shape[0:2]
+        self.timestamps = None
+        self._last_frames = [0] * self.ncams
+        try:
+            self.imsize = self.acquire_images(n=1).shape[0:2]
+        except ValueError:
+            self.halt()
+            raise
 
     def acquire_images(self, n=1):
         """
-            The webcam takes several pictures and reading only advances
-            the buffer one step at a time, thus grab all images and only
-            retrieve the latest one
+        Return n new frames from each camera. Frames are taken at the cameras
+        frame rate and the time when each frame was read (from time.monotonic)
+        is stored in the timestamps attribute. Raises ValueError if no camera
+        delivered a frame.
         """
-        if hasattr(self, "imsize"):
-            image_data = np.zeros(self.imsize+(n, self.ncams), dtype="uint8")
-        else:
-            image_data = None
+        image_data = None
+        self.timestamps = np.zeros((n, self.ncams))
         for i_image in range(n):
             for i_cam, cam in enumerate(self.cams):
-                for i in range(cv2.CAP_PROP_FRAME_COUNT):
-                    cam.grab()
-                ret, image = cam.retrieve()
-                if image.shape[-1] == 3:
-                    image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-                if ret is False:
+                image, timestamp, count = cam.get_frame(newer_than=self._last_frames[i_cam])
+                if image is None:
                     logging.warning("could not acquire image...")
                 else:
-                    if image_data is not None:
-                        image_data[:, :, i_image, i_cam] = image
-                    else:
-                        image_data = image
+                    if image_data is None:  # allocate the array with the size of the first image
+                        image_data = np.zeros(image.shape[0:2]+(n, self.ncams), dtype="uint8")
+                    self._last_frames[i_cam] = count
+                    self.timestamps[i_image, i_cam] = timestamp
+                    image_data[:, :, i_image, i_cam] = image
+        if image_data is None:
+            raise ValueError("Could not acquire any image from the webcams!")
         return image_data
 
     def halt(self):
         for cam in self.cams:
-            cam.release()
+            cam.stop()
         logging.info("Halting webcams.")
+
+
+class ReplayCams(Cameras):
+    def __init__(self, path, face_detection_tresh=.9, realtime=False, loop=True):
+        """
+        Replay previously recorded images instead of acquiring them from cameras.
+        This allows running the pose estimation without a camera, e.g. to measure
+        its speed and accuracy. The recording can either be a .npy file written by
+        Cameras.record, which is memory-mapped and may contain images from several
+        cameras, or a video file (one camera).
+
+        Args:
+            path (str | pathlib.Path): .npy file or video to replay
+            face_detection_tresh (float): threshold for the face detection, see PoseEstimator
+            realtime (bool): if True, return the images with the same timing as they were recorded
+            loop (bool): if True, start from the beginning once all images were returned
+        """
+        super().__init__(face_detection_tresh=face_detection_tresh)
+        path = Path(path)
+        self.realtime, self.loop = realtime, loop
+        self.timestamps = None
+        self.position = 0
+        self._video = None
+        if path.suffix == ".npy":
+            self.frames = np.load(path, mmap_mode="r")
+            self.imsize, self.n_frames, self.ncams = self.frames.shape[0:2], self.frames.shape[2], self.frames.shape[3]
+            timestamp_file = path.with_name(path.stem + "_timestamps.npy")
+            if timestamp_file.exists():
+                self.frame_times = np.load(timestamp_file)
+            else:
+                self.frame_times = None
+        else:
+            self._video = cv2.VideoCapture(str(path))
+            if not self._video.isOpened():
+                raise ValueError(f"Could not open video {path}!")
+            self.n_frames, self.ncams = int(self._video.get(cv2.CAP_PROP_FRAME_COUNT)), 1
+            fps = self._video.get(cv2.CAP_PROP_FPS)
+            self.frame_times = np.arange(self.n_frames)[:, np.newaxis] / fps if fps > 0 else None
+            self.imsize = (int(self._video.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                           int(self._video.get(cv2.CAP_PROP_FRAME_WIDTH)))
+        self._start = None  # host time and recording time of the first replayed image
+        logging.info(f"replaying {self.n_frames} images from {self.ncams} camera(s)")
+
+    def acquire_images(self, n=1):
+        image_data = np.zeros(tuple(self.imsize)+(n, self.ncams), dtype="uint8")
+        self.timestamps = np.zeros((n, self.ncams))
+        for i_image in range(n):
+            if self.position >= self.n_frames:
+                if not self.loop:
+                    raise ValueError("All recorded images have been replayed!")
+                self.position, self._start = 0, None
+                if self._video is not None:
+                    self._video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            if self.realtime and self.frame_times is not None:
+                if self._start is None:
+                    self._start = (time.monotonic(), self.frame_times[self.position, 0])
+                wait = self._start[0] + self.frame_times[self.position, 0] - self._start[1] - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+            if self._video is not None:
+                ret, image = self._video.read()
+                if ret is False:
+                    raise ValueError(f"Could not read image {self.position} from video!")
+                if image.ndim == 3:
+                    image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+                image_data[:, :, i_image, 0] = image
+            else:
+                image_data[:, :, i_image, :] = self.frames[:, :, self.position, :]
+            self.timestamps[i_image] = time.monotonic()
+            self.position += 1
+        return image_data
+
+    def halt(self):
+        if self._video is not None:
+            self._video.release()
+        logging.info("Halting replay.")
+
+
+def find_webcams(max_devices=10):
+    """Return the indices of all webcams that can be opened (checking indices 0 to max_devices-1)."""
+    devices = []
+    for index in range(max_devices):
+        cap = cv2.VideoCapture(index)
+        if cap.isOpened():
+            devices.append(index)
+        cap.release()
+    return devices
+
+
+class _WebCamReader(threading.Thread):
+    """
+    Read frames from a single webcam on a background thread and keep the newest
+    one together with the time it was read and a running frame count.
+    """
+
+    def __init__(self, index, resolution=None, fps=None):
+        super().__init__(daemon=True)
+        self.index = index
+        self.cap = cv2.VideoCapture(index)
+        if not self.cap.isOpened():
+            raise ValueError(f"Could not open webcam with index {index}!")
+        if resolution is not None:
+            self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, resolution[0])
+            self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, resolution[1])
+        if fps is not None:
+            self.cap.set(cv2.CAP_PROP_FPS, fps)
+        self.frame, self.timestamp, self.count = None, None, 0
+        self._condition = threading.Condition()
+        self._running = False
+
+    def start(self):
+        self._running = True
+        super().start()
+
+    def run(self):
+        while self._running:
+            ret, frame = self.cap.read()
+            timestamp = time.monotonic()
+            if ret is False:
+                time.sleep(0.01)
+                continue
+            if frame.ndim == 3:
+                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            with self._condition:
+                self.frame, self.timestamp = frame, timestamp
+                self.count += 1
+                self._condition.notify_all()
+
+    def get_frame(self, newer_than=0, timeout=1.0):
+        """Wait until a frame with a count larger than newer_than is available and return
+        frame, timestamp and count. If there is no new frame within timeout (in seconds),
+        all returned values are None."""
+        with self._condition:
+            if not self._condition.wait_for(lambda: self.count > newer_than, timeout):
+                return None, None, None
+            return self.frame, self.timestamp, self.count
+
+    def stop(self):
+        self._running = False
+        self.join(timeout=1.0)
+        self.cap.release()
@@ -0,0 +1,356 @@
+"""
+Compute the loudspeaker equalization from recordings. All functions take a matrix of
+recordings with one row per speaker and compute levels, inverse filters and diagnostics
+for all speakers at once. They do not access the processors, so a calibration can be
+computed again from stored recordings with different parameters (see main.equalize_speakers
+for recording the calibration).
+"""
+import os
+import json
+import datetime
+import logging
+import itertools
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import slab
+from matplotlib import pyplot as plt
+from matplotlib.axes import Axes
+
+
+def levels(recordings, samplerate):
+    """Level (in dB, as computed by slab) of each recording, the recordings have shape (speakers, samples)."""
+    return np.atleast_1d(slab.Sound(np.asarray(recordings).T, samplerate=samplerate).level)
+
+
+def level_equalization(recordings, target, db_thresh, samplerate):
+    """
+    Compute the factor by which the level of a signal must be multiplied to make each speaker as
+    loud as the target. Speakers that are quieter than db_thresh (e.g. broken or disconnected ones)
+    are not equalized and get a factor of 1.
+
+    Args:
+        recordings (numpy.ndarray): recording of the same signal from each speaker with shape (speakers, samples)
+        target (int): row of the target speaker in recordings
+        db_thresh (float): recordings below this level are treated like the target
+        samplerate (int): samplerate of the recordings
+    Returns:
+        numpy.ndarray: level factor of each speaker
+        numpy.ndarray: level of each recording in dB
+        numpy.ndarray of bool: True for speakers that were above the threshold
+    """
+    recorded = levels(recordings, samplerate)
+    valid = recorded >= db_thresh
+    factors = np.where(valid, recorded[target] / recorded, 1.0)
+    return factors, recorded, valid
+
+
+def frequency_equalization(recordings, target, db_thresh, samplerate, bandwidth=1/10, low_cutoff=200,
+                           high_cutoff=16000, alpha=1.0):
+    """
+    Compute a bank of inverse filters that equalize the spectrum of each speaker relative to the target
+    (see slab.Filter.equalizing_filterbank) and find deep notches in the filters.
+
+    Args:
+        recordings (numpy.ndarray): recording of the level equalized signal from each speaker with
+            shape (speakers, samples)
+        target (int): row of the target speaker in recordings
+        db_thresh (float): recordings below this level are replaced by the target so their filter is flat
+        samplerate (int): samplerate of the recordings
+        bandwidth, low_cutoff, high_cutoff, alpha: parameters for slab.Filter.equalizing_filterbank
+    Returns:
+        slab.Filter: filter bank with one channel per speaker
+        numpy.ndarray: minimum of each filter's transfer function between low_cutoff and high_cutoff in dB
+    """
+    recordings = np.array(recordings, dtype=float)
+    recordings[levels(recordings, samplerate) < db_thresh] = recordings[target]  # flat filter for excluded speakers
+    target_sound = slab.Sound(recordings[target], samplerate=samplerate)
+    filter_bank = slab.Filter.equalizing_filterbank(target=target_sound, signal=slab.Sound(recordings.T,
+                                                    samplerate=samplerate), low_cutoff=low_cutoff,
+                                                    high_cutoff=high_cutoff, bandwidth=bandwidth, alpha=alpha)
+    frequencies, transfer_functions = filter_bank.tf(show=False)
+    band = (frequencies >= low_cutoff) & (frequencies <= high_cutoff)
+    notch_depth = np.asarray(transfer_functions)[band].min(axis=0)
+    return filter_bank, notch_depth
+
+
+def equalize(level_recordings, frequency_recordings, speakers, target_speaker, samplerate, db_thresh=80,
+             bandwidth=1/10, low_cutoff=200, high_cutoff=16000, alpha=1.0, notch_thresh=-30):
+    """
+    Compute the level and frequency equalization of all speakers and a table for checking it.
+
+    Args:
+        level_recordings (numpy.ndarray): recordings of the raw signal with shape (speakers, samples)
+        frequency_recordings (numpy.ndarray): recordings of the level equalized signal, same shape
+        speakers (pandas DataFrame): rows from the speaker table in the same order as the recordings
+        target_speaker (int): index number of the speaker all others are equalized to
+        samplerate (int): samplerate of the recordings
+        db_thresh, bandwidth, low_cutoff, high_cutoff, alpha: see level_equalization and frequency_equalization
+        notch_thresh (float): filters whose transfer function drops below this value (in dB) contain a notch
+    Returns:
+        dict: the calibration of each speaker with the speakers' index numbers (as string) as keys.
+            Each entry contains the level factor ("level") and the equalizing filter ("filter")
+        pandas DataFrame: one row per speaker with the recorded level, the level factor, whether the
+            speaker was above the threshold, and the depth of the deepest notch in its filter
+    """
+    index_numbers = np.asarray(speakers.index_number, dtype=int)
+    if target_speaker not in index_numbers:
+        raise ValueError("The target speaker must be one of the equalized speakers!")
+    target = int(np.flatnonzero(index_numbers == target_speaker)[0])
+    factors, recorded, valid = level_equalization(level_recordings, target, db_thresh, samplerate)
+    filter_bank, notch_depth = frequency_equalization(frequency_recordings, target, db_thresh, samplerate,
+                                                      bandwidth, low_cutoff, high_cutoff, alpha)
+    diagnostics = pd.DataFrame({"index_number": index_numbers, "azi": np.asarray(speakers.azi, dtype=float),
+                                "ele": np.asarray(speakers.ele, dtype=float), "level": recorded,
+                                "level_factor": factors, "valid": valid, "notch_depth": notch_depth,
+                                "notch": notch_depth < notch_thresh})
+    for row in diagnostics[diagnostics.notch].itertuples():
+        logging.warning(f"The filter for speaker {row.index_number} at azimuth {row.azi} and elevation {row.ele} "
+                        f"contains a notch of {row.notch_depth:.1f} dB - adjust the equalization parameters!")
+    calibration = {str(index_number): {"level": factors[i], "filter": filter_bank.channel(i)}
+                   for i, index_number in enumerate(index_numbers)}
+    return calibration, diagnostics
+
+
+def save_recordings(path, level_recordings, frequency_recordings, speakers, samplerate, **parameters):
+    """
+    Store the recordings of a calibration run so the equalization can be computed again later
+    (see equalize_recordings). The recordings are saved as float32 .npy files that can be memory-mapped,
+    together with the recorded speakers and a json file with the samplerate and equalization parameters.
+
+    Args:
+        path (str | pathlib.Path): folder the recordings are written to
+        level_recordings, frequency_recordings, speakers, samplerate: see equalize
+        **parameters: arguments of equalize that were used, e.g. target_speaker and db_thresh
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    np.save(path / "level.npy", np.asarray(level_recordings, dtype=np.float32))
+    np.save(path / "frequency.npy", np.asarray(frequency_recordings, dtype=np.float32))
+    speakers[["index_number", "azi", "ele"]].to_csv(path / "speakers.csv", index=False)
+    meta = {"samplerate": samplerate, "created": datetime.datetime.now().isoformat(), "parameters": parameters}
+    with open(path / "meta.json", "w") as f:
+        json.dump(meta, f, indent=2, default=float)
+
+
+def load_recordings(path):
+    """
+    Load recordings stored with save_recordings. The recordings are memory-mapped, not read into memory.
+
+    Returns:
+        numpy.memmap: recordings of the raw signal with shape (speakers, samples)
+        numpy.memmap: recordings of the level equalized signal
+        pandas DataFrame: index number, azimuth and elevation of the recorded speakers
+        dict: samplerate ("samplerate") and equalization parameters ("parameters") of the calibration
+    """
+    path = Path(path)
+    with open(path / "meta.json") as f:
+        meta = json.load(f)
+    return (np.load(path / "level.npy", mmap_mode="r"), np.load(path / "frequency.npy", mmap_mode="r"),
+            pd.read_csv(path / "speakers.csv"), meta)
+
+
+def equalize_recordings(path, **parameters):
+    """
+    Compute the equalization from stored recordings (see equalize). Parameters that are not given
+    are taken from the calibration run.
+
+    Returns:
+        dict: the calibration of each speaker
+        pandas DataFrame: diagnostics for each speaker
+    """
+    level_recordings, frequency_recordings, speakers, meta = load_recordings(path)
+    parameters = {**meta["parameters"], **parameters}
+    return equalize(level_recordings, frequency_recordings, speakers, samplerate=meta["samplerate"], **parameters)
+
+
+def sweep(path, grid, n_jobs=None):
+    """
+    Compute the equalization from stored recordings for every combination of parameters in grid and score
+    each one by the spectral range (see spectral_range) across speakers of the level equalized
+    recordings after applying the equalizing filters. The grid points are computed in a process pool.
+
+    Args:
+        path (str | pathlib.Path): folder with recordings stored by save_recordings
+        grid (dict): parameters of equalize with lists of values,
+            e.g. {"bandwidth": [1/5, 1/10], "alpha": [0.5, 1.0]}
+        n_jobs (None | int): number of worker processes, if None use one per CPU, if 1 don't use a process pool
+    Returns:
+        pandas DataFrame: one row per grid point with the parameters and the maximum and mean
+            spectral range in dB, sorted by the maximum spectral range
+    """
+    names = list(grid.keys())
+    points = [dict(zip(names, values)) for values in itertools.product(*grid.values())]
+    if n_jobs == 1:
+        scores = [_score_parameters(path, point) for point in points]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs or os.cpu_count()) as pool:
+            scores = list(pool.map(_score_parameters, [path] * len(points), points))
+    results = pd.DataFrame([{**point, **score} for point, score in zip(points, scores)])
+    return results.sort_values("max_range", ignore_index=True)
+
+
+def _score_parameters(path, parameters):
+    """equalize the stored recordings with the parameters and compute the remaining spectral range"""
+    level_recordings, frequency_recordings, speakers, meta = load_recordings(path)
+    parameters = {**meta["parameters"], **parameters}
+    samplerate = meta["samplerate"]
+    index_numbers = np.asarray(speakers.index_number)
+    target = int(np.flatnonzero(index_numbers == parameters["target_speaker"])[0])
+    _, _, valid = level_equalization(level_recordings, target, parameters["db_thresh"], samplerate)
+    filter_bank, _ = frequency_equalization(frequency_recordings, target, parameters["db_thresh"], samplerate,
+                                            parameters["bandwidth"], parameters["low_cutoff"],
+                                            parameters["high_cutoff"], parameters["alpha"])
+    if not valid.any():  # all speakers are below the threshold, so nothing was equalized
+        return {"max_range": np.nan, "mean_range": np.nan}
+    equalized = filter_bank.apply(slab.Sound(np.asarray(frequency_recordings, dtype=float).T, samplerate=samplerate))
+    equalized = slab.Sound(equalized.data[:, valid], samplerate=samplerate)
+    difference = spectral_range(equalized, low_cutoff=parameters["low_cutoff"], high_cutoff=parameters["high_cutoff"],
+                                plot=False)
+    return {"max_range": float(np.max(difference)), "mean_range": float(np.mean(difference))}
+
+
+def spectral_range(signal, bandwidth=1 / 5, low_cutoff=50, high_cutoff=20000, thresh=3,
+                   plot=True, log=True):
+    """
+    Compute the range of differences in power spectrum for all channels in
+    the signal. The signal is devided into bands of equivalent rectangular
+    bandwidth (ERB - see More&Glasberg 1982) and the level is computed for
+    each frequency band and each channel in the recording. To show the range
+    of spectral difference across channels the minimum and maximum levels
+    across channels are computed. Can be used for example to check the
+    effect of loud speaker equalization.
+    """
+    # TODO: this really should be part of the slab.Sound file
+    # generate ERB-spaced filterbank:
+    fbank = slab.Filter.cos_filterbank(length=1000, bandwidth=bandwidth,
+                                       low_cutoff=low_cutoff, high_cutoff=high_cutoff,
+                                       samplerate=signal.samplerate)
+    center_freqs, _, _ = slab.Filter._center_freqs(low_cutoff, high_cutoff, bandwidth)
+    center_freqs = slab.Filter._erb2freq(center_freqs)
+    # create arrays to write data into:
+    levels = np.zeros((signal.nchannels, fbank.nchannels))
+    max_level, min_level = np.zeros(fbank.nchannels), np.zeros(fbank.nchannels)
+    for i in range(signal.nchannels):  # compute ERB levels for each channel
+        levels[i] = fbank.apply(signal.channel(i)).level
+    for i in range(fbank.nchannels):  # find max and min for each frequency
+        max_level[i] = max(levels[:, i])
+        min_level[i] = min(levels[:, i])
+    difference = max_level - min_level
+    if plot is True or isinstance(plot, Axes):
+        if isinstance(plot, Axes):
+            ax = plot
+        else:
+            fig, ax = plt.subplots(1)
+        # frequencies where the difference exceeds the threshold
+        bads = np.where(difference > thresh)[0]
+        for y in [max_level, min_level]:
+            if log is True:
+                ax.semilogx(center_freqs, y, color="black", linestyle="--")
+            else:
+                ax.plot(center_freqs, y, color="black", linestyle="--")
+        for bad in bads:
+            ax.fill_between(center_freqs[bad - 1:bad + 1], max_level[bad - 1:bad + 1],
+                            min_level[bad - 1:bad + 1], color="red", alpha=.6)
+    return difference
+
+
+def minimum_phase(fir, n_fft=None):
+    """
+    Convert a FIR filter to minimum phase with the same magnitude response using the real cepstrum.
+    The energy of a minimum phase filter is concentrated at its beginning, so it can be truncated
+    much more than a linear phase filter and has a shorter delay.
+
+    Args:
+        fir (numpy.ndarray): filter coefficients, filters are in the columns if the array is two dimensional
+        n_fft (None | int): length of the FFT, longer FFTs reduce the aliasing of the cepstrum.
+            If None, use eight times the length of the filter
+    Returns:
+        numpy.ndarray: minimum phase filter with the same shape as fir
+    """
+    fir = np.asarray(fir, dtype=float)
+    n_taps = fir.shape[0]
+    if n_fft is None:
+        n_fft = 2**int(np.ceil(np.log2(8 * n_taps)))
+    magnitude = np.abs(np.fft.fft(fir, n_fft, axis=0))
+    cepstrum = np.fft.ifft(np.log(np.maximum(magnitude, 1e-10)), axis=0).real
+    fold = np.zeros(n_fft)  # keep the causal part of the cepstrum, doubled
+    fold[0], fold[1:n_fft // 2], fold[n_fft // 2] = 1, 2, 1
+    fold = fold.reshape((-1,) + (1,) * (fir.ndim - 1))
+    return np.fft.ifft(np.exp(np.fft.fft(cepstrum * fold, axis=0)), axis=0).real[:n_taps]
+
+
+def speaker_filter(speaker_calibration):
+    """The filter that is applied for a speaker: the compact filter if there is one (see compact_filter), otherwise
+    the original equalizing filter. speaker_calibration is the speaker's entry in the calibration."""
+    return speaker_calibration.get("compact_filter", speaker_calibration["filter"])
+
+
+def compact_filter(filt, tolerance=1.0, low_cutoff=200, high_cutoff=16000, step=8):
+    """
+    Convert a single channel FIR filter to minimum phase and truncate it to the shortest length for which
+    the magnitude response between low_cutoff and high_cutoff deviates at most tolerance dB from the original.
+    The truncated filter is faded out with the second half of a hanning window. All lengths are tested at once.
+
+    Args:
+        filt (slab.Filter): the filter
+        tolerance (float): maximum absolute deviation of the magnitude response in dB
+        low_cutoff, high_cutoff (float): frequency band in which the deviation is computed
+        step (int): the tested lengths are multiples of step
+    Returns:
+        slab.Filter: the compact filter
+        float: its maximum deviation from the original in dB
+    """
+    original = np.asarray(filt.data, dtype=float)[:, 0]
+    n_taps = len(original)
+    minimum = minimum_phase(original)
+    lengths = np.arange(step, n_taps + step, step).clip(max=n_taps)
+    candidates = np.zeros((len(lengths), n_taps))
+    for i, length in enumerate(lengths):
+        n_fade = length // 4
+        candidates[i, :length] = minimum[:length]
+        candidates[i, length - n_fade:length] *= np.hanning(2 * n_fade)[n_fade:]
+    n_fft = 2**int(np.ceil(np.log2(4 * n_taps)))
+    frequencies = np.fft.rfftfreq(n_fft, 1 / filt.samplerate)
+    band = (frequencies >= low_cutoff) & (frequencies <= high_cutoff)
+    reference = 20 * np.log10(np.maximum(np.abs(np.fft.rfft(original, n_fft)[band]), 1e-10))
+    responses = 20 * np.log10(np.maximum(np.abs(np.fft.rfft(candidates, n_fft, axis=1)[:, band]), 1e-10))
+    errors = np.abs(responses - reference).max(axis=1)
+    passing = np.flatnonzero(errors <= tolerance)
+    best = passing[0] if len(passing) else len(lengths) - 1  # the full length minimum phase filter
+    compact = slab.Filter(candidates[best, :lengths[best]], samplerate=filt.samplerate, fir=True)
+    return compact, float(errors[best])
+
+
+def dsp_coefficients(filt, n_taps):
+    """
+    Compute coefficients for filtering on the processors that have the same magnitude response as applying
+    the filter with slab. slab filters forward and backward (the magnitude response is squared and the phase
+    cancels), the processors filter only once. The coefficients are therefore the minimum phase version of the
+    filter convolved with its time reversal, truncated to n_taps and faded out.
+
+    Args:
+        filt (slab.Filter): single channel FIR filter
+        n_taps (int): number of coefficients
+    Returns:
+        numpy.ndarray: the coefficients
+    """
+    fir = np.asarray(filt.data, dtype=float)[:, 0]
+    coefficients = minimum_phase(np.convolve(fir, fir[::-1]))[:n_taps]
+    coefficients = np.pad(coefficients, (0, n_taps - len(coefficients)))
+    n_fade = n_taps // 8
+    coefficients[n_taps - n_fade:] *= np.hanning(2 * n_fade)[n_fade:]
+    return coefficients
+
+
+def dsp_deviation(filt, coefficients, low_cutoff=200, high_cutoff=16000):
+    """Largest difference (in dB) between the magnitude responses of applying filt with slab and filtering
+    once with the coefficients, between low_cutoff and high_cutoff."""
+    fir = np.asarray(filt.data, dtype=float)[:, 0]
+    n_fft = 2**int(np.ceil(np.log2(4 * max(len(fir), len(coefficients)))))
+    frequencies = np.fft.rfftfreq(n_fft, 1 / filt.samplerate)
+    band = (frequencies >= low_cutoff) & (frequencies <= high_cutoff)
+    two_way = 40 * np.log10(np.maximum(np.abs(np.fft.rfft(fir, n_fft)[band]), 1e-10))
+    one_way = 20 * np.log10(np.maximum(np.abs(np.fft.rfft(coefficients, n_fft)[band]), 1e-10))
+    return float(np.abs(two_way - one_way).max())
@@ -47,6 +47,21 @@ class PoseEstimator:
         self.marks = None
 
     def pose_from_image(self, image):
+        """Estimate the head pose in image and return azimuth and elevation."""
+        azi, ele, _, _ = self.estimate_pose(image)
+        return azi, ele
+
+    def estimate_pose(self, image, detection_scale=1.0):
+        """
+        Estimate the head pose in image and return azimuth and elevation together
+        with the confidence of the face detection and the reprojection error (i.e.
+        the root mean square distance in pixels between the detected landmarks and
+        the model points projected with the estimated pose). If no face or more
+        than one face is detected, all returned values are None.
+        If detection_scale is smaller than 1, the face detection runs on a
+        downsampled copy of the image and the facebox is mapped back, so the
+        landmarks are still detected in the full resolution image.
+        """
         size = image.shape
         focal_length = size[1]
         center = (size[1]/2, size[0]/2)
@@ -54,13 +69,16 @@ class PoseEstimator:
                                  [0, focal_length, center[1]],
                                  [0, 0, 1]], dtype="double")
 
-        faceboxes = self.extract_cnn_facebox(image)
+        if detection_scale < 1.0:
+            faceboxes, confidences = self.extract_scaled_facebox(image, detection_scale)
+        else:
+            faceboxes, confidences = self.extract_cnn_facebox(image, return_confidence=True)
         if len(faceboxes) > 1:
             logging.warning("There is more than one face in the image!")
-            return None, None
+            return None, None, None, None
         elif len(faceboxes) == 0:
             logging.warning("No face detected!")
-            return None, None
+            return None, None, None, None
         else:
             facebox = faceboxes[0]
             face_img = image[facebox[1]: facebox[3], facebox[0]: facebox[2]]
@@ -79,13 +97,16 @@ class PoseEstimator:
             (success, rotation_vec, translation_vec) = \
                 cv2.solvePnP(MODELPOINTS, image_pts, camera_matrix,
                              dist_coeffs)
+            projected_pts, _ = cv2.projectPoints(MODELPOINTS, rotation_vec, translation_vec,
+                                                 camera_matrix, dist_coeffs)
+            error = np.sqrt(((projected_pts.reshape(-1, 2) - image_pts)**2).sum(axis=1).mean())
 
             rotation_mat, _ = cv2.Rodrigues(rotation_vec)
             pose_mat = cv2.hconcat((rotation_mat, translation_vec))
             _, _, _, _, _, _, angles = cv2.decomposeProjectionMatrix(pose_mat)
             angles[0, 0] = angles[0, 0] * -1
 
-            return angles[1, 0], angles[0, 0]  # azimuth, elevation
+            return angles[1, 0], angles[0, 0], float(confidences[0]), float(error)
 
     def get_faceboxes(self, image):
         """
@@ -169,11 +190,12 @@ class PoseEstimator:
         c = image.shape[1]  # columns
         return box[0] >= 0 and box[1] >= 0 and box[2] <= c and box[3] <= r
 
-    def extract_cnn_facebox(self, image):
-        """Extract face area from image."""
-        _, raw_boxes = self.get_faceboxes(image=image)
-        a = []
-        for box in raw_boxes:
+    def extract_cnn_facebox(self, image, return_confidence=False):
+        """Extract face area from image. If return_confidence is True, also
+        return the detection confidence for each of the extracted boxes."""
+        raw_confidences, raw_boxes = self.get_faceboxes(image=image)
+        a, confidences = [], []
+        for box, confidence in zip(raw_boxes, raw_confidences):
             # Move box down.
             # diff_height_width = (box[3] - box[1]) - (box[2] - box[0])
             offset_y = int(abs((box[3] - box[1]) * 0.1))
@@ -184,9 +206,27 @@ class PoseEstimator:
 
             if self.box_in_image(facebox, image):
                 a.append(facebox)
+                confidences.append(confidence)
 
+        if return_confidence:
+            return a, confidences
         return a
 
+    def extract_scaled_facebox(self, image, scale):
+        """Detect faces in a downsampled copy of image and return the faceboxes
+        in the coordinates of the original image together with the confidences."""
+        small = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        small_boxes, small_confidences = self.extract_cnn_facebox(small, return_confidence=True)
+        faceboxes, confidences = [], []
+        for box, confidence in zip(small_boxes, small_confidences):
+            left_x, top_y = int(box[0] / scale), int(box[1] / scale)
+            width = int(round((box[2] - box[0]) / scale))  # keep the box square
+            facebox = [left_x, top_y, left_x + width, top_y + width]
+            if self.box_in_image(facebox, image):
+                faceboxes.append(facebox)
+                confidences.append(confidence)
+        return faceboxes, confidences
+
     def detect_marks(self, image_np):
         """Detect marks from image"""
 
@@ -5,10 +5,12 @@ import numpy as np
 import slab
 import pickle
 from matplotlib import pyplot as plt
-from matplotlib.axes import Axes
 import pandas as pd
 import datetime
-from freefield import DIR, Processors, camera
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from freefield import DIR, Processors, camera, sessions, equalization, spatial, selftest
+from freefield.equalization import spectral_range
 import logging
 logging.basicConfig(level=logging.INFO)
 slab.Signal.set_default_samplerate(48828)  # default samplerate for generating sounds, filters etc.
@@ -20,7 +22,8 @@ EQUALIZATIONDICT = {}  # calibration to equalize levels
 TABLE = pd.DataFrame()  # numbers and coordinates of all loudspeakers
 
 
-def initialize_setup(setup, default_mode=None, proc_list=None, zbus=True, connection="GB", camera_type=None, face_detection_tresh=.9):
+def initialize_setup(setup, default_mode=None, proc_list=None, zbus=True, connection="GB", camera_type=None,
+                     face_detection_tresh=.9, camera_kwargs=None):
     """
     Initialize the processors and load table and calibration for setup.
 
@@ -36,7 +39,8 @@ def initialize_setup(setup, default_mode=None, proc_list=None, zbus=True, connec
         proc_list: if not using a default, specify the processors in a list, see processors.initialize_processors
         zbus: whether or not to initialize the zbus interface
         connection: type of connection to processors, can be "GB" (optical) or "USB"
-        camera_type: kind of camera that is initialized. Can be "webcam", "flir" or None
+        camera_type: kind of camera that is initialized. Can be "webcam", "flir", "replay" or None
+        camera_kwargs (None | dict): additional arguments for the cameras, e.g. the path of the recording to replay
     """
 
     # TODO: put level and frequency equalization in one common file
@@ -49,7 +53,9 @@ def initialize_setup(setup, default_mode=None, proc_list=None, zbus=True, connec
     elif default_mode is not None:
         PROCESSORS.initialize_default(default_mode)
     if camera_type is not None:
-        CAMERAS = camera.initialize_cameras(camera_type, face_detection_tresh=face_detection_tresh)
+        if camera_kwargs is None:
+            camera_kwargs = {}
+        CAMERAS = camera.initialize_cameras(camera_type, face_detection_tresh=face_detection_tresh, **camera_kwargs)
     # get the correct speaker table and calibration files for the setup
     if setup == 'arc':
         EQUALIZATIONFILE = DIR / 'data' / Path('calibration_arc.pkl')
@@ -192,9 +198,55 @@ def get_speaker_list(speaker_list):
     return speakers
 
 
+def get_virtual_speakers(coordinates):
+    """
+    Find the speakers and gains for playing virtual sources between the speakers with vector
+    base amplitude panning (see the spatial module). The triangulation of the speaker table is
+    computed at the first call and then reused.
+
+    Args:
+        coordinates (array-like): azimuth and elevation of one source or array with shape (n_sources, 2)
+    Returns:
+        numpy.ndarray: index numbers of the speakers with shape (n_sources, 3), -1 for unused speakers
+        numpy.ndarray: gain of each speaker with shape (n_sources, 3)
+    """
+    coordinates = np.atleast_2d(np.asarray(coordinates, dtype=float))
+    return spatial.triangulate(TABLE).query(coordinates[:, 0], coordinates[:, 1])
+
+
+def virtual_source(signal, coordinates, calibrate=True, interpolate=False):
+    """
+    Compute the signals for up to three speakers that play a virtual source at the given coordinates.
+
+    Args:
+        signal (slab.Sound): the sound of the virtual source
+        coordinates (tuple): azimuth and elevation of the source
+        calibrate (bool): if True, apply the equalization
+        interpolate (bool): if True, apply the equalization interpolated between the speakers (see
+            spatial.interpolate_equalization) to all speakers, otherwise apply each speaker's own equalization.
+    Returns:
+        dict: the signal of each speaker, with the index numbers as keys
+    """
+    signal = slab.Sound(signal)
+    speakers, gains = get_virtual_speakers(coordinates)
+    speakers, gains = speakers[0][gains[0] > 0], gains[0][gains[0] > 0]
+    if calibrate and interpolate and bool(EQUALIZATIONDICT):
+        interpolated = spatial.interpolate_equalization(EQUALIZATIONDICT, speakers, gains)
+        signal = deepcopy(signal)
+        signal.level *= interpolated["level"]
+        signal = interpolated["filter"].apply(signal)
+    signals = {}
+    for index_number, gain in zip(speakers, gains):
+        speaker_signal = slab.Sound(signal.data * gain, samplerate=signal.samplerate)
+        if calibrate and not interpolate:
+            speaker_signal = apply_equalization(speaker_signal, int(index_number))
+        signals[int(index_number)] = speaker_signal
+    return signals
+
+
 def all_leds():
-    # Temporary hack: return all speakers from the table which have a LED attached
-    return TABLE.dropna()
+    """Return all speakers from the table which have a LED attached."""
+    return TABLE[TABLE.bit.notna() & TABLE.digital_proc.notna()]
 
 
 def shift_setup(delta_azi, delta_ele):
@@ -240,13 +292,61 @@ def set_signal_and_speaker(signal, speaker, calibrate=True):
         to_play = apply_equalization(signal, speaker)
     else:
         to_play = signal
-    PROCESSORS.write(tag='chan', value=speaker.channel, procs=speaker.analog_proc)
-    PROCESSORS.write(tag='data', value=to_play.data, procs=speaker.analog_proc)
+    write_signal(to_play.data, speaker)
+
+
+def write_signal(data, speaker):
+    """
+    Write data into the buffer of the processor the speaker is attached to and set the
+    output channel. Unlike set_signal_and_speaker, no equalization is applied.
+
+        Args:
+            data (numpy.ndarray): signal to load to the buffer, must be one-dimensional
+            speaker (pandas Series | pandas DataFrame): row from the speaker table
+    """
+    if isinstance(speaker, pd.DataFrame):
+        speaker = speaker.iloc[0]
+    PROCESSORS.write(tag='chan', value=int(speaker.channel), procs=speaker.analog_proc)
+    PROCESSORS.write(tag='data', value=data, procs=speaker.analog_proc)
     other_procs = list(TABLE["analog_proc"].unique())
     other_procs.remove(speaker.analog_proc)  # set the analog output of other procs to non existent number 99
     PROCESSORS.write(tag='chan', value=99, procs=other_procs)
 
 
+def compile_trial_plan(seq, duration, calibrate=True, n_workers=None):
+    """
+    Generate the stimuli for all trials of a localization test before the test starts. For every
+    trial in the sequence a pink noise is generated and equalized for the target speaker. This is
+    done in a thread pool (the filtering is done by numpy which releases the GIL) and the results
+    are stored as rows of one contiguous float32 array, so during the test only the buffer has to
+    be written.
+
+    Args:
+        seq (slab.Trialsequence): sequence whose conditions are rows from the speaker table
+        duration (float): duration of the stimuli in seconds
+        calibrate (bool): if True (=default) apply loudspeaker equalization
+        n_workers (None | int): number of threads, if None use the default of ThreadPoolExecutor
+    Returns:
+        numpy.ndarray: stimuli with shape (n_trials, n_samples), row i is the stimulus of the i-th trial
+        list of pandas Series: the target speaker of each trial
+    """
+    speakers = [seq.conditions[trial - 1] for trial in seq.trials]
+    n_samples = int(slab.signal._default_samplerate*duration)
+    stimuli = np.zeros((len(speakers), n_samples), dtype=np.float32)
+
+    def render(i):
+        sound = slab.Sound.pinknoise(duration=duration)
+        if calibrate:
+            sound = apply_equalization(sound, int(speakers[i].index_number))
+        data = sound.data[:n_samples, 0]
+        stimuli[i, :len(data)] = data
+
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        list(pool.map(render, range(len(speakers))))
+    logging.info(f"Compiled stimuli for {len(speakers)} trials ({stimuli.nbytes / 1e6:.1f} MB).")
+    return stimuli, speakers
+
+
 def apply_equalization(signal, speaker, level=True, frequency=True):
     """
     Apply level correction and frequency equalization to a signal
@@ -268,15 +368,102 @@ def apply_equalization(signal, speaker, level=True, frequency=True):
             speaker = get_speaker(coordinates=speaker)
         elif not isinstance(speaker, (pd.Series, pd.DataFrame)):
             raise ValueError("Argument speaker must be a index number, coordinates or table row of a speaker!")
-        speaker_calibration = EQUALIZATIONDICT[str(speaker.index_number.iloc[0])]
+        speaker_calibration = EQUALIZATIONDICT.get(str(speaker.index_number.iloc[0]), {})
+        if "filter" not in speaker_calibration:  # e.g. only the recording delay was measured
+            logging.warning(f"Speaker {speaker.index_number.iloc[0]} is not equalized! Returning the signal unchanged...")
+            return signal
         calibrated_signal = deepcopy(signal)
         if level:
             calibrated_signal.level *= speaker_calibration["level"]
-        if frequency:
-            calibrated_signal = speaker_calibration["filter"].apply(calibrated_signal)
+        if frequency:  # use the compact filter if there is one, see compact_equalization
+            calibrated_signal = equalization.speaker_filter(speaker_calibration).apply(calibrated_signal)
         return calibrated_signal
 
 
+def dsp_equalization_tables(n_taps=256):
+    """
+    Export the equalization filters of all speakers as one table of FIR coefficients for each processor,
+    for circuits that apply the frequency equalization on the processors instead of the host. Row n of
+    each processor's table is the filter for channel n, row 0 is a unit impulse for playing unfiltered
+    sounds. The filters are converted so that filtering once has the same magnitude response as slab's
+    forward-backward filtering (see equalization.dsp_coefficients). The toolbox does not ship circuits
+    with an equalization filter, use emulate_dsp_equalization to check the tables.
+
+    Args:
+        n_taps (int): number of coefficients of each filter. Filters with more taps raise a ValueError,
+            shorten them with compact_equalization first
+    Returns:
+        dict: the table of each processor with shape (n_channels + 1, n_taps), with the processor names as keys
+        pandas DataFrame: largest deviation (in dB) from host side filtering for each speaker
+    """
+    report, tables = [], {}
+    for proc in TABLE.analog_proc.unique():
+        speakers = TABLE[TABLE.analog_proc == proc]
+        table = np.zeros((int(speakers.channel.max()) + 1, n_taps))
+        table[:, 0] = 1  # channels without calibration are played unfiltered
+        for speaker in speakers.itertuples():
+            speaker_calibration = EQUALIZATIONDICT.get(str(speaker.index_number), {})
+            if "filter" not in speaker_calibration:
+                continue
+            filt = equalization.speaker_filter(speaker_calibration)
+            if len(filt.data) > n_taps:
+                raise ValueError(f"The filter of speaker {speaker.index_number} has {len(filt.data)} taps but the "
+                                 f"processors only use {n_taps}! Use compact_equalization or increase n_taps.")
+            table[speaker.channel] = equalization.dsp_coefficients(filt, n_taps)
+            report.append([speaker.index_number, proc, speaker.channel,
+                           equalization.dsp_deviation(filt, table[speaker.channel])])
+        tables[proc] = table
+    report = pd.DataFrame(report, columns=["index_number", "analog_proc", "channel", "deviation"])
+    if len(report):
+        logging.info(f"exported equalization filters, largest deviation from host filtering: "
+                     f"{report.deviation.max():.2f} dB")
+    else:
+        logging.warning("Setup not calibrated, the tables only contain unit impulses...")
+    return tables, report
+
+
+def emulate_dsp_equalization(tables, signal=None, speakers="all"):
+    """
+    Check coefficient tables by emulating a filter on the processors with numpy and comparing the result
+    with equalization on the host. The signal is convolved with the coefficients of each speaker's channel
+    and filtered with apply_equalization. Nothing is played or recorded. Filtering with the coefficients
+    is causal, so the output is delayed - the returned deviation is the largest difference of the spectra
+    (in dB, smoothed in 1/3 octave bands between 200 and 16000 Hz) of both versions.
+
+    Args:
+        tables (dict): coefficient table of each processor, see dsp_equalization_tables
+        signal (None | slab.Sound): signal used for the comparison, if None use white noise
+        speakers: "all" or a list of index numbers or coordinates
+    Returns:
+        pandas DataFrame: deviation for each speaker
+    """
+    if signal is None:
+        signal = slab.Sound.whitenoise(duration=1.0)
+    if speakers == "all":
+        speaker_list = TABLE
+    else:
+        speaker_list = get_speaker_list(speakers)
+    edges = 200 * 2**(np.arange(0, np.log2(16000 / 200) + 1/3, 1/3))
+    frequencies = np.fft.rfftfreq(signal.nsamples, 1 / signal.samplerate)
+    bands = np.digitize(frequencies, edges)
+
+    def band_levels(data):
+        power = np.abs(np.fft.rfft(data))**2
+        return 10 * np.log10([power[bands == b].mean() for b in range(1, len(edges))])
+
+    report = []
+    for speaker in speaker_list.itertuples():
+        if speaker.analog_proc not in tables:
+            raise ValueError(f"There is no table for processor {speaker.analog_proc}, see dsp_equalization_tables!")
+        coefficients = tables[speaker.analog_proc][speaker.channel]
+        level_equalized = apply_equalization(signal, int(speaker.index_number), frequency=False)
+        on_processor = np.convolve(level_equalized.data[:, 0], coefficients)[:signal.nsamples]
+        on_host = apply_equalization(signal, int(speaker.index_number)).data[:, 0]
+        deviation = np.abs(band_levels(on_processor) - band_levels(on_host)).max()
+        report.append([speaker.index_number, deviation])
+    return pd.DataFrame(report, columns=["index_number", "deviation"])
+
+
 def get_recording_delay(distance=1.6, sample_rate=48828, play_from=None, rec_from=None):
     """
         Calculate the delay it takes for played sound to be recorded. Depends
@@ -314,10 +501,79 @@ def get_recording_delay(distance=1.6, sample_rate=48828, play_from=None, rec_fro
     return n_sound_traveling + n_da + n_ad
 
 
-def get_headpose(convert=True, average=True, n=1):
+def measure_recording_delay(speakers="all", sig=None, max_delay=None, save=True):
+    """
+    Measure the delay between playing a sound from each speaker and recording it. The signal is
+    played from each speaker, recorded with a buffer that is max_delay samples longer than the
+    signal and the delay is the lag where the cross-correlation of signal and recording is largest.
+    The delays are stored in the calibration of each speaker and are then used by play_and_record
+    instead of the estimate from get_recording_delay.
+
+    Args:
+        speakers: "all" or a list of index numbers or coordinates of the speakers to measure
+        sig (None | slab.Sound): signal used for the measurement, if None use a chirp
+        max_delay (None | int): longest delay (in samples) that can be measured, if None
+            use four times the estimate from get_recording_delay
+        save (bool): if True, write the updated calibration to the equalization file
+    Returns:
+        pandas Series: delay in samples with the speakers' index numbers as index
+    """
+    global EQUALIZATIONDICT
+    if PROCESSORS.mode not in ["play_rec", "play_birec"]:
+        raise ValueError("Setup must be initialized in mode 'play_rec' or 'play_birec'!")
+    if sig is None:
+        sig = slab.Sound.chirp(duration=0.05, from_frequency=200, to_frequency=16000)
+    if max_delay is None:
+        max_delay = 4 * get_recording_delay(play_from="RX8", rec_from="RP2")
+    if speakers == "all":
+        speaker_list = TABLE
+    elif isinstance(speakers, list):
+        speaker_list = get_speaker_list(speakers)
+    else:
+        raise ValueError("Argument speakers must be a list of interers or 'all'!")
+    recordings = np.zeros((len(speaker_list), sig.nsamples + max_delay))
+    for i, index_number in enumerate(speaker_list.index_number):
+        recordings[i] = play_and_record(int(index_number), sig, compensate_delay=False, compensate_level=False,
+                                        n_delay=max_delay, crop=False).data[:, 0]
+    delays = pd.Series(estimate_delay(sig.data[:, 0], recordings, max_delay), index=speaker_list.index_number.values)
+    for index_number, delay in delays.items():
+        EQUALIZATIONDICT.setdefault(str(index_number), {})["delay"] = int(delay)
+    logging.info(f"measured recording delays between {delays.min()} and {delays.max()} samples")
+    if save:
+        _save_equalization()
+    return delays
+
+
+def estimate_delay(sig, recordings, max_delay):
+    """
+    Estimate the delay of each recording relative to sig with one FFT cross-correlation.
+
+    Args:
+        sig (numpy.ndarray): one dimensional signal
+        recordings (numpy.ndarray): recordings with shape (n_recordings, n_samples)
+        max_delay (int): largest lag that is considered
+    Returns:
+        numpy.ndarray of int: delay of each recording in samples
+    """
+    recordings = np.atleast_2d(recordings)
+    n_fft = recordings.shape[1] + len(sig)
+    correlation = np.fft.irfft(np.fft.rfft(recordings, n_fft, axis=1) * np.conj(np.fft.rfft(sig, n_fft)), n_fft,
+                               axis=1)
+    return np.argmax(correlation[:, :max_delay + 1], axis=1)
+
+
+def _recording_delay(speaker_nr):
+    """measured delay of the speaker if available, otherwise the estimate with a safety margin"""
+    delay = EQUALIZATIONDICT.get(str(speaker_nr), {}).get("delay")
+    if delay is None:
+        delay = get_recording_delay(play_from="RX8", rec_from="RP2") + 50  # make the delay a bit larger, just to be sure
+    return int(delay)
+
+
+def get_headpose(convert=True, average=True, n=1, tolerance=None):
     """Wrapper for the get headpose method of the camera class"""
     if isinstance(CAMERAS, camera.Cameras):
-        azi, ele = CAMERAS.get_headpose(convert=convert, average=average, n=n)
+        azi, ele = CAMERAS.get_headpose(convert=convert, average=average, n=n, tolerance=tolerance)
         return azi, ele
     else:
         logging.warning("Cameras were not initialized...")
@@ -359,8 +615,7 @@ def play_start_sound(speaker=23):
     """
     Load and play the sound that signals the start and end of an experiment/block
     """
-    start = slab.Sound.read(DIR/"data"/"sounds"/"start.wav")
-    set_signal_and_speaker(signal=start, speaker=speaker)
+    set_signal_and_speaker(signal=_start_sound(), speaker=speaker)
     play_and_wait()
 
 
@@ -368,12 +623,23 @@ def play_warning_sound(duration=.5, speaker=23):
     """
     Load and play the sound that signals a warning (for example if the listener is in the wrong position)
     """
-    warning = slab.Sound.clicktrain(duration=duration)
-    set_signal_and_speaker(signal=warning, speaker=speaker)
+    set_signal_and_speaker(signal=_warning_sound(duration), speaker=speaker)
     play_and_wait()
 
 
-def calibrate_camera(targets, n_reps=1, n_images=5):
+@lru_cache(maxsize=1)
+def _start_sound():
+    """read the start sound from disk only once"""
+    return slab.Sound.read(DIR/"data"/"sounds"/"start.wav")
+
+
+@lru_cache(maxsize=4)
+def _warning_sound(duration):
+    """generate the click train for the warning sound only once for each duration"""
+    return slab.Sound.clicktrain(duration=duration)
+
+
+def calibrate_camera(targets, n_reps=1, n_images=5, tolerance=None):
     """
     Calibrate all cameras by lighting up a series of LEDs and estimate the pose when the head is pointed
     towards the currently lit LED. This results in a list of world and camera coordinates which is used to
@@ -383,6 +649,8 @@ def calibrate_camera(targets, n_reps=1, n_images=5):
         targets (pandas DataFrame): rows from the speaker table. The speakers must have a LED attached
         n_reps(int): number of repetitions for each target
         n_images(int): number of images taken for each head pose estimate
+        tolerance (None | float): if given, take images until the standard error of the pose is below tolerance
+            (in degree) and use n_images as maximum, see Cameras.get_headpose
     Returns:
         pandas DataFrame: camera and world coordinates acquired (calibration is performed automatically)
     """
@@ -397,7 +665,7 @@ def calibrate_camera(targets, n_reps=1, n_images=5):
         logging.info(f"trial nr {seq.this_n}: \n target at elevation of {trial.ele} and azimuth of {trial.azi}")
         PROCESSORS.write(tag="bitmask", value=int(trial.bit), procs=trial.digital_proc)
         wait_for_button()
-        pose = CAMERAS.get_headpose(average=False, convert=False, n=n_images)
+        pose = CAMERAS.get_headpose(average=False, convert=False, n=n_images, tolerance=tolerance)
         pose.insert(0, "n", seq.this_n)
         pose = pose.rename(columns={"azi": "azi_cam", "ele": "ele_cam"})
         pose.insert(2, "ele_world", trial.ele)
@@ -443,7 +711,8 @@ def calibrate_camera_no_visual(targets, n_reps=1, n_images=5):
 
 
 
-def localization_test_freefield(targets, duration=0.5, n_reps=1, n_images=5, visual=False):
+def localization_test_freefield(targets, duration=0.5, n_reps=1, n_images=5, visual=False, tolerance=None,
+                                session=None, timeline=None):
     """
     Run a basic localization test where the same sound is played from different
     speakers in randomized order, without playing the same position twice in
@@ -459,6 +728,12 @@ def localization_test_freefield(targets, duration=0.5, n_reps=1, n_images=5, vis
         n_reps(int): number of repetitions for each target
         n_images(int): number of images taken for each head pose estimate
         visual(bool): If True, light a LED at the target position - the speakers must have a LED attached
+        tolerance (None | float): if given, take images until the standard error of the pose is below tolerance
+            (in degree) and use n_images as maximum, see Cameras.get_headpose
+        session (None | str | sessions.SessionWriter): if given, every trial is written to this session
+            folder while the test is running, see the sessions module
+        timeline (None | timeline.Timeline): if given, time trigger, end of playback and button press with the
+            processors' sample counters. The circuits must latch the counters, see the timeline module
     Returns:
         instance of slab.Trialsequence: the response is stored in the data attribute as tuples with (azimuth, elevation)
     """
@@ -472,20 +747,30 @@ def localization_test_freefield(targets, duration=0.5, n_reps=1, n_images=5, vis
             raise ValueError("All speakers must have a LED attached for a test with visual cues")
     targets = [targets.loc[i] for i in targets.index]  # make list from data frame
     seq = slab.Trialsequence(targets, n_reps, kind="non_repeating")
-    play_start_sound()
-    for trial in seq:
-        wait_for_button()
-        while check_pose(fix=[0, 0]) is None:  # check if head is in position
-            play_warning_sound()
+    stimuli, _ = compile_trial_plan(seq, duration)  # generate and equalize all sounds before starting
+    writer = _open_session(session)
+    try:
+        if timeline is not None:  # fails before the test starts if the circuits have no sample counter
+            timeline.sync(set(TABLE["analog_proc"].unique()) | {"RP2"})
+        play_start_sound()
+        for trial in seq:
             wait_for_button()
-        sound = slab.Sound.pinknoise(duration=duration)
-        set_signal_and_speaker(signal=sound, speaker=trial.index_number)
-        seq = _loctest_trial(trial, seq, visual, n_images)
-    play_start_sound()
+            while check_pose(fix=[0, 0]) is None:  # check if head is in position
+                play_warning_sound()
+                wait_for_button()
+            write_signal(stimuli[seq.this_n], trial)
+            seq = _loctest_trial(trial, seq, visual, n_images, tolerance, writer, timeline, player=trial.analog_proc)
+        play_start_sound()
+    finally:
+        if writer is not None and timeline is not None:
+            timeline.to_dataframe().to_csv(writer.path / "timeline.csv", index=False)
+        if writer is not None and writer is not session:  # close the session only if it was opened here
+            writer.close()
     return seq
 
 
-def localization_test_headphones(targets, signals, n_reps=1, n_images=5, visual=False):
+def localization_test_headphones(targets, signals, n_reps=1, n_images=5, visual=False, tolerance=None,
+                                 session=None, timeline=None):
     """
     Run a basic localization test where previously recorded/generated binaural sound are played via headphones.
     The procedure is the same as in localization_test_freefield().
@@ -499,6 +784,12 @@ def localization_test_headphones(targets, signals, n_reps=1, n_images=5, visual=
         n_reps(int): number of repetitions for each target
         n_images(int): number of images taken for each head pose estimate
         visual(bool): If True, light a LED at the target position - the speakers must have a LED attached
+        tolerance (None | float): if given, take images until the standard error of the pose is below tolerance
+            (in degree) and use n_images as maximum, see Cameras.get_headpose
+        session (None | str | sessions.SessionWriter): if given, every trial is written to this session
+            folder while the test is running, see the sessions module
+        timeline (None | timeline.Timeline): if given, time trigger, end of playback and button press with the
+            processors' sample counters. The circuits must latch the counters, see the timeline module
     Returns:
         instance of slab.Trialsequence: the response is stored in the data attribute as tuples with (azimuth, elevation)
     """
@@ -514,35 +805,82 @@ def localization_test_headphones(targets, signals, n_reps=1, n_images=5, visual=
             raise ValueError("All speakers must have a LED attached for a test with visual cues")
     targets = [targets.loc[i] for i in targets.index]  # make list from data frame
     seq = slab.Trialsequence(targets, n_reps, kind="non_repeating")
-    play_start_sound()
-    for trial in seq:
-        signal = signals[trial.index_number]  # get the signal corresponding to the target
+    trial_signals = []  # pick the signal for every trial before starting
+    for trial in seq.trials:
+        signal = signals[seq.conditions[trial - 1].index_number]  # get the signal corresponding to the target
         if isinstance(signal, slab.Precomputed):  # if signal is precomputed, pick a random one
             signal = signal[np.random.randint(len(signal))]
         try:
             signal = slab.Binaural(signal)
         except IndexError:
             logging.warning("Binaural sounds must have exactly two channels!")
-        wait_for_button()
-        while check_pose(fix=[0, 0]) is None:  # check if head is in position
-            play_warning_sound()
+        trial_signals.append(signal)
+    writer = _open_session(session)
+    try:
+        if timeline is not None:  # fails before the test starts if the circuits have no sample counter
+            timeline.sync({"RP2"})
+        play_start_sound()
+        for trial in seq:
             wait_for_button()
-        # write sound into buffer
-        PROCESSORS.write(tag="playbuflen", value=signal.nsamples, procs="RP2")
-        PROCESSORS.write(tag="data_l", value=signal.left.data.flatten(), procs="RP2")
-        PROCESSORS.write(tag="data_r", value=signal.right.data.flatten(), procs="RP2")
-        seq = _loctest_trial(trial, seq, visual, n_images)
-    play_start_sound()
+            while check_pose(fix=[0, 0]) is None:  # check if head is in position
+                play_warning_sound()
+                wait_for_button()
+            _write_binaural(trial_signals[seq.this_n])
+            seq = _loctest_trial(trial, seq, visual, n_images, tolerance, writer, timeline, player="RP2")
+        play_start_sound()
+    finally:
+        if writer is not None and timeline is not None:
+            timeline.to_dataframe().to_csv(writer.path / "timeline.csv", index=False)
+        if writer is not None and writer is not session:  # close the session only if it was opened here
+            writer.close()
     return seq
 
 
-def _loctest_trial(trial, seq, visual, n_images):
+def _write_binaural(signal):
+    """write a binaural sound into the buffers of the RP2"""
+    PROCESSORS.write(tag="playbuflen", value=signal.nsamples, procs="RP2")
+    PROCESSORS.write(tag="data_l", value=signal.left.data.flatten(), procs="RP2")
+    PROCESSORS.write(tag="data_r", value=signal.right.data.flatten(), procs="RP2")
+
+
+def _open_session(session):
+    """return a SessionWriter for session which can be None, a SessionWriter or the path of a session folder"""
+    if session is None or isinstance(session, sessions.SessionWriter):
+        return session
+    return sessions.SessionWriter(session, setup=PROCESSORS.mode)
+
+
+def _loctest_trial(trial, seq, visual, n_images, tolerance=None, session=None, timeline=None, player=None):
     """do a single trial in a localization test experiment: turn on LED (optional), play and wait for button press,
-     get head pose, turn led of, write response in trial sequence and return the sequence"""
+     get head pose, turn led of, write response in trial sequence (and session, if given) and return the sequence.
+     If a timeline is given, the events are timed with the processors' sample counters (player is the processor
+     that played the stimulus) and onset and response time are the host times (time.monotonic) of trigger and
+     button press, if their counters were valid"""
     if visual is True:  # turn LED on
         PROCESSORS.write(tag="bitmask", value=trial.bit, procs=trial.digital_proc)
+    onset = time.monotonic()
     play_and_wait_for_button()
-    pose = CAMERAS.get_headpose(convert=True, average=True, n=n_images)
+    response_time = time.monotonic()
+    if session is None:
+        pose = CAMERAS.get_headpose(convert=True, average=True, n=n_images, tolerance=tolerance)
+    else:  # get the single estimates as well to store them
+        estimates = CAMERAS.get_headpose(convert=True, average=False, n=n_images, tolerance=tolerance)
+        fused = None
+        if estimates is not None and len(estimates.dropna()):
+            fused = camera.fuse_poses(estimates)
+            fused["n_frames"] = int(estimates.image.max()) + 1
+            pose = (fused.azi, fused.ele)
+        else:
+            pose = (None, None)
+    if timeline is not None:
+        events = timeline.mark_trial(seq.this_n, player=player, frame_times=getattr(CAMERAS, "timestamps", None),
+                                     index_number=trial.index_number)
+        if np.isfinite(events.get("trigger_time", np.nan)):
+            onset = events["trigger_time"]
+        if np.isfinite(events.get("button_time", np.nan)):
+            response_time = events["button_time"]
+    if session is not None:
+        session.add_trial(seq.this_n, trial, pose, onset, response_time, estimates, fused)
     if visual is True:  # turn LED off
         PROCESSORS.write(tag="bitmask", value=0, procs=trial.digital_proc)
     seq.add_response(pose)
@@ -550,12 +888,18 @@ def _loctest_trial(trial, seq, visual, n_images):
 
 
 def equalize_speakers(speakers="all", target_speaker=23, bandwidth=1/10, db_tresh=80,
-                      low_cutoff=200, high_cutoff=16000, alpha=1.0, plot=False, test=True):
+                      low_cutoff=200, high_cutoff=16000, alpha=1.0, plot=False, test=True, save_recordings=True):
     """
     Equalize the loudspeaker array in two steps. First: equalize over all
     level differences by a constant for each speaker. Second: remove spectral
     difference by inverse filtering. For more details on how the
     inverse filters are computed see the documentation of slab.Filter.equalizing_filterbank
+    and of the equalization module, which computes the equalization from the recordings.
+    If save_recordings is True, the raw recordings are stored in the folder data/recordings,
+    so the equalization can be computed again with other parameters using equalize_from_recordings.
+
+    Returns:
+        pandas DataFrame: recorded level, level factor and notch depth of the filter for each speaker
     """
     global EQUALIZATIONDICT
     logging.info('Starting calibration.')
@@ -568,68 +912,115 @@ def equalize_speakers(speakers="all", target_speaker=23, bandwidth=1/10, db_tres
         speaker_list = get_speaker_list(speakers)
     else:
         raise ValueError("Argument speakers must be a list of interers or 'all'!")
-    calibration_lvls = _level_equalization(sig, speaker_list, target_speaker, db_tresh)
-    filter_bank, rec = _frequency_equalization(sig, speaker_list, target_speaker, calibration_lvls,
-                                               bandwidth, low_cutoff, high_cutoff, alpha, db_tresh)
-    # if plot:  # save plot for each speaker
-    #     for i in range(rec.nchannels):
-    #         _plot_equalization(target_speaker, rec.channel(i),
-    #                            fbank.channel(i), i)
-    for i in range(TABLE.shape[0]):  # write level and frequency equalization into one dictionary
-        EQUALIZATIONDICT[str(i)] = {"level": calibration_lvls[i], "filter": filter_bank.channel(i)}
-    if EQUALIZATIONFILE.exists():  # move the old calibration to the log folder
+    level_recordings = _record_speakers(sig, speaker_list)
+    target = _target_row(speaker_list, target_speaker)
+    calibration_lvls, _, _ = equalization.level_equalization(level_recordings, target, db_tresh, sig.samplerate)
+    frequency_recordings = _record_speakers(sig, speaker_list, calibration_lvls)
+    parameters = dict(target_speaker=target_speaker, db_thresh=db_tresh, bandwidth=bandwidth, low_cutoff=low_cutoff,
+                      high_cutoff=high_cutoff, alpha=alpha)
+    if save_recordings:
         date = datetime.datetime.now().strftime("_%Y-%m-%d-%H-%M-%S")
-        rename_previous = DIR / 'data' / Path("log/" + EQUALIZATIONFILE.stem + date + EQUALIZATIONFILE.suffix)
-        EQUALIZATIONFILE.rename(rename_previous)
-    with open(EQUALIZATIONFILE, 'wb') as f:  # save the newly recorded calibration
-        pickle.dump(EQUALIZATIONDICT, f, pickle.HIGHEST_PROTOCOL)
+        path = DIR / 'data' / 'recordings' / (EQUALIZATIONFILE.stem + date)
+        equalization.save_recordings(path, level_recordings, frequency_recordings, speaker_list, sig.samplerate,
+                                     **parameters)
+        logging.info(f'Calibration recordings saved to {path}.')
+    calibration, diagnostics = equalization.equalize(level_recordings, frequency_recordings, speaker_list,
+                                                     samplerate=sig.samplerate, **parameters)
+    _update_equalization(calibration)
+    _save_equalization()
     logging.info('Calibration completed.')
+    return diagnostics
 
 
-def _level_equalization(sig, speaker_list, target_speaker, db_thresh):
+def equalize_from_recordings(path, save=False, **parameters):
     """
-    Record the signal from each speaker in the list and return the level of each
-    speaker relative to the target speaker(target speaker must be in the list)
+    Compute the equalization again from the recordings of a previous calibration, e.g. with a different
+    bandwidth or alpha, without recording anything. Use equalization.sweep to compare many parameters.
+
+    Args:
+        path (str | pathlib.Path): folder in data/recordings written by equalize_speakers
+        save (bool): if True, write the new calibration to the equalization file
+        **parameters: arguments of equalization.equalize that replace the ones of the calibration run
+    Returns:
+        pandas DataFrame: recorded level, level factor and notch depth of the filter for each speaker
     """
-    rec = []
-    for i in range(speaker_list.shape[0]):
-        row = speaker_list.loc[i]
-        rec.append(play_and_record(row.index_number, sig, apply_calibration=False))
-        if row.index_number == target_speaker:
-            target = rec[-1]
-    rec = slab.Sound(rec)
-    rec.data[:, rec.level < db_thresh] = target.data  # thresholding
-    return target.level / rec.level
+    global EQUALIZATIONDICT
+    calibration, diagnostics = equalization.equalize_recordings(path, **parameters)
+    _update_equalization(calibration)
+    if save:
+        _save_equalization()
+    return diagnostics
+
+
+def compact_equalization(tolerance=1.0, low_cutoff=200, high_cutoff=16000, save=True):
+    """
+    Convert the equalizing filter of each speaker to minimum phase and truncate it to the shortest length
+    that keeps the magnitude response within tolerance dB of the original (see equalization.compact_filter).
+    The compact filters are stored in the calibration as "compact_filter" and used by apply_equalization.
+
+    Args:
+        tolerance (float): maximum deviation of the magnitude response in dB
+        low_cutoff, high_cutoff (float): frequency band in which the deviation is computed
+        save (bool): if True, write the calibration to the equalization file
+    Returns:
+        pandas DataFrame: number of taps of the original and the compact filter and the deviation for each speaker
+    """
+    global EQUALIZATIONDICT
+    report = []
+    for key, speaker_calibration in EQUALIZATIONDICT.items():
+        if "filter" not in speaker_calibration:
+            continue
+        compact, error = equalization.compact_filter(speaker_calibration["filter"], tolerance, low_cutoff, high_cutoff)
+        speaker_calibration["compact_filter"] = compact
+        report.append([int(key), len(speaker_calibration["filter"].data), len(compact.data), error])
+    report = pd.DataFrame(report, columns=["index_number", "n_taps", "n_taps_compact", "error"])
+    if len(report):
+        logging.info(f"compacted the filters from {report.n_taps.mean():.0f} to {report.n_taps_compact.mean():.0f} "
+                     f"taps on average, the largest deviation is {report.error.max():.2f} dB")
+    if save:
+        _save_equalization()
+    return report
+
+
+def _update_equalization(calibration):
+    """write new levels and filters into the calibration, keeping other entries like the recording delay"""
+    for key, speaker_calibration in calibration.items():
+        entry = EQUALIZATIONDICT.setdefault(key, {})
+        entry.pop("compact_filter", None)  # computed from the old filter
+        entry.update(speaker_calibration)
+
+
+def _save_equalization():
+    """move the old calibration to the log folder and save the current one"""
+    if EQUALIZATIONFILE.exists():
+        date = datetime.datetime.now().strftime("_%Y-%m-%d-%H-%M-%S")
+        rename_previous = DIR / 'data' / Path("log/" + EQUALIZATIONFILE.stem + date + EQUALIZATIONFILE.suffix)
+        EQUALIZATIONFILE.rename(rename_previous)
+    with open(EQUALIZATIONFILE, 'wb') as f:
+        pickle.dump(EQUALIZATIONDICT, f, pickle.HIGHEST_PROTOCOL)
 
 
-def _frequency_equalization(sig, speaker_list, target_speaker, calibration_lvls, bandwidth,
-                            low_cutoff, high_cutoff, alpha, db_thresh):
+def _record_speakers(sig, speaker_list, level_factors=None):
     """
-    play the level-equalized signal, record and compute and a bank of inverse filter
-    to equalize each speaker relative to the target one. Return filterbank and recordings
+    Record the signal from each speaker in the list and return the recordings as array
+    with shape (speakers, samples). If level_factors are given, the signal's level is
+    multiplied with the speaker's factor before it is played.
     """
-    rec = []
-    for i in range(speaker_list.shape[0]):
-        row = speaker_list.loc[i]
-        modulated_sig = deepcopy(sig)  # copy signal and correct for lvl difference
-        modulated_sig.level *= calibration_lvls[row.index_number]
-        rec.append(play_and_record(row.index_number, modulated_sig, apply_calibration=False))
-        if row.index_number == target_speaker:
-            target = rec[-1]
-    rec = slab.Sound(rec)
-    # set recordings which are below the threshold or which are from exluded speaker
-    # equal to the target so that the resulting frequency filter will be flat
-    rec.data[:, rec.level < db_thresh] = target.data
-
-    filter_bank = slab.Filter.equalizing_filterbank(target=target, signal=rec, low_cutoff=low_cutoff,
-                                                    high_cutoff=high_cutoff, bandwidth=bandwidth, alpha=alpha)
-    # check for notches in the filter:
-    transfer_function = filter_bank.tf(show=False)[1][0:900, :]
-    if (transfer_function < -30).sum() > 0:
-        logging.warning(f"The filter for speaker {row.index_number} at azimuth {row.azi} and elevation {row.ele} /n"
-                        "contains deep notches - adjust the equalization parameters!")
-
-    return filter_bank, rec
+    recordings = np.zeros((len(speaker_list), sig.nsamples))
+    for i, index_number in enumerate(speaker_list.index_number):
+        played = sig
+        if level_factors is not None:  # multiplying the level in dB is a gain of level * (factor - 1) dB
+            played = slab.Sound(sig.data * 10**(sig.level * (level_factors[i] - 1) / 20), samplerate=sig.samplerate)
+        recordings[i] = play_and_record(int(index_number), played, compensate_level=False).data[:, 0]
+    return recordings
+
+
+def _target_row(speaker_list, target_speaker):
+    """position of the target speaker in the list"""
+    rows = np.flatnonzero(np.asarray(speaker_list.index_number) == target_speaker)
+    if len(rows) == 0:
+        raise ValueError("The target speaker must be one of the equalized speakers!")
+    return int(rows[0])
 
 
 def check_equalization(sig, speakers="all", max_diff=5, db_thresh=80):
@@ -662,63 +1053,97 @@ def check_equalization(sig, speakers="all", max_diff=5, db_thresh=80):
     return slab.Sound(rec_raw), slab.Sound(rec_lvl_eq), slab.Sound(rec_freq_eq)
 
 
-def spectral_range(signal, bandwidth=1 / 5, low_cutoff=50, high_cutoff=20000, thresh=3,
-                   plot=True, log=True):
-    """
-    Compute the range of differences in power spectrum for all channels in
-    the signal. The signal is devided into bands of equivalent rectangular
-    bandwidth (ERB - see More&Glasberg 1982) and the level is computed for
-    each frequency band and each channel in the recording. To show the range
-    of spectral difference across channels the minimum and maximum levels
-    across channels are computed. Can be used for example to check the
-    effect of loud speaker equalization.
-    """
-    # TODO: this really should be part of the slab.Sound file
-    # generate ERB-spaced filterbank:
-    fbank = slab.Filter.cos_filterbank(length=1000, bandwidth=bandwidth,
-                                       low_cutoff=low_cutoff, high_cutoff=high_cutoff,
-                                       samplerate=signal.samplerate)
-    center_freqs, _, _ = slab.Filter._center_freqs(low_cutoff, high_cutoff, bandwidth)
-    center_freqs = slab.Filter._erb2freq(center_freqs)
-    # create arrays to write data into:
-    levels = np.zeros((signal.nchannels, fbank.nchannels))
-    max_level, min_level = np.zeros(fbank.nchannels), np.zeros(fbank.nchannels)
-    for i in range(signal.nchannels):  # compute ERB levels for each channel
-        levels[i] = fbank.apply(signal.channel(i)).level
-    for i in range(fbank.nchannels):  # find max and min for each frequency
-        max_level[i] = max(levels[:, i])
-        min_level[i] = min(levels[:, i])
-    difference = max_level - min_level
-    if plot is True or isinstance(plot, Axes):
-        if isinstance(plot, Axes):
-            ax = plot
+def self_test(speakers="all", duration=0.25, level=75, calibrate=True, snr_thresh=20,
+              level_tolerance=6, leds=True, n_images=3, led_thresh=30):
+    """
+    Quickly check that all speakers and LEDs work, e.g. before a session. Every speaker plays a multitone
+    probe which is recorded and its level and signal to noise ratio are measured (see the selftest module).
+    The speakers are recorded one after another. Equalized speakers should all be equally loud, so their levels
+    are compared to the median. Finally, every LED is turned on and detected in the camera images. The processors
+    are left in the mode of the last test.
+
+    Args:
+        speakers (str | list): "all" or a list of index numbers or coordinates of the speakers to test
+        duration (float): duration of the probe in seconds
+        level (float): level of the probe in dB (as computed by slab)
+        calibrate (bool): apply the loudspeaker equalization to the probes
+        snr_thresh (float): minimum signal to noise ratio in dB for a speaker to be detected
+        level_tolerance (float): maximum deviation in dB of an equalized speaker from the median level
+        leds (bool): test the LEDs, requires initialized cameras
+        n_images (int): number of images that are averaged for each LED
+        led_thresh (float): minimum increase of the brightness (in gray values) for a LED to be detected
+    Returns:
+        pandas DataFrame: one row per speaker with the measured level, the deviation from the median level,
+            the signal to noise ratio, the LED's brightness increase and whether the speaker passed the test
+    """
+    if speakers == "all":
+        speaker_list = TABLE
+    elif isinstance(speakers, list):
+        speaker_list = get_speaker_list(speakers)
+    else:
+        raise ValueError("Speakers must be 'all' or a list of indices/coordinates!")
+    speaker_list = speaker_list.reset_index(drop=True)
+    samplerate = slab.signal._default_samplerate
+    n_samples = int(duration * samplerate)
+    if PROCESSORS.mode != "play_rec":
+        PROCESSORS.initialize_default(mode="play_rec")
+    bins = selftest.probe_bins(1, n_samples, samplerate)
+    probe = slab.Sound(selftest.probes(bins, n_samples, samplerate)[0], samplerate=samplerate)
+    probe.level = level
+    recordings = np.zeros((len(speaker_list), n_samples))
+    for row, index_number in enumerate(speaker_list.index_number):
+        recordings[row] = play_and_record(int(index_number), probe, compensate_level=False, calibrate=calibrate).data[:, 0]
+    level_db, snr = selftest.detect(recordings, np.broadcast_to(bins, (len(speaker_list),) + bins.shape))
+    level_db, snr = level_db[:, 0], snr[:, 0]
+    calibrated = [calibrate and "level" in EQUALIZATIONDICT.get(str(int(i)), {}) for i in speaker_list.index_number]
+    report = selftest.report(speaker_list, level_db, snr, calibrated, snr_thresh, level_tolerance)
+    report["led"], report["led_visible"] = np.nan, pd.Series(pd.NA, index=report.index, dtype="boolean")
+    with_led = speaker_list.index[speaker_list.bit.notna() & speaker_list.digital_proc.notna()]
+    if leds and len(with_led):
+        if not isinstance(CAMERAS, camera.Cameras):
+            logging.warning("Cameras are not initialized, skipping the LED test ...")
         else:
-            fig, ax = plt.subplots(1)
-        # frequencies where the difference exceeds the threshold
-        bads = np.where(difference > thresh)[0]
-        for y in [max_level, min_level]:
-            if log is True:
-                ax.semilogx(center_freqs, y, color="black", linestyle="--")
-            else:
-                ax.plot(center_freqs, y, color="black", linestyle="--")
-        for bad in bads:
-            ax.fill_between(center_freqs[bad - 1:bad + 1], max_level[bad - 1:bad + 1],
-                            min_level[bad - 1:bad + 1], color="red", alpha=.6)
-    return difference
-
-
-def play_and_record(speaker_nr, sig, compensate_delay=True, compensate_level=True, calibrate=False):
+            PROCESSORS.initialize_default(mode="cam_calibration")
+            digital_procs = list(speaker_list.digital_proc[with_led].unique())
+            PROCESSORS.write(tag="bitmask", value=0, procs=digital_procs)
+            reference, images = CAMERAS.acquire_images(n_images), []
+            for row in with_led:
+                PROCESSORS.write(tag="bitmask", value=int(speaker_list.bit[row]), procs=speaker_list.digital_proc[row])
+                images.append(CAMERAS.acquire_images(n_images))
+                PROCESSORS.write(tag="bitmask", value=0, procs=speaker_list.digital_proc[row])
+            increase, visible = selftest.led_visible(reference, np.stack(images), led_thresh)
+            report.loc[with_led, "led"], report.loc[with_led, "led_visible"] = increase, visible
+            report["passed"] &= report.led_visible.fillna(True)
+    failed = report.index_number[~report.passed]
+    logging.info(f"self test: {report.passed.sum()} of {len(report)} speakers passed")
+    if len(failed):
+        logging.warning(f"speakers {list(failed)} failed the self test!")
+    return report
+
+
+def play_and_record(speaker_nr, sig, compensate_delay=True, compensate_level=True, calibrate=False, n_delay=None,
+                    crop=True, n_repetitions=1, gap=0.05, average="mean"):
     """
     Play the signal from a speaker and return the recording. Delay compensation
     means making the buffer of the recording processor n samples longer and then
     throwing the first n samples away when returning the recording so sig and
-    rec still have the same legth. For this to work, the circuits rec_buf.rcx
-    and play_buf.rcx have to be initialized on RP2 and RX8s and the mic must
-    be plugged in.
+    rec still have the same legth. If the delay of the speaker was measured with
+    measure_recording_delay, exactly that many samples are added, otherwise the
+    delay is estimated with get_recording_delay. For this to work, the circuits
+    rec_buf.rcx and play_buf.rcx have to be initialized on RP2 and RX8s and the
+    mic must be plugged in.
+    To improve the signal to noise ratio, the signal can be repeated several times
+    with a silent gap in between. The whole train is played and recorded at once,
+    the recording is cut into the single repetitions which are then averaged.
     Parameters:
         speaker_nr: integer between 1 and 48, index number of the speaker
         sig: instance of slab.Sound, signal that is played from the speaker
         compensate_delay: bool, compensate the delay between play and record
+        n_delay: None or int, number of samples the recording buffer is made longer, overrides compensate_delay
+        crop: bool, if False keep the first n_delay samples of the recording
+        n_repetitions: int, number of times the signal is played
+        gap: float, silence between the repetitions in seconds
+        average: str, average the repetitions with the "mean" or the "median" (robust to outliers)
     Returns:
         rec: 1-D array, recorded signal
     """
@@ -728,23 +1153,34 @@ def play_and_record(speaker_nr, sig, compensate_delay=True, compensate_level=Tru
         binaural = False  # record single channel
     else:
         raise ValueError("Setup must be initialized in mode 'play_rec' or 'play_birec'!")
-    PROCESSORS.write(tag="playbuflen", value=sig.nsamples, procs=["RX81", "RX82"])
-    if compensate_delay:
-        n_delay = get_recording_delay(play_from="RX8", rec_from="RP2")
-        n_delay += 50  # make the delay a bit larger, just to be sure
+    if average not in ["mean", "median"]:
+        raise ValueError("Argument average must be 'mean' or 'median'!")
+    if n_repetitions > 1 and not crop:
+        raise ValueError("The repetitions can only be averaged if the recording is cropped!")
+    if n_delay is None:
+        n_delay = _recording_delay(speaker_nr) if compensate_delay else 0
+    n_skip = n_delay if crop else 0
+    if n_repetitions > 1:  # play all repetitions from one buffer
+        period = sig.nsamples + int(gap * sig.samplerate)
+        train = np.zeros((n_repetitions, period))
+        train[:, :sig.nsamples] = sig.data[:, 0]
+        played = slab.Sound(train.flatten(), samplerate=sig.samplerate)
     else:
-        n_delay = 0
-    PROCESSORS.write(tag="playbuflen", value=sig.nsamples, procs=["RX81", "RX82"])
-    PROCESSORS.write(tag="playbuflen", value=sig.nsamples + n_delay, procs="RP2")
-    set_signal_and_speaker(sig, speaker_nr, calibrate)
+        played = sig
+    PROCESSORS.write(tag="playbuflen", value=played.nsamples, procs=["RX81", "RX82"])
+    PROCESSORS.write(tag="playbuflen", value=played.nsamples + n_delay, procs="RP2")
+    set_signal_and_speaker(played, speaker_nr, calibrate)
     play_and_wait()
     if binaural is False:  # read the data from buffer and skip the first n_delay samples
-        rec = PROCESSORS.read(tag='data', proc='RP2', n_samples=sig.nsamples + n_delay)[n_delay:]
+        rec = PROCESSORS.read(tag='data', proc='RP2', n_samples=played.nsamples + n_delay)[n_skip:]
         rec = slab.Sound(rec)
     else:  # read data for left and right ear from buffer
-        rec_l = PROCESSORS.read(tag='datal', proc='RP2', n_samples=sig.nsamples + n_delay)[n_delay:]
-        rec_r = PROCESSORS.read(tag='datar', proc='RP2', n_samples=sig.nsamples + n_delay)[n_delay:]
+        rec_l = PROCESSORS.read(tag='datal', proc='RP2', n_samples=played.nsamples + n_delay)[n_skip:]
+        rec_r = PROCESSORS.read(tag='datar', proc='RP2', n_samples=played.nsamples + n_delay)[n_skip:]
         rec = slab.Binaural([rec_l, rec_r])
+    if n_repetitions > 1:
+        data = average_repetitions(rec.data, n_repetitions, sig.nsamples, average)
+        rec = type(rec)(data, samplerate=rec.samplerate)
     if compensate_level:
         if binaural:
             iid = rec.left.level - rec.right.level
@@ -753,3 +1189,23 @@ def play_and_record(speaker_nr, sig, compensate_delay=True, compensate_level=Tru
         else:
             rec.level = sig.level
     return rec
+
+
+def average_repetitions(data, n_repetitions, n_samples, average="mean"):
+    """
+    Cut a recording of a train of repetitions into the single repetitions and average them.
+
+    Args:
+        data (numpy.ndarray): recording with shape (samples, channels), the number of samples must be
+            divisible by n_repetitions
+        n_repetitions (int): number of repetitions in the recording
+        n_samples (int): number of samples of each repetition without the gap that follows it
+        average (str): "mean" or "median"
+    Returns:
+        numpy.ndarray: the average with shape (n_samples, channels)
+    """
+    data = np.asarray(data)
+    repetitions = data.reshape(n_repetitions, -1, data.shape[1])[:, :n_samples]
+    if average == "median":
+        return np.median(repetitions, axis=0)
+    return repetitions.mean(axis=0)
@@ -108,11 +108,11 @@ class Processors(object):
                            ['RX82', 'RX8', DIR/'data'/'rcx'/'bits.rcx']]
         else:
             raise ValueError(f'mode {mode} is not a valid input!')
-        self.mode = mode
-        logging.info(f'set mode to {mode}')
         self.initialize(proc_list, True, "GB")
+        self.mode = mode  # set the mode only after the circuits were loaded
+        logging.info(f'set mode to {mode}')
 
-    def write(self, tag, value, procs) :
+    def write(self, tag, value, procs):
         """
         Write data to processor(s).
 
@@ -134,19 +134,22 @@ class Processors(object):
             value : value that is written to the tag. Must
                 match the data type of the tag.
             procs : name(s) of the processor(s) to write to
+        To set several tags in one call, pass lists of tags, values and processors
+        with one element for each tag.
         Examples:
         #    >>> # set the value of tag 'data' on RX81 & RX82 to 0
         #    >>> write('data', 0, ['RX81', 'RX82'])
+        #    >>> # set 'chan' on both RX8s and 'playbuflen' on the RP2
+        #    >>> write(['chan', 'playbuflen'], [1, 1000], [['RX81', 'RX82'], 'RP2'])
         """
+        if isinstance(tag, (list, tuple)):
+            if isinstance(procs, str) or not len(tag) == len(value) == len(procs):
+                raise ValueError('If several tags are given, there must be one value and processor(s) for each tag!')
+            flags = [self.write(t, v, p) for t, v, p in zip(tag, value, procs)]
+            return int(all(flags))
         if isinstance(value, (np.int32, np.int64)):
             value = int(value)  # use built-int data type
-        if isinstance(procs, str):
-            if procs == "RX8s":
-                procs = [proc for proc in self.procs.keys() if "RX8" in proc]
-            elif procs == "all":
-                procs = list(self.procs.keys())
-            else:
-                procs = [procs]
+        procs = self._proc_names(procs)
         # Check if the procs are actually there
         if not set(procs).issubset(self.procs.keys()):
             raise ValueError('Can not find some of the specified processors!')
@@ -164,6 +167,17 @@ class Processors(object):
                 logging.warning(f'Unable to set tag {tag} on {proc}')
         return flag
 
+    def _proc_names(self, procs):
+        """Return a list of processor names, procs can be a name, a list of names, "RX8s" or "all"."""
+        if isinstance(procs, str):
+            if procs == "RX8s":
+                procs = [proc for proc in self.procs.keys() if "RX8" in proc]
+            elif procs == "all":
+                procs = list(self.procs.keys())
+            else:
+                procs = [procs]
+        return procs
+
     def read(self, tag, proc, n_samples=1):
         """
         Read data from processor.
@@ -254,10 +268,9 @@ class Processors(object):
         else:  # connecting was successful, load circuit
             if not rp.ClearCOF():
                 logging.warning('clearing control object file failed')
-            if not rp.LoadCOF(circuit):
-                logging.warning(f'could not load {circuit}.')
-            else:
-                logging.info(f'{circuit} loaded!')
+            if not os.path.isfile(circuit) or not rp.LoadCOF(str(circuit)):
+                raise FileNotFoundError(f'could not load {circuit}!')
+            logging.info(f'{circuit} loaded!')
             if not rp.Run():
                 logging.warning(f'Failed to run {model} processor')
             else:
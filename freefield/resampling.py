@@ -0,0 +1,131 @@
+"""
+Bootstrap and permutation statistics for localization metrics. Resamples are drawn as an
+index matrix (resamples x trials) so that a statistic is computed for a whole chunk of
+resamples with a single numpy call. Chunks are distributed across a process pool and every
+chunk has its own seed, derived from one seed sequence, so the results are reproducible
+independent of the number of workers.
+All statistics are called with arrays whose first axis are the resamples and second axis
+the trials and return one value per resample.
+"""
+import os
+import time
+import logging
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+
+def eg(ele_target, ele_response):
+    """Elevation gain: slope of the regression of response elevation on target elevation (Hofman et al., 1998)."""
+    x = ele_target - ele_target.mean(axis=1, keepdims=True)
+    y = ele_response - ele_response.mean(axis=1, keepdims=True)
+    return (x * y).sum(axis=1) / (x**2).sum(axis=1)
+
+
+def rmse_to_target(azi_target, ele_target, azi_response, ele_response):
+    """Root mean square of the distance between response and target (in degree). analysis.rmse, in
+    contrast, measures the spread of the responses around their mean."""
+    return np.sqrt(((azi_response - azi_target)**2 + (ele_response - ele_target)**2).mean(axis=1))
+
+
+def mad_to_target(azi_target, ele_target, azi_response, ele_response):
+    """Mean absolute distance between response and target (in degree). analysis.mad, in contrast,
+    measures the spread of the responses around their mean."""
+    return np.sqrt((azi_response - azi_target)**2 + (ele_response - ele_target)**2).mean(axis=1)
+
+
+def bootstrap(statistic, *arrays, n_resamples=10000, chunk_size=1000, n_jobs=None, seed=None):
+    """
+    Compute the bootstrap distribution of statistic. Trials (the first axis of every array) are
+    drawn with replacement and the same trials are drawn for all arrays.
+    Args:
+        statistic (callable): vectorized statistic, e.g. eg, rmse_to_target or mad_to_target. Must be defined
+            at module level so it can be sent to the worker processes
+        *arrays (numpy.ndarray): data, all arrays must have the same number of trials
+        n_resamples (int): number of bootstrap resamples
+        chunk_size (int): number of resamples that are computed at once, limits the memory usage
+        n_jobs (None | int): number of worker processes, if None use one per CPU, if 1 don't use a process pool
+        seed (None | int): seed for the random number generator
+    Returns:
+        numpy.ndarray: the statistic for each resample
+        numpy.ndarray: computation time for each chunk in seconds
+    """
+    arrays = _check_arrays(arrays)
+    n_trials = len(arrays[0])
+    return _run_chunks(_bootstrap_chunk, statistic, arrays, n_trials, n_resamples, chunk_size, n_jobs, seed)
+
+
+def permutation_test(statistic, arrays_a, arrays_b, n_permutations=10000, chunk_size=1000, n_jobs=None, seed=None):
+    """
+    Test whether statistic differs between two conditions by randomly reassigning the trials of both
+    conditions. The p-value is the (two sided) fraction of permutations where the absolute difference
+    is at least as large as the observed one.
+    Args:
+        statistic (callable): vectorized statistic, e.g. eg, rmse_to_target or mad_to_target
+        arrays_a (list of numpy.ndarray): data of the first condition, as passed to statistic
+        arrays_b (list of numpy.ndarray): data of the second condition
+        n_permutations, chunk_size, n_jobs, seed: see bootstrap
+    Returns:
+        float: observed difference (statistic of condition a minus condition b)
+        float: p-value
+        numpy.ndarray: the differences under the permutations
+        numpy.ndarray: computation time for each chunk in seconds
+    """
+    arrays_a, arrays_b = _check_arrays(arrays_a), _check_arrays(arrays_b)
+    if len(arrays_a) != len(arrays_b):
+        raise ValueError("Both conditions must have the same number of arrays!")
+    n_a = len(arrays_a[0])
+    pooled = [np.concatenate([a, b]) for a, b in zip(arrays_a, arrays_b)]
+    observed = apply_statistic(statistic, arrays_a) - apply_statistic(statistic, arrays_b)
+    differences, timings = _run_chunks(_permutation_chunk, statistic, pooled, n_a, n_permutations,
+                                       chunk_size, n_jobs, seed)
+    p = (np.sum(np.abs(differences) >= np.abs(observed)) + 1) / (n_permutations + 1)
+    return observed, p, differences, timings
+
+
+def _check_arrays(arrays):
+    arrays = [np.asarray(a) for a in arrays]
+    if any(len(a) != len(arrays[0]) for a in arrays):
+        raise ValueError("All arrays must have the same number of trials!")
+    return arrays
+
+
+def apply_statistic(statistic, arrays):
+    """Compute a vectorized statistic (see bootstrap) of the original data, arrays are the trials without resampling."""
+    return statistic(*[a[np.newaxis] for a in arrays])[0]
+
+
+def _run_chunks(function, statistic, arrays, n, n_resamples, chunk_size, n_jobs, seed):
+    """split the resamples into chunks, compute them in a process pool and log the timing"""
+    sizes = [chunk_size] * (n_resamples // chunk_size)
+    if n_resamples % chunk_size:
+        sizes.append(n_resamples % chunk_size)
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    args = ([statistic]*len(sizes), [arrays]*len(sizes), [n]*len(sizes), seeds, sizes)
+    if n_jobs == 1:
+        results = list(map(function, *args))
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs or os.cpu_count()) as pool:
+            results = list(pool.map(function, *args))
+    values = np.concatenate([r[0] for r in results])
+    timings = np.array([r[1] for r in results])
+    logging.info(f"computed {n_resamples} resamples in {len(sizes)} chunks, "
+                 f"{timings.mean():.3f} s per chunk ({timings.sum():.3f} s in total)")
+    return values, timings
+
+
+def _bootstrap_chunk(statistic, arrays, n_trials, seed, size):
+    """compute statistic for size resamples drawn with replacement"""
+    start = time.perf_counter()
+    idx = np.random.default_rng(seed).integers(0, n_trials, (size, n_trials))
+    values = statistic(*[a[idx] for a in arrays])
+    return values, time.perf_counter() - start
+
+
+def _permutation_chunk(statistic, arrays, n_a, seed, size):
+    """compute the difference of statistic for size random splits of the pooled trials"""
+    start = time.perf_counter()
+    n_trials = len(arrays[0])
+    idx = np.argsort(np.random.default_rng(seed).random((size, n_trials)), axis=1)  # one permutation per row
+    idx_a, idx_b = idx[:, :n_a], idx[:, n_a:]
+    values = statistic(*[a[idx_a] for a in arrays]) - statistic(*[a[idx_b] for a in arrays])
+    return values, time.perf_counter() - start
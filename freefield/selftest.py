@@ -0,0 +1,138 @@
+"""
+Analysis for the self test of a setup (see main.self_test). The speakers are tested with multitone
+probes: the tones lie exactly on the frequency bins of the recording's FFT and the probes of
+speakers that are played at the same time use interleaved tones, so each speaker's level and
+signal to noise ratio can be read from the spectrum of a single recording. All functions work
+on stacks of recordings (or camera images) and do not access the hardware.
+"""
+import numpy as np
+import pandas as pd
+
+
+def probe_bins(n_probes, n_samples, samplerate, low_cutoff=500, high_cutoff=8000, spacing=4):
+    """
+    Assign interleaved tones to probes that are played at the same time. The tones lie on a grid of
+    FFT bins spacing bins apart and probe k gets every n_probes-th tone starting with the k-th, so
+    every probe covers the whole frequency range.
+
+    Args:
+        n_probes (int): number of probes that are played at the same time
+        n_samples (int): length of the probes and the recording in samples
+        samplerate (int): samplerate of the probes
+        low_cutoff, high_cutoff (float): frequency range of the tones in Hz
+        spacing (int): distance between neighbouring tones in FFT bins
+    Returns:
+        numpy.ndarray: FFT bins of the tones with shape (n_probes, tones per probe)
+    """
+    grid = np.arange(int(np.ceil(low_cutoff * n_samples / samplerate)), int(high_cutoff * n_samples / samplerate),
+                     spacing)
+    n_tones = len(grid) // n_probes
+    if n_tones < 1:
+        raise ValueError(f"The frequency range is too narrow for {n_probes} probes of {n_samples} samples!")
+    return grid[:n_tones * n_probes].reshape(n_tones, n_probes).T
+
+
+def probes(bins, n_samples, samplerate, ramp_duration=0.005, seed=0):
+    """
+    Generate multitone probes with random phases (which keeps the crest factor low).
+
+    Args:
+        bins (numpy.ndarray): FFT bins of the tones of each probe, see probe_bins
+        n_samples (int): length of the probes in samples
+        samplerate (int): samplerate of the probes
+        ramp_duration (float): duration of the on- and offset ramps in seconds
+        seed (int): seed for the random phases
+    Returns:
+        numpy.ndarray: probes with shape (n_probes, n_samples), the rms of each probe is 1
+    """
+    bins = np.atleast_2d(bins)
+    phases = np.random.default_rng(seed).uniform(0, 2 * np.pi, bins.shape)
+    spectra = np.zeros((len(bins), n_samples // 2 + 1), dtype=complex)
+    np.put_along_axis(spectra, bins, np.exp(1j * phases), axis=1)
+    data = np.fft.irfft(spectra, n=n_samples, axis=1)
+    data /= np.sqrt(np.mean(data**2, axis=1, keepdims=True))
+    n_ramp = int(ramp_duration * samplerate)
+    if n_ramp:
+        ramp = np.sin(np.linspace(0, np.pi / 2, n_ramp))**2
+        data[:, :n_ramp] *= ramp
+        data[:, -n_ramp:] *= ramp[::-1]
+    return data
+
+
+def detect(recordings, bins):
+    """
+    Measure the level and signal to noise ratio of each probe in each recording. The recordings are
+    analyzed with one batched FFT. The signal is the power in the probe's bins and the noise is the
+    power in the bins half way between the tones, where no probe has energy.
+
+    Args:
+        recordings (numpy.ndarray): recordings with shape (n_recordings, n_samples)
+        bins (numpy.ndarray): FFT bins of the probes played in each recording with shape
+            (n_recordings, n_probes, tones per probe), see probe_bins
+    Returns:
+        numpy.ndarray: level of each probe in dB (relative to full scale) with shape (n_recordings, n_probes)
+        numpy.ndarray: signal to noise ratio of each probe in dB with the same shape
+    """
+    recordings = np.atleast_2d(recordings)
+    n_samples = recordings.shape[1]
+    spectra = np.abs(np.fft.rfft(recordings * np.hanning(n_samples), axis=1))**2
+    spectra *= 4 / np.sum(np.hanning(n_samples))**2  # squared amplitude of a tone in the bin
+    bins = np.asarray(bins)
+    n_recordings, n_probes, n_tones = bins.shape
+    rows = np.arange(n_recordings)[:, None, None]
+    signal = spectra[rows, bins].sum(axis=2)
+    spacing = np.diff(np.sort(bins.reshape(n_recordings, -1), axis=1), axis=1).min(initial=4)
+    noise_bins = (bins + max(spacing // 2, 1)).clip(max=spectra.shape[1] - 1)
+    noise = spectra[rows, noise_bins].sum(axis=2)
+    with np.errstate(divide="ignore"):
+        level = 10 * np.log10(signal / 2)  # rms of the tones
+        snr = 10 * np.log10(signal / noise)
+    return level, snr
+
+
+def led_visible(reference, images, threshold=30):
+    """
+    Check in camera images whether a LED was visible. Each image is compared to a reference taken
+    while all LEDs were off and the LED is detected if enough pixels got brighter by more than the
+    threshold in at least one of the cameras.
+
+    Args:
+        reference (numpy.ndarray): image(s) with all LEDs off with shape (height, width, n_images, n_cams)
+        images (numpy.ndarray): images with one LED on each with shape (n_leds, height, width, n_images, n_cams)
+        threshold (float): increase of the brightness (in gray values) in the brightest pixels
+    Returns:
+        numpy.ndarray: brightness increase of each LED (maximum over the cameras)
+        numpy.ndarray of bool: True for the LEDs that were visible
+    """
+    reference = np.asarray(reference, dtype=float).mean(axis=2)
+    images = np.asarray(images, dtype=float).mean(axis=3)
+    difference = (images - reference).reshape(len(images), -1, images.shape[-1])
+    increase = np.percentile(difference, 99.9, axis=1).max(axis=1)  # ignores single noisy pixels
+    return increase, increase > threshold
+
+
+def report(speakers, level, snr, calibrated, snr_thresh=20, level_tolerance=6):
+    """
+    Combine the measurements of the speakers into a report. A speaker passes if its probe was detected
+    and, if the speaker is equalized, if its level deviates less than level_tolerance from the median
+    of all equalized speakers (after equalization all speakers should be equally loud).
+
+    Args:
+        speakers (pandas DataFrame): rows from the speaker table
+        level, snr (array-like): level and signal to noise ratio of each speaker in dB, see detect
+        calibrated (array-like of bool): True for the speakers whose probe was equalized
+        snr_thresh (float): minimum signal to noise ratio for detecting a speaker in dB
+        level_tolerance (float): maximum deviation from the median level in dB
+    Returns:
+        pandas DataFrame: one row per speaker with the columns index_number, azi, ele, level,
+            level_deviation, snr, detected and passed
+    """
+    level, snr, calibrated = np.asarray(level, float), np.asarray(snr, float), np.asarray(calibrated, bool)
+    detected = snr >= snr_thresh
+    reference = detected & calibrated
+    deviation = level - np.median(level[reference]) if reference.any() else np.full(len(level), np.nan)
+    deviation[~calibrated] = np.nan
+    passed = detected & ~(np.abs(deviation) > level_tolerance)
+    return pd.DataFrame({"index_number": np.asarray(speakers.index_number, dtype=int),
+                         "azi": np.asarray(speakers.azi), "ele": np.asarray(speakers.ele), "level": level,
+                         "level_deviation": deviation, "snr": snr, "detected": detected, "passed": passed})
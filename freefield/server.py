@@ -0,0 +1,274 @@
+"""
+Control a setup over the network. The server runs on the computer that is connected to the
+processors and exposes a selection of main's functions. Clients call them with Client.call
+or like methods of the client, e.g. client.play_and_record(23, sound).
+
+Every message is a frame that consists of a one byte format flag (0: json, 1: msgpack),
+the length of the header as four byte unsigned integer, the header and the raw bytes of all
+arrays that are sent with the message. Arrays and sounds in arguments and results are replaced
+by references in the header, so audio data is sent without encoding it as text.
+"""
+import io
+import json
+import time
+import socket
+import struct
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import slab
+from freefield import main, analysis
+try:
+    import msgpack
+except ModuleNotFoundError:
+    msgpack = None
+
+# functions of main that can be called by clients
+EXPOSED = ("initialize_setup", "write", "read", "play", "halt", "play_and_wait", "play_and_wait_for_button",
+           "wait_to_finish_playing", "get_speaker", "set_signal_and_speaker", "apply_equalization", "play_and_record",
+           "get_headpose", "check_pose", "play_start_sound", "play_warning_sound", "localization_test_freefield",
+           "localization_test_headphones")
+_PREFIX = struct.Struct("!BI")  # format flag and header length
+JSON, MSGPACK = 0, 1
+
+
+class Server:
+    """
+    Server that calls the exposed functions in the order in which the requests arrive. The
+    functions are run one at a time in a separate thread, so the processors are never accessed
+    concurrently but the server keeps receiving messages while a function is running.
+
+    Args:
+        host (str): address to listen on
+        port (int): port to listen on, if 0 a free port is chosen (see Server.port)
+        path (None | str): if given, listen on this unix socket instead of host and port
+        functions (None | dict): callables with their names, if None expose the functions in EXPOSED
+    """
+
+    def __init__(self, host="127.0.0.1", port=9999, path=None, functions=None):
+        self.host, self.port, self.path = host, port, path
+        if functions is None:
+            functions = {name: getattr(main, name) for name in EXPOSED}
+        self.functions = dict(functions)
+        self.functions["stats"] = self.stats
+        self.latencies = {}  # durations of all calls of each function in seconds
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._server = None
+
+    def stats(self):
+        """Return the number, mean, median and maximum duration (in ms) of the calls of each function."""
+        rows = [[name, len(lat), np.mean(lat)*1000, np.median(lat)*1000, np.max(lat)*1000]
+                for name, lat in self.latencies.items()]
+        return pd.DataFrame(rows, columns=["function", "n", "mean_ms", "median_ms", "max_ms"])
+
+    async def start(self):
+        if self.path is not None:
+            self._server = await asyncio.start_unix_server(self._handle, path=self.path)
+        else:
+            self._server = await asyncio.start_server(self._handle, self.host, self.port)
+            self.port = self._server.sockets[0].getsockname()[1]
+        logging.info(f"serving {len(self.functions)} functions on {self.path or f'{self.host}:{self.port}'}")
+
+    async def serve_forever(self):
+        """Start the server (if it is not running) and wait until it is closed."""
+        if self._server is None:
+            await self.start()
+        await self._server.wait_closed()
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+        self._executor.shutdown(wait=False)
+
+    async def wait_closed(self):
+        """Wait until the server is closed, see close."""
+        if self._server is not None:
+            await self._server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        """answer the requests of one client until it disconnects"""
+        loop = asyncio.get_event_loop()  # the running loop, get_running_loop needs Python 3.7
+        try:
+            while True:
+                try:
+                    fmt, header, buffers = await _read_frame(reader)
+                except asyncio.IncompleteReadError:
+                    break
+                name = header.get("function")
+                start = time.perf_counter()
+                try:
+                    if name not in self.functions:
+                        raise ValueError(f"Function {name} is not exposed by the server!")
+                    args, kwargs = decode(header.get("args", []), buffers), decode(header.get("kwargs", {}), buffers)
+                    result = await loop.run_in_executor(self._executor, lambda: self.functions[name](*args, **kwargs))
+                    response, attachments = encode(result)
+                    latency = time.perf_counter() - start
+                    frame = _frame(fmt, {"id": header.get("id"), "result": response, "latency": latency}, attachments)
+                except Exception as error:  # errors are sent to the client instead of stopping the server
+                    logging.warning(f"call of {name} failed: {error!r}")
+                    latency = time.perf_counter() - start
+                    frame = _frame(fmt, {"id": header.get("id"), "error": f"{type(error).__name__}: {error}",
+                                         "latency": latency}, [])
+                if name in self.functions:  # don't keep the names of unknown functions
+                    self.latencies.setdefault(name, []).append(latency)
+                writer.write(frame)
+                await writer.drain()
+        finally:
+            writer.close()
+
+
+def serve(host="127.0.0.1", port=9999, path=None):
+    """Run a server with the functions in EXPOSED until the program is interrupted."""
+    server = Server(host, port, path)
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+
+
+class Client:
+    """
+    Connect to a server and call its functions. The round trip time of every call is
+    stored in Client.latencies together with the time the server spent in the function.
+
+    Args:
+        host (str): address of the server
+        port (int): port of the server
+        path (None | str): if given, connect to this unix socket instead of host and port
+        use_msgpack (bool): encode the headers with msgpack instead of json
+        timeout (None | float): timeout for each call in seconds
+    """
+
+    def __init__(self, host="127.0.0.1", port=9999, path=None, use_msgpack=False, timeout=None):
+        if use_msgpack and msgpack is None:
+            raise ValueError("msgpack is not installed!")
+        self._format = MSGPACK if use_msgpack else JSON
+        if path is not None:
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.connect(path)
+        else:
+            self._socket = socket.create_connection((host, port))
+            self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._socket.settimeout(timeout)
+        self._file = self._socket.makefile("rb")
+        self._lock = threading.Lock()
+        self._count = 0
+        self.latencies = []  # function, round trip time and time spent on the server for every call
+
+    def call(self, function, *args, **kwargs):
+        """Call a function on the server and return its result. Raises RuntimeError if the call failed."""
+        args, attachments = encode(list(args))
+        kwargs, kwarg_attachments = encode(kwargs, offset=len(attachments))
+        with self._lock:
+            self._count += 1
+            start = time.perf_counter()
+            self._socket.sendall(_frame(self._format, {"id": self._count, "function": function, "args": args,
+                                                       "kwargs": kwargs}, attachments + kwarg_attachments))
+            _, header, buffers = _read_frame_sync(self._file)
+            self.latencies.append((function, time.perf_counter() - start, header.get("latency", np.nan)))
+        if "error" in header:
+            raise RuntimeError(f"{function} failed on the server: {header['error']}")
+        return decode(header["result"], buffers)
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self.call(name, *args, **kwargs)
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def encode(value, offset=0):
+    """
+    Replace arrays, sounds and tables in value by references that can be encoded as json. Trial
+    sequences of the localization tests are sent as tables (see analysis.get_loctest_data).
+    Returns:
+        the encoded value
+        list of numpy.ndarray: the arrays that are sent after the header
+    """
+    attachments = []
+
+    def _encode(v):
+        if isinstance(v, slab.Trialsequence):
+            return _encode(analysis.get_loctest_data(v))
+        if isinstance(v, slab.Signal):
+            return {"__sound__": _encode(np.asarray(v.data)), "samplerate": v.samplerate,
+                    "binaural": isinstance(v, slab.Binaural)}
+        if isinstance(v, np.ndarray):
+            attachments.append(np.ascontiguousarray(v))
+            return {"__array__": offset + len(attachments) - 1, "dtype": v.dtype.str, "shape": list(v.shape)}
+        if isinstance(v, (pd.DataFrame, pd.Series)):
+            return {"__pandas__": type(v).__name__, "data": v.to_json(orient="split")}
+        if isinstance(v, dict):
+            return {str(k): _encode(i) for k, i in v.items()}
+        if isinstance(v, (list, tuple)):
+            return [_encode(i) for i in v]
+        if isinstance(v, np.generic):
+            return v.item()
+        return v
+    return _encode(value), attachments
+
+
+def decode(value, buffers):
+    """Inverse of encode, buffers are the raw bytes of the arrays."""
+    if isinstance(value, dict):
+        if "__array__" in value:
+            return np.frombuffer(buffers[value["__array__"]], dtype=value["dtype"]).reshape(value["shape"])
+        if "__sound__" in value:
+            kind = slab.Binaural if value["binaural"] else slab.Sound
+            return kind(decode(value["__sound__"], buffers).copy(), samplerate=value["samplerate"])
+        if "__pandas__" in value:
+            typ = "frame" if value["__pandas__"] == "DataFrame" else "series"
+            return pd.read_json(io.StringIO(value["data"]), orient="split", typ=typ)
+        return {k: decode(v, buffers) for k, v in value.items()}
+    if isinstance(value, list):
+        return [decode(v, buffers) for v in value]
+    return value
+
+
+def _frame(fmt, header, attachments):
+    """build a frame from the header and the arrays that are sent with it"""
+    header = dict(header, buffers=[a.nbytes for a in attachments])
+    data = msgpack.packb(header) if fmt == MSGPACK else json.dumps(header).encode()
+    return b"".join([_PREFIX.pack(fmt, len(data)), data] + [a.tobytes() for a in attachments])
+
+
+def _parse_header(fmt, data):
+    if fmt == MSGPACK:
+        if msgpack is None:
+            raise ValueError("Received a msgpack message but msgpack is not installed!")
+        return msgpack.unpackb(data)
+    return json.loads(data)
+
+
+async def _read_frame(reader):
+    fmt, length = _PREFIX.unpack(await reader.readexactly(_PREFIX.size))
+    header = _parse_header(fmt, await reader.readexactly(length))
+    buffers = [await reader.readexactly(n) for n in header.get("buffers", [])]
+    return fmt, header, buffers
+
+
+def _read_frame_sync(file):
+    def read(n):
+        data = file.read(n)
+        if len(data) < n:
+            raise ConnectionError("The server closed the connection!")
+        return data
+    fmt, length = _PREFIX.unpack(read(_PREFIX.size))
+    header = _parse_header(fmt, read(length))
+    return fmt, header, [read(n) for n in header.get("buffers", [])]
@@ -0,0 +1,150 @@
+"""
+Storing the results of localization tests on disk while the test is running. Each session
+is a folder with a small json file with meta data and two append-only binary logs: one
+record per trial and one record per head pose estimate. Every record has a fixed size
+(see TRIAL_DTYPE and POSE_DTYPE) and is flushed to disk immediately, so if the experiment
+crashes, all trials up to the crash are kept. Reading a session does not require unpickling
+anything - the logs are loaded directly into numpy arrays.
+"""
+import os
+import json
+import datetime
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+TRIAL_DTYPE = np.dtype([("trial", "i4"), ("index_number", "i4"), ("azi_target", "f8"), ("ele_target", "f8"),
+                        ("azi_response", "f8"), ("ele_response", "f8"), ("azi_sem", "f8"), ("ele_sem", "f8"),
+                        ("n_frames", "i4"), ("onset", "f8"), ("response_time", "f8"), ("rt", "f8")])
+POSE_DTYPE = np.dtype([("trial", "i4"), ("image", "i4"), ("cam", "i4"), ("azi", "f8"), ("ele", "f8"),
+                       ("confidence", "f8"), ("error", "f8")])
+
+
+class SessionWriter:
+    """
+    Append the trials of a localization test to a session folder. Can be used as a context
+    manager which closes the files at the end.
+
+    Args:
+        path (str | pathlib.Path): folder of the session, is created if it does not exist.
+            If it exists, new trials are appended to the existing ones
+        subject (str): name of the subject
+        **metadata: additional information that is stored in the session's json file
+    """
+
+    def __init__(self, path, subject="", **metadata):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        meta_file = self.path / "session.json"
+        if not meta_file.exists():
+            meta = {"subject": subject, "session": self.path.name, "created": datetime.datetime.now().isoformat(),
+                    "trial_dtype": TRIAL_DTYPE.descr, "pose_dtype": POSE_DTYPE.descr, **metadata}
+            with open(meta_file, "w") as f:
+                json.dump(meta, f, indent=2, default=str)
+        self._trials = _open_log(self.path / "trials.bin", TRIAL_DTYPE)
+        self._poses = _open_log(self.path / "poses.bin", POSE_DTYPE)
+
+    def add_trial(self, trial, target, response, onset=np.nan, response_time=np.nan, pose=None, fused=None):
+        """
+        Write one trial to disk.
+
+        Args:
+            trial (int): number of the trial in the sequence
+            target (pandas Series): row from the speaker table
+            response (tuple): azimuth and elevation of the response
+            onset (float): time the stimulus was played
+            response_time (float): time the response button was pressed
+            pose (None | pandas DataFrame): single head pose estimates as returned by Cameras.get_headpose
+            fused (None | pandas Series): fused pose with standard errors, see camera.fuse_poses
+        """
+        record = np.zeros(1, dtype=TRIAL_DTYPE)
+        record["trial"], record["index_number"] = trial, target.index_number
+        record["azi_target"], record["ele_target"] = target.azi, target.ele
+        record["azi_response"], record["ele_response"] = [np.nan if r is None else r for r in response]
+        record["onset"], record["response_time"], record["rt"] = onset, response_time, response_time - onset
+        record["azi_sem"], record["ele_sem"], record["n_frames"] = np.nan, np.nan, 0
+        if fused is not None:
+            record["azi_sem"], record["ele_sem"] = fused.azi_sem, fused.ele_sem
+            record["n_frames"] = fused.get("n_frames", 0)
+        if pose is not None and len(pose):
+            poses = np.zeros(len(pose), dtype=POSE_DTYPE)
+            poses["trial"] = trial
+            for name in POSE_DTYPE.names[1:]:
+                if name in pose:
+                    poses[name] = pose[name].values.astype(float)
+            self._write(self._poses, poses)
+        self._write(self._trials, record)
+
+    @staticmethod
+    def _write(file, records):
+        file.write(records.tobytes())
+        file.flush()
+        os.fsync(file.fileno())
+
+    def close(self):
+        self._trials.close()
+        self._poses.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _open_log(file, dtype):
+    """Open a log for appending. An incomplete last record (e.g. after a crash) is removed, so the
+    records that are appended start at a record boundary."""
+    log = open(file, "ab")
+    size = log.tell()
+    if size % dtype.itemsize:
+        log.truncate(size - size % dtype.itemsize)
+    return log
+
+
+def _read_log(file, dtype):
+    """Read all complete records from a log file, an incomplete last record (e.g. after a crash) is ignored."""
+    if not file.exists():
+        return np.zeros(0, dtype=dtype)
+    count = file.stat().st_size // dtype.itemsize
+    return np.fromfile(file, dtype=dtype, count=count)
+
+
+def read_session(path):
+    """
+    Read a single session.
+
+    Returns:
+        pandas DataFrame: one row per trial, with subject and session columns
+        pandas DataFrame: one row per head pose estimate
+    """
+    path = Path(path)
+    with open(path / "session.json") as f:
+        meta = json.load(f)
+    trials = pd.DataFrame(_read_log(path / "trials.bin", TRIAL_DTYPE))
+    poses = pd.DataFrame(_read_log(path / "poses.bin", POSE_DTYPE))
+    for data in [trials, poses]:
+        data.insert(0, "session", meta["session"])
+        data.insert(0, "subject", meta["subject"])
+    return trials, poses
+
+
+def read_sessions(paths):
+    """
+    Read several sessions and concatenate them. The trials can directly be passed to
+    analysis.localization_metrics.
+
+    Args:
+        paths (list | str | pathlib.Path): session folders or a folder containing session folders
+    Returns:
+        pandas DataFrame: trials of all sessions
+        pandas DataFrame: head pose estimates of all sessions
+    """
+    if isinstance(paths, (str, Path)):
+        paths = sorted(p.parent for p in Path(paths).glob("*/session.json"))
+    sessions = [read_session(p) for p in paths]
+    if not sessions:
+        return pd.DataFrame(), pd.DataFrame()
+    trials = pd.concat([s[0] for s in sessions], ignore_index=True)
+    poses = pd.concat([s[1] for s in sessions], ignore_index=True)
+    return trials, poses
@@ -0,0 +1,113 @@
+"""
+Drive several setups from one program. The functions in main store the processors, cameras,
+speaker table and calibration of the setup in module level variables. A Setup object keeps
+its own copy of this state and makes it the state of main while one of main's functions is
+called, so several setups can be used side by side. Because the state of main is shared, the calls
+of all setups in one process are serialized by a lock: while one setup runs a function (e.g. a whole
+localization test), the other setups wait. Setups can only run at the same time as separate
+processes, which is what run_setups does.
+"""
+import threading
+import logging
+import multiprocessing
+from pathlib import Path
+from contextlib import contextmanager
+import pandas as pd
+from freefield import main, Processors
+
+# names of the variables in main that make up the state of a setup, and the attributes of Setup they are stored in
+STATE = {"PROCESSORS": "processors", "CAMERAS": "cameras", "TABLE": "table",
+         "EQUALIZATIONDICT": "equalization_dict", "EQUALIZATIONFILE": "equalization_file"}
+_LOCK = threading.RLock()
+
+
+class Setup:
+    """
+    A setup with its own processors, cameras, speaker table and calibration. All public functions
+    of main are available as methods and operate on this setup. Calls of different setups in the same
+    process don't run concurrently, see run_setups for that.
+
+    Args:
+        setup (str): the setup to load, 'dome' or 'arc'
+        **kwargs: arguments for main.initialize_setup, e.g. default_mode or camera_type
+    Examples:
+    #    >>> dome = Setup("dome", default_mode="play_rec")
+    #    >>> arc = Setup("arc", default_mode="play_rec")
+    #    >>> dome.set_signal_and_speaker(slab.Sound.tone(), speaker=23)
+    #    >>> dome.play_and_wait()
+    """
+
+    def __init__(self, setup, **kwargs):
+        self.name = setup
+        self.processors = Processors()
+        self.cameras = None
+        self.table = pd.DataFrame()
+        self.equalization_dict = {}
+        self.equalization_file = Path()
+        self.initialize_setup(setup, **kwargs)
+
+    def __repr__(self):
+        return f"Setup({self.name!r}, {len(self.table)} speakers, processors={list(self.processors.procs)})"
+
+    @contextmanager
+    def active(self):
+        """Make this setup the state of main for the duration of the with block."""
+        with _LOCK:
+            previous = {variable: getattr(main, variable) for variable in STATE}
+            for variable, attribute in STATE.items():
+                setattr(main, variable, getattr(self, attribute))
+            try:
+                yield self
+            finally:  # keep changes made by main (e.g. a new calibration) and restore the previous state
+                for variable, attribute in STATE.items():
+                    setattr(self, attribute, getattr(main, variable))
+                    setattr(main, variable, previous[variable])
+
+    def __getattr__(self, name):
+        # only called for attributes that are not found on the instance, i.e. the functions of main
+        function = getattr(main, name, None) if not name.startswith("_") else None
+        if not callable(function) or getattr(function, "__module__", None) != main.__name__:
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
+        def method(*args, **kwargs):
+            with self.active():
+                return function(*args, **kwargs)
+        method.__name__, method.__doc__ = name, function.__doc__
+        return method
+
+
+def run_setups(jobs, n_workers=None):
+    """
+    Run several setups in parallel, each in its own process. Every job initializes a setup and
+    calls a list of main's functions on it. The processes are started with the "spawn" method
+    so that each one connects to its own processors.
+
+    Args:
+        jobs (list of dict): each job has the key "setup", a dict with the arguments for Setup, and the key
+            "calls", a list of tuples (function name, args, kwargs)
+        n_workers (None | int): maximum number of processes, if None start one per job
+    Returns:
+        list: for each job, the list of return values of its calls
+    Examples:
+    #    >>> jobs = [{"setup": {"setup": "dome", "default_mode": "loctest_freefield"},
+    #    ...          "calls": [("localization_test_freefield", (targets,), {"n_reps": 3})]},
+    #    ...         {"setup": {"setup": "arc", "default_mode": "loctest_freefield"},
+    #    ...          "calls": [("localization_test_freefield", (targets,), {"n_reps": 3})]}]
+    #    >>> dome_results, arc_results = run_setups(jobs)
+    """
+    if not jobs:
+        return []
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(processes=n_workers or len(jobs)) as pool:
+        results = [pool.apply_async(_run_job, (job["setup"], job.get("calls", []))) for job in jobs]
+        return [result.get() for result in results]
+
+
+def _run_job(setup_kwargs, calls):
+    """initialize a setup in the worker process and call the functions in order"""
+    setup = Setup(**setup_kwargs)
+    results = []
+    for name, args, kwargs in calls:
+        logging.info(f"{setup.name}: calling {name}")
+        results.append(getattr(setup, name)(*args, **kwargs))
+    return results
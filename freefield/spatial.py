@@ -0,0 +1,118 @@
+"""
+Play virtual sources between the loudspeakers with vector base amplitude panning (VBAP, Pulkki 1997).
+The speaker array is divided into triangles (or, for a horizontal arc, into pairs of neighbouring
+speakers) and a source inside a triangle is played from its three speakers with gains that are
+computed from the direction of the source and the directions of the speakers. The triangulation
+of a speaker table is computed once and cached and all queries are vectorized, so the positions
+of all trials of an experiment can be resolved with a single call.
+"""
+import numpy as np
+from scipy.spatial import Delaunay
+import slab
+from freefield import spherical, equalization
+
+_CACHE = {}
+
+
+class Triangulation:
+    """
+    Triangulation of a speaker array. Use triangulate, which caches the result, instead of creating
+    instances directly.
+
+    Args:
+        speakers (pandas DataFrame): rows from the speaker table
+    """
+
+    def __init__(self, speakers):
+        self.index_numbers = np.asarray(speakers.index_number, dtype=int)
+        self.azi = np.asarray(speakers.azi, dtype=float)
+        self.ele = np.asarray(speakers.ele, dtype=float)
+        self.horizontal = np.ptp(self.ele) == 0  # e.g. the arc, triangles are degenerate
+        if self.horizontal:  # pairs of neighbouring speakers
+            order = np.argsort(self.azi)
+            self.simplices = np.column_stack([order[:-1], order[1:]])
+            self._delaunay = None
+        else:
+            self._delaunay = Delaunay(np.column_stack([self.azi, self.ele]))
+            self.simplices = self._delaunay.simplices
+        vectors = spherical.to_cartesian(self.azi, self.ele)[self.simplices]  # (simplices, vertices, xyz)
+        if self.horizontal:  # pan in the plane of the speakers: use the x and y coordinates only
+            vectors = vectors[:, :, :2]
+        self._inverse = np.linalg.inv(vectors)
+
+    def __len__(self):
+        return len(self.simplices)
+
+    def find(self, azi, ele):
+        """Return the index of the triangle (or pair) that contains each position, -1 if it is outside the array."""
+        azi, ele = np.broadcast_arrays(np.atleast_1d(np.asarray(azi, dtype=float)),
+                                       np.atleast_1d(np.asarray(ele, dtype=float)))
+        if not self.horizontal:
+            return self._delaunay.find_simplex(np.column_stack([azi.ravel(), ele.ravel()]))
+        sorted_azi = np.sort(self.azi)
+        simplex = np.searchsorted(sorted_azi, azi.ravel(), side="right") - 1
+        simplex[azi.ravel() == sorted_azi[-1]] = len(sorted_azi) - 2  # the last speaker belongs to the last pair
+        simplex[(simplex < 0) | (simplex >= len(self.simplices)) | (ele.ravel() != self.ele[0])] = -1
+        return simplex
+
+    def query(self, azi, ele):
+        """
+        Find the speakers and their gains for virtual sources.
+
+        Args:
+            azi, ele (float | array-like): azimuth and elevation of the virtual sources in degree
+        Returns:
+            numpy.ndarray: index numbers of the speakers with shape (n_sources, 3), -1 if a
+                horizontal array uses only two speakers
+            numpy.ndarray: gains with shape (n_sources, 3), normalized so their squares add up to one
+        """
+        simplex = self.find(azi, ele)
+        if (simplex < 0).any():
+            raise ValueError(f"{(simplex < 0).sum()} of the positions are outside of the speaker array!")
+        azi, ele = np.broadcast_arrays(np.atleast_1d(azi), np.atleast_1d(ele))
+        source = spherical.to_cartesian(azi.ravel(), ele.ravel())
+        if self.horizontal:
+            source = source[:, :2]
+        gains = np.einsum("ni,nij->nj", source, self._inverse[simplex]).clip(min=0)
+        gains /= np.linalg.norm(gains, axis=1, keepdims=True)
+        speakers = self.index_numbers[self.simplices[simplex]]
+        if self.horizontal:
+            speakers = np.column_stack([speakers, np.full(len(speakers), -1)])
+            gains = np.column_stack([gains, np.zeros(len(gains))])
+        return speakers, gains
+
+
+def triangulate(speakers):
+    """Return the (cached) triangulation of the speakers, see Triangulation."""
+    key = (np.asarray(speakers.index_number, dtype=int).tobytes(), np.asarray(speakers.azi, dtype=float).tobytes(),
+           np.asarray(speakers.ele, dtype=float).tobytes())
+    if key not in _CACHE:
+        _CACHE[key] = Triangulation(speakers)
+    return _CACHE[key]
+
+
+def interpolate_equalization(calibration, speakers, gains):
+    """
+    Interpolate the equalization of a virtual source from the equalization of the speakers it is played
+    from. Level factor and filter coefficients are averaged, weighted by the energy (squared gain) of
+    each speaker. Like main.apply_equalization, the compact filters are used if there are any (see
+    equalization.speaker_filter), shorter filters are padded with zeros.
+
+    Args:
+        calibration (dict): the calibration of the setup, see main.EQUALIZATIONDICT
+        speakers (array-like): index numbers of the speakers, -1 is ignored
+        gains (array-like): gain of each speaker
+    Returns:
+        dict: with the interpolated level factor ("level") and filter ("filter")
+    """
+    speakers, gains = np.asarray(speakers), np.asarray(gains, dtype=float)
+    used = (speakers >= 0) & (gains > 0)
+    speakers, weights = speakers[used], gains[used]**2 / np.sum(gains[used]**2)
+    entries = [calibration.get(str(index_number), {}) for index_number in speakers]
+    if not all("filter" in entry for entry in entries):
+        raise ValueError("All speakers must be equalized!")
+    level = float(np.sum([w * entry["level"] for w, entry in zip(weights, entries)]))
+    filters = [np.asarray(equalization.speaker_filter(entry).data, dtype=float)[:, 0] for entry in entries]
+    n_taps = max(len(fir) for fir in filters)
+    data = np.sum([w * np.pad(fir, (0, n_taps - len(fir))) for w, fir in zip(weights, filters)], axis=0)
+    return {"level": level, "filter": slab.Filter(data, samplerate=entries[0]["filter"].samplerate, fir=True)}
@@ -0,0 +1,105 @@
+"""
+Localization metrics that treat azimuth and elevation as directions on a sphere
+instead of points in a plane. All functions take arrays of angles in degree and
+use numpy broadcasting, so they can be applied to many trials at once.
+Azimuth is positive to the right and elevation positive upwards.
+"""
+import numpy as np
+from freefield import resampling
+
+
+def to_cartesian(azi, ele):
+    """Convert azimuth and elevation (in degree) to unit vectors. The last axis of the
+    returned array contains the x (front), y (right) and z (up) coordinates."""
+    azi, ele = np.broadcast_arrays(np.deg2rad(azi), np.deg2rad(ele))
+    return np.stack([np.cos(ele) * np.cos(azi), np.cos(ele) * np.sin(azi), np.sin(ele)], axis=-1)
+
+
+def to_spherical(vectors):
+    """Convert (not necessarily normalized) vectors to azimuth and elevation in degree."""
+    vectors = np.asarray(vectors, dtype=float)
+    azi = np.rad2deg(np.arctan2(vectors[..., 1], vectors[..., 0]))
+    ele = np.rad2deg(np.arctan2(vectors[..., 2], np.hypot(vectors[..., 0], vectors[..., 1])))
+    return azi, ele
+
+
+def great_circle_error(azi_target, ele_target, azi_response, ele_response):
+    """
+    Angle (in degree) between target and response direction measured along the great
+    circle that connects them. Unlike the euclidean distance between (azimuth, elevation)
+    pairs this does not overestimate azimuth errors at high elevations.
+    """
+    target, response = to_cartesian(azi_target, ele_target), to_cartesian(azi_response, ele_response)
+    cross = np.linalg.norm(np.cross(target, response), axis=-1)
+    dot = (target * response).sum(axis=-1)
+    return np.rad2deg(np.arctan2(cross, dot))  # numerically stable for small and large angles
+
+
+def mean_direction(azi, ele, axis=-1):
+    """
+    Compute the mean direction by adding up the unit vectors of all directions along axis.
+    Returns:
+        numpy.ndarray: azimuth of the mean direction
+        numpy.ndarray: elevation of the mean direction
+        numpy.ndarray: length of the mean resultant vector, between 0 (uniformly spread) and 1 (identical)
+    """
+    vectors = to_cartesian(azi, ele)
+    axis = axis if axis >= 0 else axis - 1  # the cartesian coordinates are the last axis
+    resultant = vectors.mean(axis=axis)
+    mean_azi, mean_ele = to_spherical(resultant)
+    return mean_azi, mean_ele, np.linalg.norm(resultant, axis=-1)
+
+
+def spherical_variance(azi, ele, axis=-1):
+    """Spherical variance, i.e. one minus the length of the mean resultant vector. It is 0 if all
+    directions are identical and approaches 1 if the directions are uniformly distributed."""
+    return 1 - mean_direction(azi, ele, axis=axis)[2]
+
+
+def mirror_front_back(azi):
+    """Mirror azimuth at the frontal plane (e.g. 30 -> 150, -170 -> -10)."""
+    return (180 - np.asarray(azi, dtype=float) + 180) % 360 - 180
+
+
+def front_back_error(azi_target, ele_target, azi_response, ele_response):
+    """
+    Great circle error that is corrected for front/back confusions. If the response, mirrored
+    at the frontal plane, is closer to the target than the response itself, the trial counts
+    as a front/back confusion and the error of the mirrored response is used.
+    Returns:
+        numpy.ndarray: great circle error after correcting confusions
+        numpy.ndarray of bool: True for trials that were front/back confusions
+    """
+    error = great_circle_error(azi_target, ele_target, azi_response, ele_response)
+    mirrored_error = great_circle_error(azi_target, ele_target, mirror_front_back(azi_response), ele_response)
+    confusion = mirrored_error < error
+    return np.where(confusion, mirrored_error, error), confusion
+
+
+def bootstrap_ci(statistic, *arrays, n_resamples=1000, ci=95, chunk_size=1000, n_jobs=None, seed=None):
+    """
+    Compute a bootstrapped confidence interval of statistic, see resampling.bootstrap.
+    Args:
+        statistic (callable): vectorized function that is called with arrays whose first axis are the
+            resamples and second axis the trials and returns one value per resample. Must be defined
+            at module level, so it can be sent to the worker processes
+        *arrays (numpy.ndarray): data, all arrays must have the same number of trials
+        n_resamples (int): number of bootstrap resamples
+        ci (float): width of the confidence interval in percent
+        chunk_size (int): number of resamples that are computed at once
+        n_jobs (None | int): number of worker processes, if None use one per CPU, if 1 don't use a process pool
+        seed (None | int): seed for the random number generator, makes the result reproducible
+    Returns:
+        float: statistic of the original data
+        float: lower bound of the confidence interval
+        float: upper bound of the confidence interval
+    """
+    distribution, _ = resampling.bootstrap(statistic, *arrays, n_resamples=n_resamples, chunk_size=chunk_size,
+                                           n_jobs=n_jobs, seed=seed)
+    low, high = np.percentile(distribution, [(100 - ci) / 2, 100 - (100 - ci) / 2])
+    return resampling.apply_statistic(statistic, arrays), low, high
+
+
+def mean_error(azi_target, ele_target, azi_response, ele_response):
+    """Mean great circle error across trials (the second axis), can be used as statistic for bootstrap_ci."""
+    return great_circle_error(azi_target, ele_target, azi_response, ele_response).mean(axis=1)
@@ -0,0 +1,138 @@
+"""
+A library of stimuli that is stored on disk and memory-mapped, so that large sets of sounds
+(e.g. hundreds of binaural recordings) don't have to be kept in memory. All samples are
+stored in one float32 file and a small csv table indexes the stimuli by name, version and,
+for equalized variants, by speaker.
+"""
+import datetime
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import slab
+
+INDEX_COLUMNS = ["name", "version", "speaker", "calibration", "samplerate", "nchannels", "nsamples", "offset",
+                 "created"]
+
+
+class StimulusLibrary:
+    """
+    Named and versioned stimuli stored in a folder. Opening a library only reads the index and
+    memory-maps the samples, so it takes the same time regardless of the library's size.
+
+    Args:
+        path (str | pathlib.Path): folder of the library, is created if it does not exist
+    Examples:
+    #    >>> library = StimulusLibrary("my_stimuli")
+    #    >>> library.add("noise", slab.Sound.pinknoise(duration=0.5))
+    #    >>> noise = library.get("noise")  # latest version of the sound
+    #    >>> noise_23 = library.equalized("noise", speaker=23)  # equalized for speaker 23, computed only once
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._data_file, self._index_file = self.path / "stimuli.f32", self.path / "index.csv"
+        if self._index_file.exists():
+            self.index = pd.read_csv(self._index_file, keep_default_na=False)
+        else:
+            self.index = pd.DataFrame(columns=INDEX_COLUMNS)
+        self._map()
+
+    def _map(self):
+        """memory-map the samples of all stimuli in the library"""
+        n_samples = self._data_file.stat().st_size // 4 if self._data_file.exists() else 0
+        if n_samples:
+            self._data = np.memmap(self._data_file, dtype=np.float32, mode="r", shape=(n_samples,))
+        else:
+            self._data = np.zeros(0, dtype=np.float32)
+
+    def __contains__(self, name):
+        return name in self.index["name"].values
+
+    def __len__(self):
+        return len(self.index)
+
+    def add(self, name, sound, version=None, speaker=-1, calibration=""):
+        """
+        Add a stimulus to the library.
+
+        Args:
+            name (str): name of the stimulus
+            sound (slab.Sound): the stimulus, can have several channels
+            version (None | int): version of the stimulus, if None increment the latest version by one
+            speaker (int): index number of the speaker the stimulus was equalized for, -1 if not equalized
+            calibration (str): identifier of the equalization that was applied
+        Returns:
+            int: the version of the added stimulus
+        """
+        sound = slab.Sound(sound)
+        if version is None:
+            versions = self.index.loc[(self.index["name"] == name) & (self.index["speaker"] == -1), "version"]
+            version = int(versions.max()) + 1 if len(versions) else 0
+        offset = len(self._data)
+        data = np.ascontiguousarray(sound.data, dtype=np.float32)
+        self._data = None  # release the memory map before the file grows
+        with open(self._data_file, "ab") as f:  # write the samples first, so the index never points to missing data
+            f.write(data.tobytes())
+        row = pd.DataFrame([[name, version, speaker, calibration, sound.samplerate, sound.nchannels, sound.nsamples,
+                             offset, datetime.datetime.now().isoformat()]], columns=INDEX_COLUMNS)
+        row.to_csv(self._index_file, mode="a", header=not self._index_file.exists(), index=False)
+        self.index = pd.concat([self.index, row], ignore_index=True)
+        self._map()
+        return version
+
+    def _find(self, name, version=None, speaker=-1, calibration=""):
+        """return the index entry for a stimulus or None if it doesn't exist"""
+        entries = self.index[(self.index["name"] == name) & (self.index["speaker"] == speaker) &
+                             (self.index["calibration"].astype(str) == calibration)]
+        if version is None:
+            if speaker == -1:  # the latest version
+                version = entries["version"].max()
+            else:  # equalized variant of the latest version
+                version = self.index.loc[(self.index["name"] == name) & (self.index["speaker"] == -1), "version"].max()
+        entries = entries[entries["version"] == version]
+        if len(entries) == 0:
+            return None
+        return entries.iloc[-1]
+
+    def get_data(self, name, version=None, speaker=-1, calibration=""):
+        """Return the samples of a stimulus as a read-only view of the memory map with shape (nsamples, nchannels)."""
+        entry = self._find(name, version, speaker, calibration)
+        if entry is None:
+            raise ValueError(f"Stimulus {name} (version {version}, speaker {speaker}) is not in the library!")
+        start, n = int(entry.offset), int(entry.nsamples) * int(entry.nchannels)
+        return self._data[start:start + n].reshape(int(entry.nsamples), int(entry.nchannels)), int(entry.samplerate)
+
+    def get(self, name, version=None):
+        """Return a stimulus as slab.Sound. If version is None, return the latest version."""
+        data, samplerate = self.get_data(name, version)
+        return slab.Sound(np.array(data), samplerate=samplerate)
+
+    def equalized(self, name, speaker, version=None):
+        """
+        Return the stimulus equalized for a speaker (see main.apply_equalization). The equalized
+        variant is computed when it is requested for the first time and then stored in the library.
+        Variants are stored together with the equalization file they were computed with and
+        computed again when the setup is recalibrated.
+        """
+        from freefield import main
+        calibration = _calibration_id(main.EQUALIZATIONFILE)
+        if version is None:
+            latest = self._find(name)
+            if latest is None:
+                raise ValueError(f"Stimulus {name} is not in the library!")
+            version = latest.version
+        entry = self._find(name, version, speaker, calibration)
+        if entry is None:
+            sound = main.apply_equalization(self.get(name, version), int(speaker))
+            self.add(name, sound, version=version, speaker=int(speaker), calibration=calibration)
+        data, samplerate = self.get_data(name, version, speaker, calibration)
+        return slab.Sound(np.array(data), samplerate=samplerate)
+
+
+def _calibration_id(equalization_file):
+    """identify a calibration by the name and modification time of its file"""
+    equalization_file = Path(equalization_file)
+    if not equalization_file.is_file():
+        return "uncalibrated"
+    return f"{equalization_file.name}_{int(equalization_file.stat().st_mtime)}"
@@ -0,0 +1,34 @@
+# Compare the speed and accuracy of the two ways of speeding up the pose estimation:
+# downsampling the whole image (old approach) versus only running the face
+# detection on a downsampled image and detecting landmarks at full resolution
+import time
+import os
+import cv2
+import numpy as np
+from freefield import DIR, PoseEstimator, Cameras
+
+model = PoseEstimator(threshold=.9)
+images = [cv2.imread(str(DIR/"tests"/"images"/f))[:, :, 0] for f in sorted(os.listdir(DIR/"tests"/"images"))]
+n_reps = 5
+
+
+def run(estimate):
+    poses, start = [], time.perf_counter()
+    for _ in range(n_reps):
+        poses = [estimate(image) for image in images]
+    duration = (time.perf_counter() - start) / (n_reps * len(images))
+    return np.array(poses, dtype=float), duration
+
+
+reference, t_full = run(lambda image: model.pose_from_image(image))
+print(f"full resolution: {t_full*1000:.1f} ms per image")
+for resolution in [.8, .5, .25]:
+    downsampled, t_down = run(
+        lambda image: model.pose_from_image(Cameras.change_image_res(image, resolution)))
+    multires, t_multi = run(
+        lambda image: model.estimate_pose(image, detection_scale=resolution)[0:2])
+    for name, poses, duration in [("downsampled image", downsampled, t_down),
+                                  ("downsampled detection", multires, t_multi)]:
+        error = np.nanmean(np.abs(poses - reference), axis=0)
+        print(f"{name} at resolution {resolution}: {duration*1000:.1f} ms per image, "
+              f"mean deviation from full resolution: azimuth {error[0]:.2f}, elevation {error[1]:.2f} degree")
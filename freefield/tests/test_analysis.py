@@ -1,6 +1,7 @@
 from freefield import main, DIR, analysis
 from freefield.tests.test_camera import VirtualCam
 import pandas as pd
+import numpy as np
 # generate some data:
 main.initialize_setup(setup="dome", default_mode="play_rec", camera_type=None)
 targets = main.TABLE.sample(10)
@@ -16,4 +17,18 @@ def test_get_loctest_data():
     pass
 
 def test_gain():
-    pass
\ No newline at end of file
+    pass
+
+def test_localization_metrics():
+    data = pd.concat([analysis.get_loctest_data(sequence).assign(subject="s1", session=i) for i in range(2)])
+    speakers, sessions = analysis.localization_metrics(data)
+    assert len(sessions) == 2 and (sessions.n == len(sequence.trials)).all()
+    assert len(speakers) == 2 * len(targets)
+    assert (speakers.n == 5).all()  # n_reps
+    # compare to the metrics for a single speaker
+    first = data[data.session == 0]
+    speaker = first.index_number.iloc[0]
+    array = np.column_stack([np.zeros(len(first)), first.index_number, first.azi_response, first.ele_response])
+    row = speakers[(speakers.session == 0) & (speakers.index_number == speaker)].iloc[0]
+    assert np.isclose(row.mad, analysis.mad(array, speaker))
+    assert np.isclose(row.rmse, analysis.rmse(array, speaker))
@@ -0,0 +1,41 @@
+import types
+import numpy as np
+import pandas as pd
+import slab
+from freefield import binaural
+
+samplerate = 48828
+# a simple HRTF whose impulse responses are delayed pulses, the delay encodes the source
+azimuths = np.arange(0, 360, 30)
+sources = np.column_stack([azimuths, np.zeros(len(azimuths)), np.ones(len(azimuths))])
+filters = []
+for i in range(len(azimuths)):
+    hrir = np.zeros((64, 2))
+    hrir[i, 0], hrir[i + 1, 1] = 1, 0.5
+    filters.append(types.SimpleNamespace(data=hrir))
+hrtf = types.SimpleNamespace(data=filters, sources=sources, samplerate=samplerate, datatype="FIR")
+speakers = pd.DataFrame({"index_number": [3, 7], "azi": [-30., 60.], "ele": [0., 0.]})
+source = slab.Sound(np.random.default_rng(0).normal(size=1000), samplerate=samplerate)
+
+
+def test_convolve():
+    hrirs = np.random.default_rng(1).normal(size=(3, 64, 2))
+    rendered = binaural.convolve(hrirs, source.data[:, 0])
+    assert rendered.shape == (3, 1000 + 63, 2)
+    assert np.allclose(rendered[1, :, 0], np.convolve(source.data[:, 0], hrirs[1, :, 0]))
+
+
+def test_render_binaural(tmp_path):
+    signals = binaural.render_binaural(source, hrtf, speakers)
+    assert set(signals.keys()) == {3, 7}
+    # -30 degree (left) is 30 degree in the HRTF, 60 degree (right) is 300 degree
+    assert np.allclose(signals[3].data[1:1001, 0], source.data[:, 0])
+    assert np.allclose(signals[3].data[2:1002, 1], 0.5 * source.data[:, 0])
+    assert np.allclose(signals[7].data[10:1010, 0], source.data[:, 0])
+    cached = binaural.render_binaural(source, hrtf, speakers, n_jobs=2, cache_dir=tmp_path)
+    assert len(list(tmp_path.glob("*.npy"))) == 2
+    again = binaural.render_binaural(source, hrtf, speakers, cache_dir=tmp_path)
+    assert np.allclose(again[7].data, cached[7].data) and np.allclose(again[7].data, signals[7].data)
+    subset = binaural.render_binaural(source, hrtf, speakers.iloc[1:], cache_dir=tmp_path)
+    assert len(list(tmp_path.glob("*.npy"))) == 2  # the same position is cached independent of the other speakers
+    assert np.allclose(subset[7].data, signals[7].data)
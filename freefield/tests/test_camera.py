@@ -1,8 +1,9 @@
 import numpy as np
-from freefield import DIR, Cameras
+from freefield import DIR, Cameras, camera
 import cv2
 import os
 import pandas as pd
+import pytest
 
 
 class VirtualCam(Cameras):
@@ -52,3 +53,50 @@ def test_calibration():
     assert all(pose.frame == "world")
     pose = cam.get_headpose(convert=True, average=True, n=5, resolution=.8)
     assert len(pose) == 2 and isinstance(pose, tuple)
+
+
+def test_fuse_poses():
+    pose = pd.DataFrame({"azi": [10., 10.5, 9.5, 10., 60.], "ele": [-5., -5.5, -4.5, -5., 30.],
+                         "cam": [0, 0, 1, 1, 1], "confidence": [.99, .95, .98, .97, .99],
+                         "error": [2., 2., 2., 2., 2.]})
+    fused = camera.fuse_poses(pose)
+    assert fused.n == 4 and fused.n_rejected == 1  # the last estimate is an outlier
+    assert abs(fused.azi - 10) < 0.5 and abs(fused.ele + 5) < 0.5
+    assert fused.azi_sem > 0 and fused.ele_sem > 0
+    # estimates with a large reprojection error contribute less
+    pose.loc[0, "error"], pose.loc[1, "error"] = 50., 1.
+    assert camera.fuse_poses(pose).azi > fused.azi
+
+
+def test_adaptive_headpose():
+    cam = VirtualCam()
+    pose = cam.get_headpose(convert=False, average=True, uncertainty=True, n=5, tolerance=100)
+    assert pose.n_frames == 2  # two images are enough for such a large tolerance
+    pose = cam.get_headpose(convert=False, average=False, n=5, tolerance=0)
+    assert pose.image.max() == 4  # tolerance can't be met so the maximum is used
+
+
+def test_record_and_replay(tmp_path):
+    cam = VirtualCam()
+    cam.record(tmp_path/"session", n=3)
+    replay = camera.ReplayCams(tmp_path/"session.npy", loop=True)
+    assert replay.imsize == cam.imsize and replay.ncams == cam.ncams and replay.n_frames == 3
+    images = replay.acquire_images(n=4)  # the fourth image is the first one again
+    assert images.shape == tuple(cam.imsize) + (4, 1)
+    assert (images[:, :, 0, :] == images[:, :, 3, :]).all()
+    pose = replay.get_headpose(convert=False, average=False, n=2)
+    assert len(pose) == 2
+    replay = camera.ReplayCams(tmp_path/"session.npy", loop=False)
+    replay.acquire_images(n=3)
+    with pytest.raises(ValueError):
+        replay.acquire_images(n=1)
+
+
+def test_webcams_without_frames():
+    class Reader:  # a webcam that never delivers a frame
+        def get_frame(self, newer_than=0, timeout=1.0):
+            return None, None, None
+    cams = camera.WebCams.__new__(camera.WebCams)
+    cams.cams, cams.ncams, cams._last_frames = [Reader()], 1, [0]
+    with pytest.raises(ValueError):
+        cams.acquire_images(n=2)
@@ -0,0 +1,88 @@
+import numpy as np
+import pandas as pd
+import slab
+from freefield import equalization
+
+samplerate = 48828
+rng = np.random.default_rng(0)
+speakers = pd.DataFrame({"index_number": [0, 1, 2, 3], "azi": [-17.5, 0., 17.5, 35.], "ele": [0., 0., 0., 0.]})
+noise = slab.Sound.whitenoise(duration=0.1, samplerate=samplerate).data[:, 0]
+recordings = np.stack([noise * gain for gain in [0.5, 1., 2., 1e-6]])  # the last speaker is broken
+
+
+def test_level_equalization():
+    factors, levels, valid = equalization.level_equalization(recordings, 1, 20, samplerate)
+    assert (valid == [True, True, True, False]).all()
+    assert factors[1] == 1 and factors[3] == 1
+    assert factors[0] > 1 > factors[2]
+    assert np.allclose(levels[:3] * factors[:3], levels[1])
+
+
+def test_equalize():
+    lowpassed = slab.Filter.band(frequency=4000, kind="lp", samplerate=samplerate).apply(
+        slab.Sound(noise, samplerate=samplerate)).data[:, 0]
+    frequency_recordings = np.stack([noise, noise, lowpassed, noise * 1e-6])
+    calibration, diagnostics = equalization.equalize(recordings, frequency_recordings, speakers, 1, samplerate,
+                                                     db_thresh=20)
+    assert list(calibration.keys()) == ["0", "1", "2", "3"]
+    assert list(diagnostics.index_number) == [0, 1, 2, 3]
+    assert diagnostics.valid.tolist() == [True, True, True, False]
+    # the filter of the lowpassed speaker boosts high frequencies, the target's filter is flat
+    frequencies, tf = calibration["2"]["filter"].tf(show=False)
+    band = (frequencies > 6000) & (frequencies < 12000)
+    assert tf[band].mean() > 3
+    assert np.abs(calibration["1"]["filter"].tf(show=False)[1][band]).max() < 1
+
+
+def test_stored_recordings(tmp_path):
+    frequency_recordings = recordings * [[2], [1], [0.5], [1]]
+    parameters = dict(target_speaker=1, db_thresh=20, bandwidth=1/10, low_cutoff=200, high_cutoff=16000, alpha=1.0)
+    equalization.save_recordings(tmp_path, recordings, frequency_recordings, speakers, samplerate, **parameters)
+    level, frequency, stored_speakers, meta = equalization.load_recordings(tmp_path)
+    assert isinstance(level, np.memmap) and np.allclose(frequency, frequency_recordings)
+    assert meta["samplerate"] == samplerate and meta["parameters"]["db_thresh"] == 20
+    calibration, diagnostics = equalization.equalize_recordings(tmp_path)
+    assert np.allclose(diagnostics.level_factor, equalization.level_equalization(recordings, 1, 20, samplerate)[0])
+    _, diagnostics = equalization.equalize_recordings(tmp_path, db_thresh=200)
+    assert not diagnostics.valid.any()
+    results = equalization.sweep(tmp_path, {"bandwidth": [1/5, 1/10], "alpha": [0.5, 1.0]}, n_jobs=1)
+    assert len(results) == 4 and set(results.columns) == {"bandwidth", "alpha", "max_range", "mean_range"}
+    assert (np.diff(results.max_range) >= 0).all()
+    results = equalization.sweep(tmp_path, {"db_thresh": [200]}, n_jobs=1)  # no speaker is above the threshold
+    assert results.max_range.isna().all()
+
+
+def test_minimum_phase():
+    fir = slab.Filter.band(frequency=(500, 4000), kind="bp", length=512, samplerate=samplerate, fir=True)
+    minimum = equalization.minimum_phase(fir.data)
+    assert minimum.shape == fir.data.shape
+    frequencies = np.fft.rfftfreq(8192, 1 / samplerate)
+    band = (frequencies > 600) & (frequencies < 3500)
+    magnitude, original_magnitude = [np.abs(np.fft.rfft(f, 8192))[band] for f in [minimum[:, 0], fir.data[:, 0]]]
+    assert np.abs(20 * np.log10(magnitude / original_magnitude)).max() < 0.1
+    energy = np.cumsum(minimum[:, 0]**2) / np.sum(minimum[:, 0]**2)
+    original_energy = np.cumsum(fir.data[:, 0]**2) / np.sum(fir.data[:, 0]**2)
+    assert np.argmax(energy > 0.9) < np.argmax(original_energy > 0.9)  # energy is concentrated at the start
+
+
+def test_compact_filter():
+    lowpassed = slab.Filter.band(frequency=4000, kind="lp", samplerate=samplerate).apply(
+        slab.Sound(noise, samplerate=samplerate)).data[:, 0]
+    filter_bank, _ = equalization.frequency_equalization(np.stack([noise, lowpassed]), 0, 20, samplerate)
+    filt = filter_bank.channel(1)
+    compact, error = equalization.compact_filter(filt, tolerance=1.0)
+    assert error <= 1.0
+    assert len(compact.data) < len(filt.data)
+    loose, _ = equalization.compact_filter(filt, tolerance=3.0)
+    assert len(loose.data) <= len(compact.data)
+
+
+def test_dsp_coefficients():
+    lowpassed = slab.Filter.band(frequency=4000, kind="lp", samplerate=samplerate).apply(
+        slab.Sound(noise, samplerate=samplerate)).data[:, 0]
+    filter_bank, _ = equalization.frequency_equalization(np.stack([noise, lowpassed]), 0, 20, samplerate)
+    filt = filter_bank.channel(1)
+    coefficients = equalization.dsp_coefficients(filt, 512)
+    assert coefficients.shape == (512,)
+    assert equalization.dsp_deviation(filt, coefficients) < \
+        equalization.dsp_deviation(filt, np.eye(1, 512)[0])  # closer than not filtering at all
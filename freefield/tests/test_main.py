@@ -1,7 +1,12 @@
-from freefield import main, DIR
+from freefield import main, DIR, sessions, camera, equalization, timeline
+import tempfile
+import time
+import copy
+from pathlib import Path
 import numpy as np
 import os
 import unittest
+from unittest import mock
 import pandas as pd
 import slab
 from freefield.tests.test_camera import VirtualCam
@@ -9,7 +14,18 @@ main.initialize_setup(setup="dome", default_mode="play_rec", camera_type=None)
 # TODO: test arc as well!
 cam = VirtualCam()
 cam.calibrate(pd.read_csv(DIR / "tests" / "coordinates.csv"), plot=False)
-main.Cameras = cam
+main.CAMERAS = cam
+
+
+class StraightCam(camera.Cameras):
+    """camera that always sees the head pointing straight ahead, for tests that don't need the pose model"""
+    def __init__(self):
+        self.calibration, self.ncams, self.timestamps = None, 1, None
+
+    def get_headpose(self, convert=True, average=True, n=1, tolerance=None, **kwargs):
+        if average:
+            return 0., 0.
+        return pd.DataFrame({"image": np.arange(n), "cam": 0, "azi": 0., "ele": 0., "confidence": 1., "error": 1.})
 
 
 class TestMainMethods(unittest.TestCase):
@@ -57,12 +73,70 @@ class TestMainMethods(unittest.TestCase):
                 for speaker in speakers:
                     main.set_signal_and_speaker(signal, speaker, proc)
 
+    def test_compile_trial_plan(self):
+        targets = main.TABLE.head()
+        seq = slab.Trialsequence([targets.loc[i] for i in targets.index], 2, kind="non_repeating")
+        stimuli, speakers = main.compile_trial_plan(seq, duration=.5)
+        assert stimuli.shape == (len(seq.trials), int(.5 * 48828)) and stimuli.dtype == np.float32
+        assert [s.index_number for s in speakers] == [seq.conditions[t - 1].index_number for t in seq.trials]
+        for stimulus, speaker in zip(stimuli, speakers):
+            main.write_signal(stimulus, speaker)
+
     def test_get_recording_delay(self):
         delay = main.get_recording_delay()
         assert delay == 227
         delay = main.get_recording_delay(play_from="RX8", rec_from="RP2")
         assert delay == 316
 
+    def test_measure_recording_delay(self):
+        sig = slab.Sound.chirp(duration=0.05, from_frequency=200, to_frequency=16000)
+        recordings = np.zeros((3, sig.nsamples + 500))
+        for i, delay in enumerate([10, 316, 480]):
+            recordings[i, delay:delay + sig.nsamples] = sig.data[:, 0]
+        assert (main.estimate_delay(sig.data[:, 0], recordings, max_delay=500) == [10, 316, 480]).all()
+        equalization = copy.deepcopy(main.EQUALIZATIONDICT)
+        try:
+            delays = main.measure_recording_delay(speakers=[4, 16], save=False)
+            assert list(delays.index) == [4, 16]
+            assert main.EQUALIZATIONDICT["4"]["delay"] == delays[4]
+            rec = main.play_and_record(4, sig)
+            assert rec.nsamples == sig.nsamples
+        finally:  # the measured delays must not leak into other tests
+            main.initialize_setup(setup="dome", default_mode="play_rec", camera_type=None)
+            main.EQUALIZATIONDICT = equalization
+
+    def test_virtual_source(self):
+        signal = slab.Sound.tone(duration=0.1)
+        signals = main.virtual_source(signal, (10, 5), calibrate=False)
+        gains = main.get_virtual_speakers((10, 5))[1][0]
+        assert len(signals) == np.sum(gains > 0)
+        for played, gain in zip(signals.values(), gains[gains > 0]):
+            assert np.allclose(played.data, signal.data * gain)
+
+    def test_dsp_equalization_tables(self):
+        tilt = slab.Filter(np.array([[.8], [.3], [.1]]), samplerate=48828, fir=True)
+        with mock.patch.object(main, "EQUALIZATIONDICT", {"4": {"level": 1., "filter": tilt}}):
+            tables, report = main.dsp_equalization_tables(n_taps=256)
+            speaker = main.get_speaker(index_number=4).iloc[0]
+            assert set(tables.keys()) == set(main.TABLE.analog_proc.unique())
+            assert tables[speaker.analog_proc].shape[1] == 256
+            assert np.array_equal(tables[speaker.analog_proc][0], np.eye(1, 256)[0])  # row 0 is a unit impulse
+            assert list(report.index_number) == [4]
+            assert main.emulate_dsp_equalization(tables, speakers=[4]).deviation[0] < 1
+            filt = slab.Filter(np.eye(1000, 1)[::-1], fir=True)  # longer than the tables
+            main.EQUALIZATIONDICT["4"]["filter"] = filt
+            with self.assertRaises(ValueError):
+                main.dsp_equalization_tables(n_taps=256)
+
+    def test_self_test(self):
+        assert (main.all_leds().bit.notna()).all() and len(main.all_leds()) == 5
+        report = main.self_test(leds=False)
+        assert list(report.index_number) == list(main.TABLE.index_number) and report.snr.notna().all()
+        assert not report.passed.any()  # the simulated processors record noise, so no probe is detected
+        report = main.self_test(speakers=[4, 23], leds=False)
+        assert list(report.index_number) == [4, 23]
+        main.initialize_setup(setup="dome", default_mode="play_rec", camera_type=None)
+
     def test_check_pose(self):
         assert main.check_pose(var=100) is True
         assert main.check_pose(var=0) is False
@@ -71,11 +145,41 @@ class TestMainMethods(unittest.TestCase):
         targets = main.all_leds()
         coords = main.calibrate_camera(targets, n_reps=1, n_images=1)
 
+    def test_loctest_trial_times(self):
+        trial = main.TABLE.loc[0]
+        seq = slab.Trialsequence([trial], n_reps=1)
+        next(seq)
+        trigger_time = time.monotonic()
+        session, tl = mock.Mock(), mock.Mock()
+        tl.mark_trial.return_value = {"trigger_time": trigger_time, "button_time": np.nan}  # button counter invalid
+        with mock.patch.object(main, "play_and_wait_for_button"), mock.patch.object(main, "CAMERAS") as cams:
+            cams.get_headpose.return_value = None
+            main._loctest_trial(trial, seq, visual=False, n_images=1, session=session, timeline=tl, player="RX81")
+        onset, response_time = session.add_trial.call_args[0][3:5]
+        assert onset == trigger_time and 0 <= response_time - onset < 1  # both on the monotonic clock
+
     def test_localization_test_freefield(self):
         targets = main.TABLE.head()
         seq = main.localization_test_freefield(targets=targets, duration=.8, n_reps=1, n_images=5, visual=False)
         assert len(seq.trials) == len(seq.data)
 
+    @mock.patch.object(main, "CAMERAS", StraightCam())
+    def test_localization_test_session(self):
+        targets = main.TABLE.head()
+        with tempfile.TemporaryDirectory() as path:
+            seq = main.localization_test_freefield(targets=targets, duration=.8, n_reps=1, n_images=2, visual=False,
+                                                   session=Path(path)/"session")
+            trials, poses = sessions.read_session(Path(path)/"session")
+        assert len(trials) == len(seq.trials)
+        assert (trials.index_number.values == [seq.conditions[t-1].index_number for t in seq.trials]).all()
+
+    @mock.patch.object(main, "CAMERAS", StraightCam())
+    def test_localization_test_timeline(self):
+        targets = main.TABLE.head()
+        with self.assertRaises(ValueError):  # the circuits in data/rcx have no sample counters
+            main.localization_test_freefield(targets=targets, duration=.8, n_reps=1, n_images=1, visual=False,
+                                             timeline=timeline.Timeline(main.PROCESSORS))
+
     def test_localization_test_headphones(self):
         targets = main.TABLE.head()
         signals = [slab.Precomputed(lambda: slab.Binaural([slab.Sound.pinknoise(), slab.Sound.pinknoise()]),
@@ -89,27 +193,41 @@ class TestMainMethods(unittest.TestCase):
         main.initialize_setup(setup="dome", default_mode="play_rec", camera_type=None)
         rec = main.play_and_record(speaker_nr, signal, compensate_delay=True, apply_calibration=True)
 
+    def test_play_and_record_repetitions(self):
+        signal = slab.Sound.whitenoise(duration=0.1)
+        rec = main.play_and_record(23, signal, n_repetitions=5, gap=0.02)
+        assert rec.nsamples == signal.nsamples
+        rec = main.play_and_record(23, signal, n_repetitions=5, average="median")
+        assert rec.nsamples == signal.nsamples
+        period = signal.nsamples + 100
+        train = np.zeros((5 * period, 1))
+        for i in range(5):
+            train[i * period:i * period + signal.nsamples] = signal.data + i
+        average = main.average_repetitions(train, 5, signal.nsamples)
+        assert np.allclose(average, signal.data + 2)
+
     def test_level_equalization(self):
         signal = slab.Sound.chirp(duration=0.05, from_frequency=100, to_frequency=20000)
         speaker_list = main.TABLE
-        target_speaker = 23
+        target = main._target_row(speaker_list, 23)
         db_thresh = 80
-        lvls = main._level_equalization(signal, speaker_list, target_speaker, db_thresh)
+        recordings = main._record_speakers(signal, speaker_list)
+        lvls, recorded, valid = equalization.level_equalization(recordings, target, db_thresh, signal.samplerate)
         assert len(lvls) == len(speaker_list)
-        assert lvls[23] == 1
+        assert lvls[target] == 1
 
     def test_frequency_equalization(self):
         signal = slab.Sound.chirp(duration=0.05, from_frequency=100, to_frequency=20000)
         speaker_list = main.TABLE
-        target_speaker = 23
+        target = main._target_row(speaker_list, 23)
         db_thresh = 80
-        bandwidth = 1 / 10
-        low_cutoff = 200
-        high_cutoff = 16000
-        alpha = 1.0
-        lvls = main._level_equalization(signal, speaker_list, target_speaker, db_thresh)
-        filter_bank = main._frequency_equalization(signal, speaker_list, target_speaker, lvls, bandwidth,
-                                                   low_cutoff, high_cutoff, alpha, db_thresh)
+        recordings = main._record_speakers(signal, speaker_list)
+        lvls = equalization.level_equalization(recordings, target, db_thresh, signal.samplerate)[0]
+        recordings = main._record_speakers(signal, speaker_list, lvls)
+        filter_bank, notch_depth = equalization.frequency_equalization(recordings, target, db_thresh, signal.samplerate,
+                                                                       bandwidth=1 / 10, low_cutoff=200,
+                                                                       high_cutoff=16000, alpha=1.0)
+        assert filter_bank.nchannels == len(notch_depth) == len(speaker_list)
 
     def test_equalize_speakers(self):
         n_files = len(os.listdir(DIR / "data" / "log"))
@@ -1,4 +1,8 @@
-from freefield import Processors
+from freefield import Processors, DIR
+import numpy as np
+import pytest
+
+RCX = DIR / "data" / "rcx"
 
 
 def test_devices():
@@ -13,3 +17,17 @@ def test_devices():
     assert processors.write("tag", 1, procs=['RX81', 'RX82']) == 1
     processors.write(["tag1", "tag2", "tag3"], [1, 2, 3],
                    procs=[['RX81', 'RX82'], ['RP2'], ['RX81']])
+
+
+def test_missing_circuit():
+    processors = Processors()
+    with pytest.raises(FileNotFoundError):
+        processors.initialize(["RX81", "RX8", RCX / "missing.rcx"])
+
+
+def test_write_several_tags():
+    processors = Processors()
+    processors.initialize_default("play_rec")
+    assert processors.write(["chan", "playbuflen"], [1, 1000], [["RX81", "RX82"], "RP2"]) == 1
+    with pytest.raises(ValueError):
+        processors.write(["data", "chan"], [0, 1], procs="RX81")
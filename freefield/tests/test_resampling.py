@@ -0,0 +1,36 @@
+import numpy as np
+from scipy import stats
+from freefield import resampling
+
+rng = np.random.default_rng(0)
+ele_target = rng.choice([-37.5, -12.5, 12.5, 37.5], 100)
+ele_response = 0.7 * ele_target + rng.normal(0, 5, 100)
+
+
+def test_statistics():
+    gain = resampling.apply_statistic(resampling.eg, [ele_target, ele_response])
+    assert np.isclose(gain, stats.linregress(ele_target, ele_response).slope)
+    zeros = np.zeros(100)
+    assert np.isclose(resampling.apply_statistic(resampling.rmse_to_target, [zeros, ele_target, zeros, ele_response]),
+                      np.sqrt(((ele_response - ele_target)**2).mean()))
+
+
+def test_bootstrap():
+    distribution, timings = resampling.bootstrap(resampling.eg, ele_target, ele_response, n_resamples=2500,
+                                                 chunk_size=1000, n_jobs=2, seed=1)
+    assert len(distribution) == 2500 and len(timings) == 3
+    assert 0.6 < distribution.mean() < 0.8
+    # the result does not depend on the number of workers
+    same, _ = resampling.bootstrap(resampling.eg, ele_target, ele_response, n_resamples=2500,
+                                   chunk_size=1000, n_jobs=1, seed=1)
+    assert (same == distribution).all()
+
+
+def test_permutation_test():
+    other_response = 0.2 * ele_target + rng.normal(0, 5, 100)
+    observed, p, differences, _ = resampling.permutation_test(
+        resampling.eg, [ele_target, ele_response], [ele_target, other_response], n_permutations=999, n_jobs=1, seed=0)
+    assert observed > 0.3 and p < 0.01 and len(differences) == 999
+    observed, p, _, _ = resampling.permutation_test(
+        resampling.eg, [ele_target, ele_response], [ele_target, ele_response], n_permutations=999, n_jobs=1, seed=0)
+    assert observed == 0 and p == 1
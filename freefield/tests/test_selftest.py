@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+from freefield import selftest
+import pytest
+
+samplerate, n_samples = 48828, 12207
+
+
+def test_probes():
+    bins = selftest.probe_bins(4, n_samples, samplerate)
+    assert bins.shape[0] == 4 and len(np.unique(bins)) == bins.size
+    probes = selftest.probes(bins, n_samples, samplerate, ramp_duration=0)
+    assert np.allclose(np.sqrt(np.mean(probes**2, axis=1)), 1)
+    power = np.abs(np.fft.rfft(probes, axis=1))**2
+    for probe_bins, probe_power in zip(bins, power):  # all energy is in the probe's own bins
+        assert probe_power[probe_bins].sum() == pytest.approx(probe_power.sum())
+    with pytest.raises(ValueError):
+        selftest.probe_bins(100, 100, samplerate)
+
+
+def test_detect():
+    bins = selftest.probe_bins(4, n_samples, samplerate)
+    probes = selftest.probes(bins, n_samples, samplerate)
+    noise = np.random.default_rng(0).normal(scale=1e-3, size=(2, n_samples))
+    # the third speaker is broken and the last one is 10 dB quieter
+    recordings = np.stack([probes[0] + probes[1] + 0.316 * probes[3], probes[2]]) + noise
+    level, snr = selftest.detect(recordings, np.stack([bins, bins]))
+    assert level.shape == snr.shape == (2, 4)
+    assert np.allclose(level[0, [0, 1, 3]], [0, 0, -10], atol=0.2)
+    assert (snr[0, [0, 1, 3]] > 40).all() and snr[0, 2] < 10
+    speakers = pd.DataFrame({"index_number": [1, 2, 3, 4], "azi": 0, "ele": 0})
+    report = selftest.report(speakers, level[0], snr[0], [True, True, True, False])
+    assert list(report.passed) == [True, True, False, True]
+    assert np.isnan(report.level_deviation[3])
+
+
+def test_led_visible():
+    rng = np.random.default_rng(1)
+    reference = rng.integers(0, 50, (40, 60, 2, 2))
+    images = np.stack([reference, reference.copy()])
+    images[1, 10:15, 20:25, :, 1] += 100  # LED seen by the second camera
+    increase, visible = selftest.led_visible(reference, images)
+    assert list(visible) == [False, True]
@@ -0,0 +1,59 @@
+import asyncio
+import threading
+import numpy as np
+import pandas as pd
+import slab
+import pytest
+from freefield import server
+
+
+def _start(functions=None):
+    srv = server.Server(port=0, functions=functions)
+    loop = asyncio.new_event_loop()
+    ready = threading.Event()
+
+    def run():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(srv.start())
+        ready.set()
+        loop.run_forever()
+    threading.Thread(target=run, daemon=True).start()
+    ready.wait(5)
+    return srv
+
+
+def test_encode_decode():
+    sound = slab.Sound.whitenoise(duration=0.1)
+    table = pd.DataFrame({"azi": [0., 17.5], "ele": [-12.5, 0.]})
+    value, attachments = server.encode({"sound": sound, "x": np.arange(5), "table": table, "n": np.int64(3)})
+    decoded = server.decode(value, [a.tobytes() for a in attachments])
+    assert np.allclose(decoded["sound"].data, sound.data) and decoded["sound"].samplerate == sound.samplerate
+    assert (decoded["x"] == np.arange(5)).all() and decoded["n"] == 3
+    assert np.allclose(decoded["table"].values, table.values)
+
+
+def test_client_server():
+    srv = _start({"scale": lambda sound, factor=1: slab.Sound(sound.data * factor, samplerate=sound.samplerate)})
+    sound = slab.Sound.tone(duration=0.2)
+    with server.Client(port=srv.port) as client:
+        scaled = client.scale(sound, factor=2)
+        assert np.allclose(scaled.data, sound.data * 2)
+        with pytest.raises(RuntimeError):
+            client.call("equalize_speakers")  # not exposed
+        stats = client.stats()
+    assert set(stats.function) == {"scale"}
+    assert len(client.latencies) == 3 and all(rtt >= latency for _, rtt, latency in client.latencies)
+
+
+def test_results_that_can_not_be_sent():
+    targets = pd.DataFrame({"index_number": [1, 2], "azi": [0., 17.5], "ele": [0., 0.]})
+    seq = slab.Trialsequence([targets.loc[i] for i in targets.index], n_reps=1)
+    for _ in seq:
+        seq.data[seq.this_n] = (1., 2.)  # a (azimuth, elevation) response like in the localization tests
+    srv = _start({"loctest": lambda: seq, "unknown": lambda: object()})
+    with server.Client(port=srv.port) as client:
+        data = client.loctest()  # trial sequences are sent as tables
+        assert list(data.azi_response) == [1., 1.] and len(data) == 2
+        with pytest.raises(RuntimeError):
+            client.unknown()  # the error is sent to the client and the server keeps running
+        assert len(client.loctest()) == 2
@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+from freefield import sessions, analysis
+
+
+def write_session(path, subject, n_trials=10):
+    with sessions.SessionWriter(path, subject=subject, setup="dome") as writer:
+        for i in range(n_trials):
+            target = pd.Series({"index_number": i % 3, "azi": (i % 3) * 10., "ele": 0.})
+            pose = pd.DataFrame({"azi": [1., 2.], "ele": [3., 4.], "cam": [0, 1], "image": [0, 0],
+                                 "confidence": [.99, .98], "error": [1., 2.]})
+            fused = pd.Series({"azi": 1.5, "ele": 3.5, "azi_sem": .5, "ele_sem": .5, "n_frames": 1})
+            writer.add_trial(i, target, (target.azi + 1, None), onset=i, response_time=i + .5, pose=pose, fused=fused)
+
+
+def test_write_and_read(tmp_path):
+    write_session(tmp_path/"s1", "subject1")
+    trials, poses = sessions.read_session(tmp_path/"s1")
+    assert len(trials) == 10 and len(poses) == 20
+    assert (trials.subject == "subject1").all() and (trials.session == "s1").all()
+    assert np.allclose(trials.rt, .5) and trials.ele_response.isna().all()
+    # appending to an existing session
+    write_session(tmp_path/"s1", "subject1", n_trials=2)
+    assert len(sessions.read_session(tmp_path/"s1")[0]) == 12
+
+
+def test_incomplete_record(tmp_path):
+    write_session(tmp_path/"s1", "subject1")
+    with open(tmp_path/"s1"/"trials.bin", "ab") as f:  # simulate a crash while writing
+        f.write(b"\x00" * (sessions.TRIAL_DTYPE.itemsize // 2))
+    trials, _ = sessions.read_session(tmp_path/"s1")
+    assert len(trials) == 10
+    # resuming the session discards the incomplete record
+    write_session(tmp_path/"s1", "subject1", n_trials=2)
+    trials, _ = sessions.read_session(tmp_path/"s1")
+    assert list(trials.trial) == list(range(10)) + [0, 1] and np.allclose(trials.rt, .5)
+
+
+def test_read_sessions(tmp_path):
+    for i in range(3):
+        write_session(tmp_path/f"session{i}", f"subject{i % 2}")
+    trials, poses = sessions.read_sessions(tmp_path)
+    assert len(trials) == 30 and trials.session.nunique() == 3
+    trials["ele_response"] = 0.
+    speakers, sessions_ = analysis.localization_metrics(trials)
+    assert len(sessions_) == 3 and len(speakers) == 9
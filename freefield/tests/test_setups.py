@@ -0,0 +1,33 @@
+from freefield import main, setups
+
+
+def test_setup_state():
+    table, processors = main.TABLE, main.PROCESSORS
+    dome = setups.Setup("dome", default_mode="play_rec")
+    arc = setups.Setup("arc", default_mode="play_rec")
+    # the state of main is restored after each call
+    assert main.TABLE is table and main.PROCESSORS is processors
+    assert dome.processors is not arc.processors
+    assert dome.equalization_file.name == "calibration_dome.pkl"
+    assert arc.equalization_file.name == "calibration_arc.pkl"
+    # main's functions operate on the setup they are called from
+    assert dome.get_speaker(index_number=10).equals(dome.table[dome.table.index_number == 10])
+    assert arc.get_speaker(index_number=10).equals(arc.table[arc.table.index_number == 10])
+    dome_azi, arc_azi = dome.table.azi.copy(), arc.table.azi.copy()
+    dome.shift_setup(delta_azi=5, delta_ele=0)
+    assert (dome.table.azi == dome_azi + 5).all() and (arc.table.azi == arc_azi).all()
+    assert main.TABLE is table
+    try:
+        dome._record_speakers
+    except AttributeError:
+        pass
+    else:
+        raise AssertionError("private functions of main must not be exposed")
+
+
+def test_run_setups():
+    jobs = [{"setup": {"setup": name, "default_mode": "play_rec"}, "calls": [("get_speaker", (), {"index_number": 3})]}
+            for name in ["dome", "arc"]]
+    dome_results, arc_results = setups.run_setups(jobs)
+    assert dome_results[0].index_number.iloc[0] == 3
+    assert arc_results[0].index_number.iloc[0] == 3
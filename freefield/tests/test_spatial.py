@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+import slab
+from freefield import DIR, spatial
+import pytest
+
+dome = pd.read_csv(DIR / "data" / "tables" / "speakertable_dome.txt")
+arc = pd.read_csv(DIR / "data" / "tables" / "speakertable_arc.txt")
+
+
+def test_triangulate():
+    triangulation = spatial.triangulate(dome)
+    assert spatial.triangulate(dome) is triangulation  # cached
+    # at the position of a speaker, only this speaker is used
+    speakers, gains = triangulation.query(dome.azi.values, dome.ele.values)
+    assert (speakers[np.arange(len(dome)), gains.argmax(axis=1)] == dome.index_number.values).all()
+    assert np.allclose(gains.max(axis=1), 1)
+    # in between, all speakers of the triangle contribute and the energy is constant
+    azi, ele = np.random.default_rng(0).uniform(-35, 35, 100), np.random.default_rng(1).uniform(-25, 25, 100)
+    speakers, gains = triangulation.query(azi, ele)
+    assert speakers.shape == gains.shape == (100, 3)
+    assert np.allclose((gains**2).sum(axis=1), 1)
+    with pytest.raises(ValueError):
+        triangulation.query(120, 0)
+
+
+def test_triangulate_arc():
+    triangulation = spatial.triangulate(arc)
+    speakers, gains = triangulation.query([0, 2.14], [0, 0])
+    assert 23 in speakers[0] and gains[0].max() == pytest.approx(1)
+    assert set(speakers[1]) == {23, 24, -1}
+    assert np.allclose(gains[1, :2], np.sqrt(0.5), atol=0.01)
+
+
+def test_interpolate_equalization():
+    filters = [slab.Filter(np.eye(1, 16, k)[0], samplerate=48828, fir=True) for k in range(3)]
+    calibration = {str(i): {"level": 1 + i / 10, "filter": filters[i]} for i in range(3)}
+    interpolated = spatial.interpolate_equalization(calibration, [0, 2, -1], [np.sqrt(.5), np.sqrt(.5), 0])
+    assert interpolated["level"] == pytest.approx(1.1)
+    assert np.allclose(interpolated["filter"].data[[0, 2], 0], 0.5)
+    calibration["2"]["compact_filter"] = slab.Filter(np.eye(1, 8, 1)[0], samplerate=48828, fir=True)
+    interpolated = spatial.interpolate_equalization(calibration, [0, 2], [np.sqrt(.5), np.sqrt(.5)])
+    assert len(interpolated["filter"].data) == 16  # the compact filter is used and padded
+    assert np.allclose(interpolated["filter"].data[[0, 1], 0], 0.5)
@@ -0,0 +1,36 @@
+import numpy as np
+from freefield import spherical
+
+
+def test_great_circle_error():
+    assert np.isclose(spherical.great_circle_error(0, 0, 30, 0), 30)
+    assert np.isclose(spherical.great_circle_error(0, 0, 0, -45), 45)
+    # close to the pole a large azimuth difference is a small error
+    assert spherical.great_circle_error(0, 80, 90, 80) < 15
+    errors = spherical.great_circle_error(np.zeros((5, 1)), 0, np.arange(4) * 10, 0)
+    assert errors.shape == (5, 4)
+
+
+def test_mean_direction():
+    azi, ele, length = spherical.mean_direction(np.array([170, -170]), np.array([0, 0]))
+    assert np.isclose(np.abs(azi), 180) and np.isclose(ele, 0)  # the linear mean would be 0
+    assert np.isclose(spherical.spherical_variance(np.array([10, 10]), np.array([5, 5])), 0)
+    azi, ele, length = spherical.mean_direction(np.random.uniform(-20, 20, (3, 100)), np.zeros((3, 100)), axis=1)
+    assert azi.shape == (3,) and (length < 1).all()
+
+
+def test_front_back_error():
+    error, confusion = spherical.front_back_error(np.array([20, 20]), np.array([0, 0]),
+                                                  np.array([25, 160]), np.array([0, 0]))
+    assert np.allclose(error, [5, 0]) and (confusion == [False, True]).all()
+
+
+def test_bootstrap_ci():
+    rng = np.random.default_rng(1)
+    target = np.zeros(200)
+    azi, ele = rng.normal(10, 2, 200), rng.normal(0, 2, 200)
+    estimate, low, high = spherical.bootstrap_ci(spherical.mean_error, target, target, azi, ele,
+                                                 n_resamples=500, chunk_size=100, n_jobs=2, seed=0)
+    assert low < estimate < high and high - low < 2
+    assert spherical.bootstrap_ci(spherical.mean_error, target, target, azi, ele,
+                                  n_resamples=500, chunk_size=100, n_jobs=1, seed=0)[1] == low
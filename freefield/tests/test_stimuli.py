@@ -0,0 +1,32 @@
+import numpy as np
+import slab
+import pytest
+from freefield import main, stimuli
+
+main.initialize_setup(setup="dome", default_mode="play_rec", camera_type=None)
+
+
+def test_add_and_get(tmp_path):
+    library = stimuli.StimulusLibrary(tmp_path)
+    noise = slab.Sound.pinknoise(duration=.1)
+    binaural = slab.Binaural([slab.Sound.whitenoise(duration=.2), slab.Sound.whitenoise(duration=.2)])
+    assert library.add("noise", noise) == 0
+    assert library.add("noise", noise) == 1
+    assert library.add("binaural", binaural) == 0
+    library = stimuli.StimulusLibrary(tmp_path)  # reopen from disk
+    assert len(library) == 3 and "noise" in library
+    assert np.allclose(library.get("noise").data, noise.data, atol=1e-6)
+    assert library.get("binaural").nchannels == 2
+    data, samplerate = library.get_data("binaural")
+    assert isinstance(data, np.memmap) and data.shape == (binaural.nsamples, 2)
+    with pytest.raises(ValueError):
+        library.get("tone")
+
+
+def test_equalized(tmp_path):
+    library = stimuli.StimulusLibrary(tmp_path)
+    library.add("noise", slab.Sound.pinknoise(duration=.1))
+    equalized = library.equalized("noise", speaker=23)
+    assert len(library) == 2  # the equalized variant was added ...
+    assert np.allclose(library.equalized("noise", speaker=23).data, equalized.data)
+    assert len(library) == 2  # ... and is only computed once
@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+from freefield import timeline
+
+
+class _Counters:
+    """processors whose sample counters run with a drifting clock"""
+    def __init__(self, rate, start=0.0):
+        self.rate, self.start, self.latched = rate, start, {}
+
+    def read(self, tag, proc):
+        if tag == "sample":
+            return (timeline.time.monotonic() - self.start) * self.rate
+        return self.latched[tag]
+
+
+def test_clock_fit():
+    clock = timeline.ClockFit(samplerate=48828.125)
+    with pytest.raises(ValueError):
+        clock.to_host(0)
+    rate, host = 48828.125 * (1 + 20e-6), 1e5 + np.arange(0, 3600, 60.)
+    for h in host:
+        clock.add(h, (h - 1e5) * rate + 1e9)
+    assert clock.rate == pytest.approx(rate, rel=1e-9)
+    assert clock.drift == pytest.approx(20e-6, rel=1e-3)
+    assert np.abs(clock.residuals(host, (host - 1e5) * rate + 1e9)).max() < 1e-6
+
+
+class _Clock:
+    """host clock that advances by a fixed step every time it is read"""
+    def __init__(self, step=1e-3):
+        self.now, self.step = 0.0, step
+
+    def __call__(self):
+        self.now += self.step
+        return self.now
+
+
+def test_mark_trial(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(timeline.time, "monotonic", clock)
+    rate = 48828.125 * (1 - 50e-6)
+    counters = _Counters(rate)
+    events = {"trigger": ("RP2", "trigsample"), "button": ("RP2", "btnsample")}
+    tl = timeline.Timeline(counters, events=events)
+    for i in range(5):
+        now = counters.read("sample", "RP2")
+        counters.latched = {"trigsample": now, "btnsample": now + rate * 0.4321}
+        record = tl.mark_trial(i, frame_times=np.array([[1., 2.], [3., 4.]]), index_number=23)
+        clock.now += 60  # one trial per minute
+    assert record["rt"] == pytest.approx(0.4321, abs=1e-3)
+    assert record["button_time"] - record["trigger_time"] == pytest.approx(0.4321, abs=1e-3)
+    assert (record["frames_start"], record["frames_end"]) == (1., 4.)
+    data = tl.to_dataframe()
+    assert len(data) == 5 and (data.index_number == 23).all()
+    assert tl.drift()["RP2"] == pytest.approx(-50e-6, abs=1e-6)
+
+
+def test_invalid_counters():
+    counters = _Counters(48828.125, start=timeline.time.monotonic())
+    tl = timeline.Timeline(counters)
+    with pytest.raises(ValueError):  # the processor that played the trial is needed for the end of the playback
+        tl.mark_trial(0)
+    now = counters.read("sample", "RP2")
+    counters.latched = {"trigsample": now, "endsample": now + 100, "btnsample": now - 100}
+    record = tl.mark_trial(0, player="RX81")
+    assert set(tl.clocks) == {"RP2", "RX81"} and record["playback_end_time"] > record["trigger_time"]
+    assert np.isnan(record["button_time"]) and np.isnan(record["rt"])  # the button was pressed before the trigger
+    record = tl.mark_trial(1, player="RX82")  # the counters did not change since the last trial
+    assert np.isnan([record["trigger_time"], record["playback_end_time"], record["button_time"]]).all()
+    counters.read = lambda tag, proc: 0  # the circuit has no counter
+    with pytest.raises(ValueError):
+        timeline.Timeline(counters).sync()
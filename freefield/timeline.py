@@ -0,0 +1,170 @@
+"""
+Sample accurate timing of trial events. The processors latch the value of their sample counter
+when an event happens (e.g. the zBus trigger or a button press) and the host reads these values
+after the trial, so the events don't have to be detected by polling. To convert sample counts
+to host time, the running counter of each processor is read together with the host's monotonic
+clock once per trial and the relation between both clocks (offset and drift) is estimated by a
+linear regression that is updated with every reading.
+The circuits must have a tag with the running sample counter (default "sample") and one tag for
+each event that holds the counter value of the event's last occurrence, see docs/procs.rst. Counters
+that are zero or did not increase (e.g. because the circuit has no such tag) are rejected.
+"""
+import time
+import logging
+import numpy as np
+import pandas as pd
+
+# default events: name -> (processor, tag with the latched sample counter), None is the processor that played the trial
+EVENTS = {"trigger": ("RP2", "trigsample"), "playback_end": (None, "endsample"), "button": ("RP2", "btnsample")}
+
+
+class ClockFit:
+    """
+    Incremental linear regression of a processor's sample counter on host time. The sums are
+    computed relative to the first point, which keeps them numerically stable over long sessions.
+
+    Args:
+        samplerate (float): nominal samplerate, used as long as there are not enough points for a regression
+    """
+
+    def __init__(self, samplerate):
+        self.samplerate = samplerate
+        self.n = 0
+        self.last = None  # the last sample count that was added
+        self._origin = None
+        self._sums = np.zeros(5)  # x, y, xx, xy, yy
+
+    def add(self, host_time, sample):
+        """Add a pair of host time (in seconds) and sample count."""
+        self.last = sample
+        if self._origin is None:
+            self._origin = (host_time, sample)
+        x, y = host_time - self._origin[0], sample - self._origin[1]
+        self._sums += [x, y, x * x, x * y, y * y]
+        self.n += 1
+
+    @property
+    def rate(self):
+        """Estimated samplerate of the processor in samples per second of host time."""
+        if self.n < 2:
+            return self.samplerate
+        sx, sy, sxx, sxy, _ = self._sums
+        variance = sxx - sx * sx / self.n
+        if variance <= 0:
+            return self.samplerate
+        rate = (sxy - sx * sy / self.n) / variance
+        return rate if rate > 0 else self.samplerate
+
+    @property
+    def drift(self):
+        """Relative deviation of the processor's clock from the nominal samplerate (e.g. 1e-5 = 10 ppm)."""
+        return self.rate / self.samplerate - 1
+
+    def to_host(self, sample):
+        """Convert sample counts to host time in seconds (time.monotonic)."""
+        if self._origin is None:
+            raise ValueError("The clock must be synchronized at least once before converting samples!")
+        sx, sy, _, _, _ = self._sums / self.n
+        return self._origin[0] + sx + (np.asarray(sample, dtype=float) - self._origin[1] - sy) / self.rate
+
+    def residuals(self, host_times, samples):
+        """Difference (in seconds) between host times and the times predicted from the samples."""
+        return np.asarray(host_times) - self.to_host(samples)
+
+
+class Timeline:
+    """
+    Collect the times of trial events from the processors' sample counters and the timestamps
+    of the camera frames.
+
+    Args:
+        processors (Processors): the initialized processors
+        events (None | dict): event names with (processor, tag) of the latched counter, if None use EVENTS. If the
+            processor is None, the event is read from the processor that played the trial (see mark_trial)
+        counter_tag (str): tag of the running sample counter on every processor
+        samplerate (float): nominal samplerate of the processors
+    Examples:
+    #    >>> timeline = Timeline(main.PROCESSORS)
+    #    >>> seq = main.localization_test_freefield(targets, timeline=timeline)
+    #    >>> timeline.to_dataframe().rt  # reaction times from the sample counters
+    """
+
+    def __init__(self, processors, events=None, counter_tag="sample", samplerate=48828.125):
+        self.processors = processors
+        self.events = dict(EVENTS if events is None else events)
+        self.counter_tag = counter_tag
+        self.samplerate = samplerate
+        self.clocks = {}  # clock regression of each processor, created when the processor is read the first time
+        self.trials = []
+        self._latched = {}  # counter of each event in the last trial
+
+    def sync(self, procs=None):
+        """Read the sample counter of the processors (if None, all processors with fixed events and all that were
+        read before) and add it to the processor's clock regression. The host time of a reading is the midpoint
+        of the times before and after reading the tag. Raises ValueError if a counter is zero or did not increase."""
+        if procs is None:
+            procs = set(self.clocks) | set(p for p, _ in self.events.values() if p is not None)
+        for proc in procs:
+            clock = self.clocks.setdefault(proc, ClockFit(self.samplerate))
+            before = time.monotonic()
+            sample = float(self.processors.read(self.counter_tag, proc=proc))
+            if sample <= 0 or (clock.last is not None and sample <= clock.last):
+                raise ValueError(f"The sample counter of {proc} did not increase - does the circuit have the tag "
+                                 f"{self.counter_tag}?")
+            clock.add((before + time.monotonic()) / 2, sample)
+
+    def mark_trial(self, trial, player=None, frame_times=None, **info):
+        """
+        Read the latched counters of all events after a trial, convert them to host time and store them.
+        Counters that are zero, did not increase since the last trial or come before the trigger are not
+        valid (e.g. the event did not happen or the circuit has no such tag), their sample and time are NaN.
+
+        Args:
+            trial (int): number of the trial
+            player (None | str): name of the processor that played the trial, required for events without processor
+            frame_times (None | numpy.ndarray): host times (time.monotonic) of the camera frames
+                acquired for the response, e.g. Cameras.timestamps
+            **info: additional values that are stored with the trial
+        Returns:
+            dict: sample and host time of each event, the reaction time (button - trigger) in seconds
+                and the time of the first and last camera frame
+        """
+        procs = {name: player if proc is None else proc for name, (proc, _) in self.events.items()}
+        if None in procs.values():
+            raise ValueError("The processor that played the trial must be given as player!")
+        self.sync(set(procs.values()))
+        record = {"trial": trial, **info}
+        for name, (_, tag) in self.events.items():
+            sample = float(self.processors.read(tag, proc=procs[name]))
+            previous, self._latched[name] = self._latched.get(name), sample
+            if sample <= 0 or (previous is not None and sample <= previous):
+                logging.warning(f"the counter of the event {name} did not increase, the event is ignored!")
+                sample = np.nan
+            record[f"{name}_sample"] = sample
+            record[f"{name}_time"] = float(self.clocks[procs[name]].to_host(sample))
+        if "trigger" in self.events and np.isfinite(record["trigger_time"]):
+            for name in self.events:
+                if record[f"{name}_time"] < record["trigger_time"]:
+                    logging.warning(f"the event {name} happened before the trigger, the event is ignored!")
+                    record[f"{name}_sample"] = record[f"{name}_time"] = np.nan
+        if "trigger" in self.events and "button" in self.events:
+            trigger_proc, button_proc = procs["trigger"], procs["button"]
+            if trigger_proc == button_proc:  # same clock: use the samples directly
+                rate = self.clocks[trigger_proc].rate
+                record["rt"] = (record["button_sample"] - record["trigger_sample"]) / rate
+            else:
+                record["rt"] = record["button_time"] - record["trigger_time"]
+        if frame_times is not None and np.size(frame_times):
+            record["frames_start"], record["frames_end"] = float(np.min(frame_times)), float(np.max(frame_times))
+        self.trials.append(record)
+        return record
+
+    def to_dataframe(self):
+        """Return the events of all trials, one row per trial."""
+        return pd.DataFrame(self.trials)
+
+    def drift(self):
+        """Return the estimated drift of each processor's clock relative to its nominal samplerate."""
+        drift = {proc: clock.drift for proc, clock in self.clocks.items()}
+        logging.info("clock drift: " + ", ".join(f"{proc}: {d * 1e6:.1f} ppm" for proc, d in drift.items()))
+        return drift